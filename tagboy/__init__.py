@@ -4,6 +4,12 @@ if __package__ is None:
     from os import sys, path
     sys.path.append(path.dirname(path.abspath(__file__)))
 
+from tbcache import TagCache
 from tbcmd import ArgParser, main
-from tbcore import TagBoy
-from tbutil import distance
+from tbcore import LazyTagDict, TagBoy
+from tbgeo import PointIndex, clusters
+from tbindex import TagIndex
+from tbmeta import MetadataSnapshot, TagRecord, TagSchema
+from tbtable import TagTable
+from tbutil import NameMatcher, distance
+from tbwrite import TagWriter
@@ -0,0 +1,159 @@
+# ******************************************************************************
+#
+# Copyright (C) 2018 Dan Christian <DanChristian65@gmail.com>
+#
+# This file is part of tagboy distribution.
+#
+# tagboy is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# tagboy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tagboy; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, 5th Floor, Boston, MA 02110-1301 USA.
+#
+# Author: Dan Christian <DanChristian65@gmail.com>
+
+# Tag aggregations (--count-tags, --distinct-values)
+
+from __future__ import absolute_import
+
+
+class _Aggregate(object):
+    """Per tag accumulator that can be split across --jobs workers.
+
+    Workers Add() files and hand their partial state back with Take();
+    the parent combines them with Merge().  Tag names are interned, so
+    each name is stored once however many files have it.
+
+    Subclasses define Add(tags, names), State() (the picklable partial
+    state), Clear(), Merge(state), and Report(files).
+    """
+
+    def __init__(self):
+        self.names = dict()     # name -> the one copy of name
+
+    def _Intern(self, name):
+        return self.names.setdefault(name, name)
+
+    def Take(self):
+        """Return the state since the last Take() and clear it."""
+        state = self.State()
+        self.Clear()
+        return state
+
+
+class TagCounter(_Aggregate):
+    """Count the files with a non-empty value for each tag (tb-tagcount)."""
+
+    def __init__(self):
+        _Aggregate.__init__(self)
+        self.counts = dict()    # name -> file count
+
+    def Add(self, tags, names):
+        """Count one file.  names are the (long) tag names to look at."""
+        counts = self.counts
+        for kk in names:
+            if not tags[kk]:
+                continue
+            kk = self._Intern(kk)
+            counts[kk] = counts.get(kk, 0) + 1
+
+    def State(self):
+        return self.counts
+
+    def Clear(self):
+        self.counts = dict()
+
+    def Merge(self, state):
+        """Add in the output of Take()."""
+        counts = self.counts
+        for kk, nn in state.iteritems():
+            kk = self._Intern(kk)
+            counts[kk] = counts.get(kk, 0) + nn
+
+    def Report(self, files):
+        """Return the output lines."""
+        lines = ["%60s: %d" % (kk, self.counts[kk])
+                 for kk in sorted(self.counts)]
+        lines.append("Looked at %d files" % files)
+        return lines
+
+
+class DistinctValues(_Aggregate):
+    """Collect the different values of each tag (tb-tagdiff).
+
+    Like tb-tagdiff, long values are shortened before they are compared,
+    so values that only differ after MAX_SHOW characters count as one.
+    """
+    MAX_SHOW = 80               # longer values are shortened
+
+    def __init__(self):
+        _Aggregate.__init__(self)
+        self.values = dict()    # name -> set of values
+
+    @classmethod
+    def _Str(cls, value):
+        """Return value as a shortened byte string.
+
+        One item lists are unwrapped.
+        """
+        if isinstance(value, (list, tuple)) and len(value) == 1:
+            value = value[0]
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        else:
+            value = str(value)
+        if len(value) > cls.MAX_SHOW:
+            return value[:cls.MAX_SHOW] + "..."
+        return value
+
+    def Add(self, tags, names):
+        """Add the values of one file."""
+        values = self.values
+        for kk in names:
+            vv = self._Str(tags[kk])
+            seen = values.get(kk)
+            if seen is None:
+                seen = values[self._Intern(kk)] = set()
+            seen.add(vv)
+
+    def State(self):
+        return self.values
+
+    def Clear(self):
+        self.values = dict()
+
+    def Merge(self, state):
+        """Add in the output of Take()."""
+        values = self.values
+        for kk, vals in state.iteritems():
+            seen = values.get(kk)
+            if seen is None:
+                values[self._Intern(kk)] = set(vals)
+            else:
+                seen.update(vals)
+
+    def Report(self, files):
+        """Return the output lines."""
+        lines = ["Looked at %d files" % files,
+                 "These tags never changed (or appeared only once):"]
+        names = sorted(self.values)
+        for kk in names:
+            if len(self.values[kk]) == 1:
+                vv, = self.values[kk]
+                lines.append("== %s: %s" % (kk, vv))
+        lines.append("These tags changed:")
+        for kk in names:
+            vals = self.values[kk]
+            if len(vals) == 1:
+                continue
+            lines.append("=== %s (%d):\n\"%s\"" % (kk, len(vals),
+                                                  "\", \"".join(sorted(vals))))
+        return lines
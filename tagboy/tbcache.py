@@ -0,0 +1,126 @@
+# ******************************************************************************
+#
+# Copyright (C) 2018 Dan Christian <DanChristian65@gmail.com>
+#
+# This file is part of tagboy distribution.
+#
+# tagboy is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# tagboy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tagboy; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, 5th Floor, Boston, MA 02110-1301 USA.
+#
+# Author: Dan Christian <DanChristian65@gmail.com>
+
+# Persistent metadata cache (sqlite3)
+
+from __future__ import absolute_import
+
+import cPickle
+import os
+import random
+import sqlite3
+
+from tbmeta import MetadataSnapshot
+
+
+class TagCache(object):
+    """On disk cache of metadata snapshots for --cache.
+
+    Entries are keyed by path and are only used if the file's size,
+    mtime, and inode still match.  Each process opens its own
+    connection, so a cache can be shared by --jobs workers.  Every
+    store is committed at once, so no worker holds the write lock
+    while it does something else.  Hits are written down in a batch
+    by Commit(), so Prune() only has to check files not seen this run.
+    """
+    TIMEOUT = 60                # seconds to wait for another writer
+
+    def __init__(self, path):
+        self.path = path
+        self.run_id = random.getrandbits(62) # marks entries seen this run
+        self._hits = set()      # paths found by Lookup(), marked by Commit()
+        self._db = None
+        self._pid = None
+
+    def _Connect(self):
+        """Return a connection for this process (connections can't be forked)."""
+        if self._db is not None and self._pid == os.getpid():
+            return self._db
+        self._db = sqlite3.connect(self.path, timeout=self.TIMEOUT)
+        self._db.text_factory = str
+        self._pid = os.getpid()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL") # WAL commits don't sync
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " path TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER,"
+            " seen INTEGER, snapshot BLOB)")
+        return self._db
+
+    @staticmethod
+    def Signature(fname):
+        """Return the stat signature used to validate entries."""
+        st = os.stat(fname)
+        return (st.st_size, st.st_mtime, st.st_ino)
+
+    def Lookup(self, fname, sig):
+        """Return the cached MetadataSnapshot for fname, or None."""
+        db = self._Connect()
+        row = db.execute(
+            "SELECT size, mtime, inode, snapshot FROM files WHERE path = ?",
+            (fname,)).fetchone()
+        if not row or tuple(row[:3]) != sig:
+            return None
+        self._hits.add(fname)
+        return MetadataSnapshot.FromState(cPickle.loads(str(row[3])))
+
+    def Store(self, fname, sig, snap):
+        """Add or replace the entry for fname."""
+        blob = cPickle.dumps(snap.GetState(), cPickle.HIGHEST_PROTOCOL)
+        db = self._Connect()
+        db.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+            (fname, sig[0], sig[1], sig[2], self.run_id, sqlite3.Binary(blob)))
+        db.commit()
+
+    def Prune(self):
+        """Drop entries for deleted files.  Returns the number dropped.
+
+        Entries stored or found during this run are known to exist, so
+        only the rest are checked with a stat.  Other processes (e.g.
+        --jobs workers) must Commit() their hits first.
+        """
+        self.Commit()
+        db = self._Connect()
+        gone = [(pp,) for (pp,) in db.execute(
+            "SELECT path FROM files WHERE seen != ?", (self.run_id,))
+                if not os.path.exists(pp)]
+        db.executemany("DELETE FROM files WHERE path = ?", gone)
+        db.commit()
+        return len(gone)
+
+    def Commit(self):
+        """Write out any pending changes, including this run's hits."""
+        if self._hits:
+            db = self._Connect()
+            db.executemany("UPDATE files SET seen = ? WHERE path = ?",
+                           [(self.run_id, pp) for pp in self._hits])
+            self._hits.clear()
+        if self._db is not None and self._pid == os.getpid():
+            self._db.commit()
+
+    def Close(self):
+        """Commit and close this process's connection."""
+        self.Commit()
+        if self._db is not None and self._pid == os.getpid():
+            self._db.close()
+        self._db = None
@@ -63,8 +63,11 @@ if multiple --grep options are given, only continue if ALL of them
 match.
 
 If multiple --near options are given, select a file if ANY of them
-match.  The special tags _near and _distance will be set to the
-nearest match.
+match.  --near-file reads many places (one 'LAT, LON' per line).  The
+special tags _near and _distance will be set to the nearest match.
+
+With --jobs, files are read and filtered (--grep, --near) by worker
+processes.  --begin/eval/end and all output still happen in file order.
 
 For --echo or --exec, $TAG or ${TAG} will expand into the files value
 for that tag.  If the file doesn't have that tag, then it will passed
@@ -72,6 +75,57 @@ through unchanged.  In addition to file tags, the program defines:
 _arg, _filecount, _filename, _filepath, _matchcount, _version.
 See:  http://docs.python.org/library/string.html#string.Template
 
+--format writes one record per matching file for other programs to
+read: jsonl (a JSON object per line), csv or tsv (the --select tag
+names are the columns), or print0 (NUL terminated paths for xargs -0).
+It can't be combined with --print, --echo, or --ls.
+
+--thumbnails OUTDIR copies the largest preview image stored in each
+matching file (or the EXIF thumbnail) into OUTDIR as NAME-HASH.jpg (or
+whatever type the preview is), where HASH comes from the file's full
+path.  The bytes are copied as is.  Outputs newer than their file are
+left alone, so re-runs only do new or changed files.  With --jobs (and
+no --eval) the worker processes do the work.
+
+--cluster-gps RADIUS_M groups the matching files that have a GPS
+position into places: a file joins a place if it is within RADIUS_M
+meters of any file already there.  Each place is shown at the end with
+its center and files.
+
+--count-tags shows how many matching files have a non-empty value for
+each tag, and --distinct-values lists the tags that never changed and
+the different values of those that did (values are shortened to 80
+characters before they are compared).  Both look at the --select tags,
+or all tags, and are shown at the end.
+
+--table OUT.npz saves the tags (the --select tags, or all of them) of
+every matching file as numpy columns for analysis.  Numeric tags become
+int64/float64 columns with a NAME:mask of missing values, other tags
+become integer codes into a NAME:vocab list of strings, and the GPS
+position is in lat/lon (NaN if unknown).  Load it with numpy.load().
+
+--build-index DB records the tags (and position) of every file read.
+Later runs with --use-index DB answer --iname, --grep, --near, and
+--select for the files under the given paths from the index without
+opening any images (--eval and --ls see the stored tags).  Rebuild the
+index to pick up changed files.
+
+--watch keeps running after the directories are done, and handles
+files as they are created or changed (until interrupted), including
+any that showed up during the first pass.  It uses inotify, or
+re-reads the directories with --watch-poll (e.g. for network file
+systems).  --begin runs once, and --end runs on exit.
+
+--stats shows the calls, wall and CPU seconds of each phase
+(e.g. read, grep, eval, exec) at the end.  With --jobs, the read
+through near phases are summed over all workers.  --progress shows
+files/sec while running (and an ETA if only files are given).
+
+--exec-batch works like xargs: file paths are appended to the command
+instead of expanding tags (only $_arg and $_version may be used).  If
+any --exec command fails, they are listed at the end and the exit
+status is 3.
+
 For arguments that take 'globs' (e.g. --iname, --name, grep's tags_glob):
   ?   - matches any single character
   *   - match zero or more characters
@@ -100,6 +154,36 @@ matchcount, version, and skip.  The skip variable defaults to 0.  If
 the --eval sets skip to a non False value, further processing
 (e.g. --grep, --ls, --print) will be skipped.
 
+--evalbatch FILE runs FILE once.  It must define evalbatch(records),
+which is called with up to --evalbatch-size files at a time as a list
+of (filepath, tags, selected).  It returns None to keep every file, or
+a list with a true value for each file to skip.  Output for a file
+waits until its batch has run.  If FILE sets evalbatch_tags to a list
+of tag names or globs, only those are decoded for it.
+
+--journal FILE records each finished file (every 1000 files or 30
+seconds, synced to disk).  The --begin/--eval globals that can be
+pickled and the --count-tags/--distinct-values totals are saved with
+each batch, in FILE.state.  If the run is interrupted, running the
+same command again skips the recorded files without opening them and
+carries on; --end then runs once, for the whole set.  A journal from a
+finished run starts over.  It can't be used with --table,
+--cluster-gps, --symsync, or --symclear.
+
+Tag values that --eval changes (e.g. tags['Artist'] = 'Me') are shown
+as a diff on stderr.  With --write they are written back to the file
+instead (shown with -v), one write per file, by a pool of --write-jobs
+threads while the next files are read.  --write-temp changes a copy of
+the file and renames it over the original, so an interrupted write
+never leaves a damaged image.  New tags are not created, and only text
+tags (Exif Ascii, IPTC String, and XMP text) can be written; a file
+with any other tag changed is reported and left alone.
+
+Only the tags that are used (by --echo, --exec, --grep, --select,
+--near, or --eval) are decoded.  If --eval code uses tags other than
+by constant name (e.g. tags[name] or tags.keys()), or uses objs, then
+every tag is decoded.
+
 Examples:
   tagboy ./ --iname '*.jpg' --ls
   tagboy ./ --iname '*.jpg' --echo '$_filename: ${Keywords}'
@@ -116,7 +200,6 @@ VERSION='0.13'
 
 #TODO: Field comparisons (more than --eval ?)
 #TODO: Field assignments
-#TODO: Thumbnail extraction
 #TODO: Read/write image comments (separate from EXIF comments)
 #TODO: Whitelist of interesting tags (others ignored)
 #TODO: Write/read a sqlite3? database with ???
@@ -165,6 +248,14 @@ def ArgParser():
         "--exec",
         help="Execute string with $var substitution (repeatable)",
         action="append", dest="execStrings", default=[])
+    parser.add_option(
+        "--exec-jobs", type="int",
+        help="Run up to EXEC_JOBS --exec commands at once (default 1)",
+        dest="exec_jobs", default=1)
+    parser.add_option(
+        "--exec-batch", type="int",
+        help="Append up to EXEC_BATCH file paths to each --exec command",
+        dest="exec_batch", default=0)
     parser.add_option(
         "-n",
         "--noexec",
@@ -174,6 +265,26 @@ def ArgParser():
         "--ls",
         help="Show image info (shows long names with -v or --long)",
         action="store_true", dest="ls", default=False)
+    parser.add_option(
+        "--format", type="choice", choices=FORMATS,
+        help="Write matches as FORMAT: %s" % '|'.join(FORMATS),
+        dest="format", default=None)
+    parser.add_option(
+        "--thumbnails", metavar="OUTDIR",
+        help="Save the embedded preview of each matching file in OUTDIR",
+        dest="thumbnails", default=None)
+    parser.add_option(
+        "--count-tags",
+        help="Count the matching files that have each tag (long names)",
+        action="store_true", dest="count_tags", default=False)
+    parser.add_option(
+        "--distinct-values",
+        help="Show which tags have the same value in every matching file",
+        action="store_true", dest="distinct_values", default=False)
+    parser.add_option(
+        "--table",
+        help="Save matching tags as numpy columns in OUT.npz (needs numpy)",
+        metavar="OUT.npz", dest="table", default=None)
     parser.add_option(
         "-s",
         "--select",
@@ -184,10 +295,18 @@ def ArgParser():
         help="match files with GPS position near 'LAT, LON' (repeatable, -v shows match)",
         nargs = 1,
         action="append", dest="near", default=[])
+    parser.add_option(
+        "--near-file",
+        help="match files near any 'LAT, LON' line in NEAR_FILE (repeatable)",
+        action="append", dest="near_files", default=[])
     parser.add_option(
         "--distance",
         help="radius for a --near match in kilometers (default 5)",
         dest="near_dist", default=5)
+    parser.add_option(
+        "--cluster-gps", type="float", metavar="RADIUS_M",
+        help="Group matching files by GPS position, within RADIUS_M meters",
+        dest="cluster_gps", default=None)
     parser.add_option(
         "--maxstr", type="int",
         help="Maximum string length to print (default 50, 0 = unlimited)",
@@ -200,6 +319,10 @@ def ArgParser():
         "--symclear",
         help="Remove all symlinks in LINKDIR before creating new ones",
         action="store_true", dest="symclear", default=False)
+    parser.add_option(
+        "--symsync",
+        help="Update LINKDIR at the end to hold exactly the selected files",
+        action="store_true", dest="symsync", default=False)
     parser.add_option(
         "--begin",
         help="Python statement(s) to run before first file (repeatable)",
@@ -220,6 +343,30 @@ def ArgParser():
         "--evalfile",
         help="Python file to run for each file (repeatable)",
         action="append", dest="eval_files", default=[])
+    parser.add_option(
+        "--evalbatch",
+        help="Python file defining evalbatch(records) to run on batches of files",
+        dest="evalbatch", default=None)
+    parser.add_option(
+        "--evalbatch-size", type="int",
+        help="Files per --evalbatch call (default 1000)",
+        dest="evalbatch_size", default=1000)
+    parser.add_option(
+        "--journal", metavar="FILE",
+        help="Record finished files in FILE, and skip them when resuming",
+        dest="journal", default=None)
+    parser.add_option(
+        "--write",
+        help="Write tag values changed by --eval back into the files",
+        action="store_true", dest="write", default=False)
+    parser.add_option(
+        "--write-temp",
+        help="With --write, change a copy of each file and rename it into place",
+        action="store_true", dest="write_temp", default=False)
+    parser.add_option(
+        "--write-jobs", type="int",
+        help="Write up to WRITE_JOBS files at once (default 2)",
+        dest="write_jobs", default=2)
     parser.add_option(
         "--arg",
         help="Pass this argument to begin/eval/end",
@@ -228,6 +375,55 @@ def ArgParser():
         "--endfile",
         help="Python file to run after last file (repeatable)",
         action="append", dest="end_files", default=[])
+    parser.add_option(
+        "--cache",
+        help="Cache tags in sqlite file CACHE.  Unchanged files aren't re-read",
+        dest="cache", default=None)
+    parser.add_option(
+        "--build-index",
+        help="Store the tags of every file read in the BUILD_INDEX database",
+        dest="build_index", default=None)
+    parser.add_option(
+        "--use-index",
+        help="Find files with the USE_INDEX database instead of reading them",
+        dest="use_index", default=None)
+    parser.add_option(
+        "--fast-read",
+        help="Read JPEG/TIFF tags directly (no maker notes, fewer human values)",
+        action="store_true", dest="fast_read", default=False)
+    parser.add_option(
+        "-j",
+        "--jobs", type="int",
+        help="Read files using JOBS worker processes (default 1)",
+        dest="jobs", default=1)
+    parser.add_option(
+        "--watch",
+        help="After the directories are done, handle new or changed files",
+        action="store_true", dest="watch", default=False)
+    parser.add_option(
+        "--watch-delay", type="float",
+        help="Wait for files to be unchanged WATCH_DELAY seconds (default 2)",
+        dest="watch_delay", default=2.0)
+    parser.add_option(
+        "--watch-poll",
+        help="Watch by re-reading directories every WATCH_DELAY seconds",
+        action="store_true", dest="watch_poll", default=False)
+    parser.add_option(
+        "--stats",
+        help="Show time spent in each phase and files/sec at the end",
+        action="store_true", dest="stats", default=False)
+    parser.add_option(
+        "--stats-json",
+        help="Write --stats to STATS_JSON as json",
+        dest="stats_json", default=None)
+    parser.add_option(
+        "--progress",
+        help="Show files/sec (and ETA if known) on stderr while running",
+        action="store_true", dest="progress", default=False)
+    parser.add_option(
+        "--walk-jobs", type="int",
+        help="List directories using WALK_JOBS threads (default 1)",
+        dest="walk_jobs", default=1)
     parser.add_option(
         "-L",
         "--follow", help="Follow symbolic links to directories",
@@ -272,18 +468,27 @@ def main():
     if not args:
         tb.Error("No arguments.  Nothing to do.  Use -h for help.")
         sys.exit(2)
+    if tb.progress and not any(os.path.isdir(pp) for pp in args):
+        tb.progress.total = len(args) # only files, so the ETA is known
+    dirs = [parg for parg in args if os.path.isdir(parg)]
+    if tb.options.watch and not dirs:
+        tb.Error("--watch needs a directory to watch")
     try:
+        if tb.options.watch and dirs: # catch changes during the first walk
+            tb.StartWatch(dirs)
         for parg in args:
-            if os.path.isdir(parg):
-                tb.EachDir(parg)
-            elif os.path.isfile(parg):
-                tb.EachFile(parg)
-            else:
-                print >> sys.stderr, ("Can't find a file/directory named: %s"
-                                      % (parg))
+            tb.EachArg(parg)
+        if tb.options.watch and dirs:
+            tb.Watch(dirs)
     except (KeyboardInterrupt, SystemExit):
-        pass
-    if tb.DoEnd():
+        tb.interrupted = True
+        if tb.journal:          # leave --end for the resumed run
+            tb.Suspend()
+            sys.exit(130)
+    matched = tb.DoEnd()
+    if tb.exec_failures:
+        sys.exit(3)
+    if matched:
         sys.exit(0)
     else:
         sys.exit(1)
@@ -26,7 +26,14 @@ from __future__ import absolute_import
 from __future__ import division
 #This breaks all the examples:  from __future__ import print_function
 
+import collections
+import cPickle as pickle
+import dis
 import fnmatch
+import functools
+import hashlib
+import multiprocessing
+import multiprocessing.util
 import os
 try:
     import pyexiv2 as ex
@@ -34,11 +41,29 @@ except ImportError:
     print "Unable to import pyexiv2.  You may need: sudo apt install python-pyexiv2"
     sys.exit(1)
 
+import pipes
 import re
+import signal
+import sqlite3
 import subprocess
 import string
+import StringIO
 import sys
-
+import time
+
+from tbagg import DistinctValues, TagCounter
+from tbcache import TagCache
+from tbgeo import PointIndex, centroid, clusters
+from tbindex import TagIndex
+from tbjournal import Journal
+from tbmeta import MetadataSnapshot, TagDemand, TagRecord
+from tbout import FORMATS, MakeSink
+from tbstats import PhaseStats, Progress
+from tbtable import HAVE_NUMPY, TagTable
+from tbreader import ReadFast
+from tbwalk import DirWalker
+from tbwatch import Debouncer, MakeWatcher
+from tbwrite import TagWriter
 from tbutil import *
 
 
@@ -46,6 +71,266 @@ class TagTemplate(string.Template):
     """Sub-class string.Template to allow . in variable names."""
     idpattern = r'[_a-z][\._a-z0-9]*'
 
+    def Names(self):
+        """Return the set of variable names used in the template."""
+        names = set()
+        for mo in self.pattern.finditer(self.template):
+            name = mo.group('named') or mo.group('braced')
+            if name:
+                names.add(name)
+        return names
+
+
+# Names that give --eval code a way to reach any tag
+EVAL_DYNAMIC_NAMES = frozenset(['objs', 'objmap', 'locals', 'vars', 'globals', 'eval',
+                                'execfile', 'compile', '__import__'])
+# tags methods that are safe when called with a constant tag name
+EVAL_TAG_METHODS = frozenset(['get', 'has_key', 'setdefault', 'pop'])
+EVAL_SUBSCRIPT_OPS = frozenset(['BINARY_SUBSCR', 'STORE_SUBSCR',
+                                'DELETE_SUBSCR', 'DUP_TOPX'])
+EVAL_CALL_OPS = frozenset(['CALL_FUNCTION', 'CALL_METHOD', 'PRECALL', 'CALL'])
+
+
+def _Instructions(code):
+    """Generate (opcode name, argument) for a code object."""
+    if hasattr(dis, 'get_instructions'): # python 3.4+
+        for ins in dis.get_instructions(code):
+            yield ins.opname, ins.arg
+        return
+    co = code.co_code
+    ii = 0
+    extended = 0
+    while ii < len(co):
+        op = ord(co[ii])
+        if op < dis.HAVE_ARGUMENT:
+            yield dis.opname[op], None
+            ii += 1
+            continue
+        arg = ord(co[ii+1]) + ord(co[ii+2]) * 256 + extended
+        ii += 3
+        extended = 0
+        if op == dis.EXTENDED_ARG:
+            extended = arg * 65536
+            continue
+        yield dis.opname[op], arg
+
+
+def CodeTagNames(code, var='tags'):
+    """Return the tag names that compiled --eval code looks up in var.
+
+    Only constant lookups are understood: var['Name'], var.get('Name'),
+    etc.  Returns None if the code could use any tag (e.g. it iterates
+    over var or uses objs).
+    """
+    if EVAL_DYNAMIC_NAMES.intersection(code.co_names):
+        return None
+    ins = list(_Instructions(code))
+    names = set()
+    for ii, (op, arg) in enumerate(ins):
+        if op in ('LOAD_NAME', 'LOAD_GLOBAL'):
+            name = code.co_names[arg]
+        elif op == 'LOAD_FAST':
+            name = code.co_varnames[arg]
+        elif op == 'LOAD_DEREF':
+            name = (code.co_cellvars + code.co_freevars)[arg]
+        else:
+            continue
+        if name != var:
+            continue
+        nxt = ins[ii+1:ii+5] + [(None, None)] * 4
+        if (nxt[0][0] in ('LOAD_ATTR', 'LOAD_METHOD')
+            and code.co_names[nxt[0][1]] in EVAL_TAG_METHODS):
+            const_op = nxt[1]   # var.get('Name'[, 'default'])
+            if nxt[2][0] == 'LOAD_CONST':
+                call_op = nxt[3]
+            else:
+                call_op = nxt[2]
+            if call_op[0] not in EVAL_CALL_OPS: # e.g. var.get('A.' + x)
+                return None
+        elif nxt[1][0] in EVAL_SUBSCRIPT_OPS:
+            const_op = nxt[0]   # var['Name']
+        else:
+            return None
+        if const_op[0] != 'LOAD_CONST':
+            return None
+        const = code.co_consts[const_op[1]]
+        if not isinstance(const, basestring):
+            return None
+        names.add(const)
+    for const in code.co_consts: # nested functions, lambdas, etc.
+        if hasattr(const, 'co_code'):
+            nested = CodeTagNames(const, var)
+            if nested is None:
+                return None
+            names |= nested
+    return names
+
+
+class LazyTagDict(dict):
+    """Dictionary of tag values that converts each value on first use.
+
+    It acts like a normal dict.  Anything that needs every value
+    (e.g. keys(), iteritems(), len()) converts all the remaining ones.
+    revmap is referenced, not copied, so only values are stored per
+    file.  It must not change while the dict is in use.
+    """
+    __slots__ = ('_convert', '_revmap', '_dropped', '_full')
+
+    def __init__(self, convert, revmap, converted=None):
+        dict.__init__(self)
+        self._convert = convert          # function: long_name -> value
+        self._revmap = revmap            # name -> long_name
+        self._dropped = None             # set of tag names deleted
+        self._full = False               # every tag has been converted
+        if converted:
+            self.update(converted)
+
+    def Converted(self):
+        """Return a plain dict of just the values converted so far."""
+        return dict(dict.iteritems(self))
+
+    def _Pending(self, key):
+        """Check if key is a tag that hasn't been converted (or deleted)."""
+        return (not self._full and key in self._revmap
+                and not dict.__contains__(self, key)
+                and not (self._dropped and key in self._dropped))
+
+    def _Drop(self, key):
+        """Remember that a tag was deleted, so it isn't converted again."""
+        if not self._full and key in self._revmap:
+            if self._dropped is None:
+                self._dropped = set()
+            self._dropped.add(key)
+
+    def _Fill(self):
+        """Convert all remaining values."""
+        if self._full:
+            return
+        for kk, long_name in self._revmap.iteritems():
+            if self._Pending(kk):
+                dict.__setitem__(self, kk, self._convert(long_name))
+        self._full = True
+        self._dropped = None
+
+    def __missing__(self, key):
+        if not self._Pending(key):
+            raise KeyError(key)     # not a tag
+        value = self._convert(self._revmap[key])
+        dict.__setitem__(self, key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if self._Pending(key):
+            self._Drop(key)
+        else:
+            dict.__delitem__(self, key)
+            self._Drop(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or self._Pending(key)
+
+    def has_key(self, key):
+        return key in self
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        if self._Pending(key):
+            self[key]
+        self._Drop(key)
+        return dict.pop(self, key, *default)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for kk, vv in dict(*args, **kwargs).iteritems():
+            self[kk] = vv
+
+    def copy(self):
+        self._Fill()
+        return dict(self)
+
+    def keys(self):
+        self._Fill()
+        return dict.keys(self)
+
+    def values(self):
+        self._Fill()
+        return dict.values(self)
+
+    def items(self):
+        self._Fill()
+        return dict.items(self)
+
+    def iterkeys(self):
+        self._Fill()
+        return dict.iterkeys(self)
+
+    def itervalues(self):
+        self._Fill()
+        return dict.itervalues(self)
+
+    def iteritems(self):
+        self._Fill()
+        return dict.iteritems(self)
+
+    def popitem(self):
+        self._Fill()
+        return dict.popitem(self)
+
+    def clear(self):
+        self._full = True
+        self._dropped = None
+        dict.clear(self)
+
+    def __iter__(self):
+        self._Fill()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._Fill()
+        return dict.__len__(self)
+
+    def __eq__(self, other):
+        self._Fill()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        self._Fill()
+        return dict.__repr__(self)
+
+
+_worker_tb = None   # TagBoy instance inherited by --jobs worker processes
+
+
+def _InitWorker(tb):
+    """Set up a --jobs worker process.  Called once per worker."""
+    global _worker_tb
+    _worker_tb = tb
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # parent handles ^C
+    if tb.cache:                # commit when the pool shuts down
+        multiprocessing.util.Finalize(tb.cache, tb.cache.Close, exitpriority=10)
+    if tb.index:
+        multiprocessing.util.Finalize(tb.index, tb.index.Close, exitpriority=10)
+
+
+def _ScanWorker(fn):
+    """Pool entry point: read and filter one file in a worker."""
+    return _worker_tb.ScanFile(fn)
+
 
 class TagBoy(object):
     """Class that implements tag mapulation."""
@@ -59,12 +344,22 @@ class TagBoy(object):
     OBJMAP     = 'objmap'     # name of dict of tag names: short -> long
     SELECTED   = 'selected'   # name of dict of --select tags short -> long
     SKIP       = 'skip'       # name of set True to end processing of this file
+    EVALBATCH  = 'evalbatch'  # name of --evalbatch function(records)
+    EVALBATCH_TAGS = 'evalbatch_tags' # name of optional list of tags it uses
     TAGS       = 'tags'       # name of dict of all tags: name -> value
     VERSION    = 'version'    # name of version of tagboy (string)
 
                                         # parse degree, minutes, seconds.  e.g. 37deg 16' 25.870
     DMS_RE = re.compile("\s*(\d+)deg (\d+)' ([0-9.]+)\s*")
 
+    GPS_KEYS = ("Exif.GPSInfo.GPSLatitude", "Exif.GPSInfo.GPSLatitudeRef",
+                "Exif.GPSInfo.GPSLongitude", "Exif.GPSInfo.GPSLongitudeRef")
+
+    JOB_CHUNK = 16              # files handed to a --jobs worker at a time
+    GLOB_CACHE_SIZE = 1000      # key layouts to remember tag glob matches for
+    KEYMAP_CACHE_SIZE = 1000    # key layouts to remember name mappings for
+    EXEC_BATCH_BYTES = 65536    # longest --exec-batch command line
+
     def __init__(self, version="dev"):
         self.file_count = 0       # number of files encountered
         self.match_count = 0      # number of files 'matched'
@@ -73,12 +368,45 @@ class TagBoy(object):
         self.begin_code = list()  # list of compiled code for before any file
         self.eval_code = list()   # list of compiled code for each file
         self.end_code = list()    # list of compiled code for after all files
+        self.evalbatch = None     # --evalbatch function(records) -> skips
+        self.eval_batch = list()  # [(record, tags)...] waiting for evalbatch
         self.echo_tmpl = list()   # list of echo statement templates
         self.exec_tmpl = list()   # list of exec statement templates
+        self.exec_batches = list() # per exec template: [paths...] to run
+        self.exec_running = list() # [(Popen, command)...] still running
+        self.exec_count = 0       # number of commands started
+        self.exec_failures = list() # [(command, status)...] that failed
+        self.sym_links = dict()   # --symsync: link name -> target path
+        self.interrupted = False  # set if the run was stopped early
         self.iname_globs = list() # list of case converted name globs
+        self.name_matcher = NameMatcher() # all --name/--iname globs
         self.greps = list()       # list of search (RE, glob)
         self.selects = list()     # list of select globs
+        self.glob_cache = dict()  # key layout -> {tag glob -> [names]}
+        self.keymap_cache = collections.OrderedDict() # (layout, long) -> revmap
+        self.demand = None        # TagDemand of the tags used, None is all
         self.near = list()        # list of places of interest
+        self.near_index = None    # PointIndex of self.near
+        self.pool = None          # worker processes for --jobs
+        self.walker = None        # DirWalker for directory arguments
+        self.watcher = None       # --watch watcher, started before the walk
+        self.cache = None         # TagCache for --cache
+        self.index = None         # TagIndex for --build-index or --use-index
+        self.sink = None          # RecordSink for --format
+        self.sink_columns = list() # --format csv/tsv column tag names
+        self.table = None         # TagTable for --table
+        self.aggregates = list()  # --count-tags and --distinct-values
+        self.positions = None     # [(lat, lon)...] for --cluster-gps
+        self.position_paths = list() # file path of each of self.positions
+        self.thumb_names = dict() # --thumbnails file stem -> output name
+        self.writer = None        # TagWriter for --write
+        self.change_files = 0     # files with --eval tag changes
+        self.change_tags = 0      # tag values changed by --eval
+        self.journal = None       # Journal for --journal
+        self.started = False      # --begin has run
+        self.stats = PhaseStats() # --stats phase times and event counters
+        self.counters = self.stats.counters # event name -> count
+        self.progress = None      # Progress for --progress
 
     def HandleArgs(self, options, pos_args):
         """Process argument parsing and return parsed arguments."""
@@ -91,15 +419,70 @@ class TagBoy(object):
                        self.options.linkdir)
             sys.exit(2)
 
+        if self.options.write:
+            if self.options.write_jobs < 1:
+                self.Error("--write-jobs must be at least 1: %d"
+                           % self.options.write_jobs)
+                sys.exit(2)
+            self.writer = TagWriter(ex.ImageMetadata, self.options.write_jobs,
+                                    self.options.write_temp, self.Error)
+        elif self.options.write_temp:
+            self.Error("--write-temp requires --write")
+            sys.exit(2)
+
+        if self.options.journal:
+            for opt, name in ((self.options.table, '--table'),
+                              (self.options.cluster_gps, '--cluster-gps'),
+                              (self.options.symsync, '--symsync'),
+                              (self.options.symclear, '--symclear')):
+                if opt:
+                    self.Error("%s needs every file in one run.  It can't be"
+                               " used with --journal" % name)
+                    sys.exit(2)
+            try:
+                self.journal = Journal(self.options.journal)
+            except (IOError, OSError) as inst:
+                self.Error("Unable to use --journal %s: %s"
+                           % (self.options.journal, inst))
+                sys.exit(2)
+
+        if self.options.thumbnails:
+            try:
+                if not os.path.isdir(self.options.thumbnails):
+                    os.makedirs(self.options.thumbnails)
+                for name in os.listdir(self.options.thumbnails):
+                    self.thumb_names[os.path.splitext(name)[0]] = name
+            except OSError as inst:
+                self.Error("Unable to use --thumbnails %s: %s"
+                           % (self.options.thumbnails, inst))
+                sys.exit(2)
+
         if self.options.symclear and not self.options.linkdir:
             self.Error(
                 "Warning: --symclear is ignored if --symlink is not specified")
+        if self.options.symsync and not self.options.linkdir:
+            self.Error(
+                "Warning: --symsync is ignored if --symlink is not specified")
 
         for ss in self.options.echoStrings: # convert echo list into templates
             self.echo_tmpl.append(TagTemplate(ss))
 
         for ss in self.options.execStrings: # convert echo list into templates
             self.exec_tmpl.append(TagTemplate(ss))
+            self.exec_batches.append(list())
+
+        if self.options.exec_jobs < 1:
+            self.Error("--exec-jobs must be at least 1: %d"
+                       % self.options.exec_jobs)
+            sys.exit(2)
+        if self.options.exec_batch > 1:
+            allowed = set(['_'+self.ARG, '_'+self.VERSION])
+            for et in self.exec_tmpl:
+                if et.Names() - allowed:
+                    self.Error("--exec-batch appends file paths.  "
+                               "Only $_arg and $_version can be used in: %s"
+                               % et.template)
+                    sys.exit(2)
 
         for nn in self.options.near: # convert echo list into templates
             try:
@@ -107,6 +490,9 @@ class TagBoy(object):
             except ValueError:
                 self.Error("Unable to parse %r as (lat, lon).  IGNORED" % nn)
 
+        for ff in self.options.near_files:
+            self.near.extend(self._ReadLatLonFile(ff))
+
         # Compile all code first to flush out any errors
         for ss in self.options.begin_files:
             self.begin_code.append(self._CompileFile(ss))
@@ -118,6 +504,19 @@ class TagBoy(object):
         for ss in self.options.do_eval:
             self.eval_code.append(self._Compile(ss))
 
+        if self.options.evalbatch:
+            self._Eval(self._CompileFile(self.options.evalbatch),
+                       self.global_vars)
+            self.evalbatch = self.global_vars.get(self.EVALBATCH)
+            if not callable(self.evalbatch):
+                self.Error("%s must define a function: %s(records)"
+                           % (self.options.evalbatch, self.EVALBATCH))
+                sys.exit(2)
+            if self.options.evalbatch_size < 1:
+                self.Error("--evalbatch-size must be at least 1: %d"
+                           % self.options.evalbatch_size)
+                sys.exit(2)
+
         for ss in self.options.end_files:
             self.end_code.append(self._CompileFile(ss))
         for ss in self.options.do_end:
@@ -125,8 +524,51 @@ class TagBoy(object):
 
         for chk in self.options.iGlobs: # make case insensitive
             self.iname_globs.append(chk.lower())
+        self.name_matcher = NameMatcher(self.options.nameGlobs,
+                                        self.iname_globs)
 
         self.options.near_dist = float(self.options.near_dist)
+        if self.near:
+            self.near_index = PointIndex(self.near, self.options.near_dist)
+
+        if self.options.jobs < 1:
+            self.Error("--jobs must be at least 1: %d" % self.options.jobs)
+            sys.exit(2)
+        if self.options.walk_jobs < 1:
+            self.Error("--walk-jobs must be at least 1: %d"
+                       % self.options.walk_jobs)
+            sys.exit(2)
+
+        if self.options.stats_json:
+            self.options.stats = True
+        self.stats.enabled = self.options.stats
+        if self.options.progress:
+            self.progress = Progress()
+
+        if self.options.cache:
+            self.cache = TagCache(self.options.cache)
+            try:                # flush out any errors now
+                self.cache.Commit()
+                self.cache._Connect()
+            except sqlite3.Error as inst:
+                self.Error("Unable to open cache %s: %s"
+                           % (self.options.cache, inst))
+                sys.exit(2)
+
+        if self.options.build_index and self.options.use_index:
+            self.Error("Use only one of --build-index and --use-index")
+            sys.exit(2)
+        index_path = self.options.build_index or self.options.use_index
+        if index_path:
+            if self.options.use_index and not os.path.isfile(index_path):
+                self.Error("No index named: %s" % index_path)
+                sys.exit(2)
+            self.index = TagIndex(index_path)
+            try:                # flush out any errors now
+                self.index._Connect()
+            except sqlite3.Error as inst:
+                self.Error("Unable to open index %s: %s" % (index_path, inst))
+                sys.exit(2)
 
         compile_flags = re.IGNORECASE if self.options.igrep else 0
         for pat, targ in self.options.grep:
@@ -138,6 +580,53 @@ class TagBoy(object):
             for tt in targ.split(';'):
                 self.selects.append(tt)
 
+        if self.options.format:
+            if self.options.printpath or self.echo_tmpl or self.options.ls:
+                self.Error("--format can't be used with --print, --echo, or --ls")
+                sys.exit(2)
+            if self.options.format in ('csv', 'tsv'):
+                if not self.selects:
+                    self.Error("--format %s needs --select to name its columns"
+                               % self.options.format)
+                    sys.exit(2)
+                for ss in self.selects:
+                    if NameMatcher.GLOB_CHARS.intersection(ss):
+                        self.Error("--format %s columns must be tag names: %s"
+                                   % (self.options.format, ss))
+                        sys.exit(2)
+                self.sink_columns = self.selects
+            self.sink = MakeSink(self.options.format, self.sink_columns)
+
+        if self.options.count_tags:
+            self.aggregates.append(TagCounter())
+        if self.options.distinct_values:
+            self.aggregates.append(DistinctValues())
+
+        if self.options.cluster_gps is not None:
+            if self.options.cluster_gps <= 0:
+                self.Error("--cluster-gps radius must be positive")
+                sys.exit(2)
+            self.positions = list()
+
+        if self.options.table:
+            if not HAVE_NUMPY:
+                self.Error("--table needs numpy, which isn't installed")
+                sys.exit(2)
+            self.table = TagTable()
+
+        self.demand = self.TagDemand()
+        self.Debug(1, "Tags used: %s" % (self.demand or "all"))
+
+        if self.journal and self.journal.done:
+            state = self.journal.state or dict()
+            self.file_count = state.get('file_count', 0)
+            self.match_count = state.get('match_count', 0)
+            for agg, agg_state in zip(self.aggregates,
+                                      state.get('aggregates', ())):
+                agg.Merge(agg_state)
+            self.Verbose("Resuming: %d files done (journal %s)"
+                         % (len(self.journal.done), self.options.journal))
+
         self.global_vars[self.ARG] = self.options.argument
 
         if self.options.version:
@@ -146,6 +635,34 @@ class TagBoy(object):
 
         return pos_args
 
+    def TagDemand(self):
+        """Work out which tags this run uses from the arguments.
+
+        Returns a TagDemand, or None if every tag may be used.
+        """
+        if (self.cache or self.options.build_index
+            or (self.options.ls and not self.selects)
+            or (self.options.format == 'jsonl' and not self.selects)
+            or (self.options.table and not self.selects)
+            or (self.aggregates and not self.selects)):
+            return None
+        names = set(self.sink_columns)
+        for tmpl in self.echo_tmpl + self.exec_tmpl:
+            names.update(nn for nn in tmpl.Names() if nn[0] != '_')
+        if self.near or self.table is not None or self.positions is not None:
+            names.update(self.GPS_KEYS)
+        for cc in self.eval_code:
+            used = CodeTagNames(cc, self.TAGS)
+            if used is None:
+                return None
+            names.update(used)
+        globs = list(self.selects) + [tag_glob for rec, tag_glob in self.greps]
+        if self.evalbatch:
+            if self.EVALBATCH_TAGS not in self.global_vars:
+                return None     # can't tell what it uses
+            globs.extend(self.global_vars[self.EVALBATCH_TAGS])
+        return TagDemand(names, globs)
+
     def Error(self, msg):
         """Output an error message."""
         print >> sys.stderr, msg
@@ -162,14 +679,50 @@ class TagBoy(object):
             return
         print >> sys.stderr, msg
 
+    def Count(self, name, count=1):
+        """Add to a named event counter."""
+        self.stats.Count(name, count)
+
     def ReadMetadata(self, fname):
-        """Read file metadata and return."""
+        """Read file metadata and return.
+
+        With --cache or --fast-read, a MetadataSnapshot is returned
+        instead of the live pyexiv2 object.
+        """
+        sig = None
+        if self.cache:
+            try:
+                sig = self.cache.Signature(fname)
+            except OSError:
+                pass
+            if sig:
+                try:
+                    snap = self.cache.Lookup(fname, sig)
+                except sqlite3.Error as inst:
+                    self.Error("Cache error reading %s: %s" % (fname, inst))
+                    snap = None
+                if snap is not None:
+                    self.Count('cache_hit')
+                    return snap
+            self.Count('cache_miss')
+        if self.options.fast_read:
+            snap = ReadFast(fname, self.demand)
+            if snap is not None:
+                self.Count('fast_read')
+                return snap
+            self.Count('fast_fallback')
         metadata = ex.ImageMetadata(fname)
         try:
             metadata.read()
         except IOError:
             self.Error("Error reading: %s" % fname)
             metadata = None         # force object distruction
+        if metadata and sig:
+            metadata = MetadataSnapshot.FromMetadata(metadata)
+            try:
+                self.cache.Store(fname, sig, metadata)
+            except sqlite3.Error as inst:
+                self.Error("Cache error storing %s: %s" % (fname, inst))
         return metadata
 
     def HumanStr(self, metadata, key):
@@ -193,8 +746,14 @@ class TagBoy(object):
         self._MakeKeyMap(metadata.xmp_keys, revmap)
 
     def _MakeKeyMap(self, keys, revmap):
-        """Insert name mapping into revmap: long->long and short->long."""
+        """Insert name mapping into revmap: long->long and short->long.
+
+        Tags this run doesn't use (see TagDemand) are left out.
+        """
+        demand = self.demand
         for k in keys:
+            if demand is not None and not demand.Wants(k):
+                continue
             revmap[k] = k
             if self.options.long:
                 continue
@@ -253,6 +812,28 @@ class TagBoy(object):
         else:
             self.PrintKeyValue(local_tags, select_tags)
 
+    def SinkItems(self, local_tags, select_tags=None):
+        """Return [(name, value)...] for a --format record.
+
+        csv/tsv get the --select columns.  Otherwise the same tags --ls
+        would show are used.
+        """
+        if self.sink_columns:
+            return [(kk, local_tags.get(kk, '')) for kk in self.sink_columns]
+        if select_tags is not None:
+            names = select_tags.keys()
+        else:
+            names = local_tags.keys()
+        items = list()
+        for kk in sorted(names):
+            if not self.options.verbose and kk[0] == '_': # internal variable
+                continue
+            if (not self.options.long and
+                not self.options.verbose and kk.find('.') >= 0):
+                continue            # skip the dotted names
+            items.append((kk, local_tags[kk]))
+        return items
+
     def SymClear(self):
         """Clear all symbolic links in options.linkdir."""
         for fn in os.listdir(self.options.linkdir):
@@ -275,6 +856,10 @@ class TagBoy(object):
             self.Error("Warning: symlink would point to itself: %s" % abs_path)
             return
 
+        if self.options.symsync: # just record it.  SymSync does the work
+            self.sym_links[os.path.basename(fn)] = abs_path
+            return
+
         if os.path.exists(dest_path) and os.path.islink(dest_path):
             try:                # attempt to unlink
                 os.unlink(dest_path)
@@ -284,14 +869,134 @@ class TagBoy(object):
             os.symlink(abs_path, dest_path)
             self.Verbose("ln -s %s %s" % (abs_path, self.options.linkdir))
         except OSError as inst:
-            self.Errof("Unable to ln -s %s %s: %s" % (
+            self.Error("Unable to ln -s %s %s: %s" % (
                     abs_path, self.options.linkdir, inst))
 
-    def Grep(self, fname, metadata, revmap):
+    def SymSync(self):
+        """Make the symlinks in options.linkdir match this run's matches.
+
+        Only links that are new, changed, or no longer wanted are
+        touched.  New links are made in a staging directory and renamed
+        into place, so a reader never sees a missing or partial link.
+        Returns (added, removed, unchanged).
+        """
+        linkdir = self.options.linkdir
+        existing = dict()       # name -> current target
+        for entry in list_dir(linkdir):
+            if entry.is_symlink():
+                try:
+                    existing[entry.name] = os.readlink(entry.path)
+                except OSError:
+                    pass
+            elif entry.name in self.sym_links:
+                self.Error("Unable to ln -s %s %s: not a symlink" % (
+                    self.sym_links.pop(entry.name), linkdir))
+
+        added = 0
+        wanted = [(name, target)
+                  for name, target in sorted(self.sym_links.iteritems())
+                  if existing.get(name) != target]
+        staging = os.path.join(linkdir, '.tagboy-staging-%d' % os.getpid())
+        if wanted:
+            try:
+                os.mkdir(staging)
+            except OSError as inst:
+                self.Error("Unable to make %s: %s" % (staging, inst))
+                wanted = []
+        try:
+            for name, target in wanted:
+                tmp_path = os.path.join(staging, name)
+                try:
+                    os.symlink(target, tmp_path)
+                    os.rename(tmp_path, os.path.join(linkdir, name))
+                    self.Verbose("ln -s %s %s" % (target, linkdir))
+                    added += 1
+                except OSError as inst:
+                    self.Error("Unable to ln -s %s %s: %s" % (
+                        target, linkdir, inst))
+                    if os.path.lexists(tmp_path):
+                        os.unlink(tmp_path)
+        finally:
+            if wanted:
+                os.rmdir(staging)
+
+        removed = 0
+        for name in sorted(set(existing) - set(self.sym_links)):
+            try:
+                os.unlink(os.path.join(linkdir, name))
+                removed += 1
+            except OSError as inst:
+                self.Error("Unable to remove %s: %s" % (
+                    os.path.join(linkdir, name), inst))
+        unchanged = len(self.sym_links) - len(wanted)
+        self.Verbose("Symlinks: %d added, %d removed, %d unchanged"
+                     % (added, removed, unchanged))
+        return (added, removed, unchanged)
+
+    def KeyLayout(self, metadata):
+        """Return a hashable summary of the keys in metadata.
+
+        Files from the same camera (and firmware) share a layout.
+        """
+        if isinstance(metadata, MetadataSnapshot):
+            return metadata.schema.Layout()
+        return (tuple(metadata.exif_keys), tuple(metadata.iptc_keys),
+                tuple(metadata.xmp_keys))
+
+    def KeyMap(self, metadata, layout=None):
+        """Return the read only name mapping (see MakeKeyMap) for metadata.
+
+        The mapping only depends on the key layout (and --long), so one
+        copy is shared by all files with that layout.  The least
+        recently used layouts are dropped when there are too many.
+        """
+        if layout is None:
+            layout = self.KeyLayout(metadata)
+        cache_key = (layout, bool(self.options.long))
+        revmap = self.keymap_cache.pop(cache_key, None)
+        if revmap is not None:
+            self.Count('keymap_hit')
+        else:
+            self.Count('keymap_miss')
+            revmap = dict()
+            self.MakeKeyMap(metadata, revmap)
+            revmap = FrozenDict(revmap)
+            if len(self.keymap_cache) >= self.KEYMAP_CACHE_SIZE:
+                self.keymap_cache.popitem(last=False)
+        self.keymap_cache[cache_key] = revmap # now the most recent
+        return revmap
+
+    def ExpandGlobs(self, metadata, revmap, layout=None):
+        """Return {tag_glob: [names]} for every --grep and --select glob.
+
+        The expansion only depends on the key layout, so it is
+        remembered for each layout.
+        """
+        if not self.greps and not self.selects:
+            return dict()
+        if layout is None:
+            layout = self.KeyLayout(metadata)
+        expanded = self.glob_cache.get(layout)
+        if expanded is not None:
+            self.Count('glob_hit')
+            return expanded
+        self.Count('glob_miss')
+        names = revmap.keys()
+        expanded = dict()
+        for tag_glob in [tg for mp, tg in self.greps] + self.selects:
+            expanded[tag_glob] = fnmatch.filter(names, tag_glob)
+        if len(self.glob_cache) >= self.GLOB_CACHE_SIZE:
+            self.glob_cache.clear()
+        self.glob_cache[layout] = expanded
+        return expanded
+
+    def Grep(self, fname, metadata, revmap, expanded=None):
         """Check if all patterns match for this file."""
+        if expanded is None:
+            expanded = self.ExpandGlobs(metadata, revmap)
         all_match = True
         for mpat, tag_glob in self.greps:
-            keys = fnmatch.filter(revmap.keys(), tag_glob) # Expand tag glob
+            keys = expanded[tag_glob] # Expand tag glob
             self.Debug(2, "Matched keys: %s" % keys)
             matched = False
             for kk in keys:
@@ -340,6 +1045,29 @@ class TagBoy(object):
         lon = lon.strip()
         return (float(lat), float(lon))
 
+    def _ReadLatLonFile(self, fname):
+        """Read a list of positions, one 'lat, lon' per line.
+
+        Blank lines and lines starting with # are ignored.
+        """
+        points = list()
+        try:
+            fd = open(fname, 'r')
+        except IOError:
+            self.Error("Unable to read: %s" % fname)
+            sys.exit(2)
+        for num, line in enumerate(fd):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                points.append(self._ParseLatLon(line))
+            except ValueError:
+                self.Error("%s:%d: Unable to parse %r as (lat, lon).  IGNORED"
+                           % (fname, num + 1, line))
+        fd.close()
+        return points
+
     def _ConvertDMS(self, dms):
         """Convert degree, minute, second string to decimal degrees."""
         # TODO: class method
@@ -387,15 +1115,14 @@ class TagBoy(object):
 
         nearest = None
         closest = None
-        for pos in self.near:
-            dist = distance(pos, file_pos)
-            if dist <= self.options.near_dist:
-                if closest is None or dist < closest:   # find closest match
-                    closest = dist
-                    nearest = pos
-            else:
-                self.Debug(1, "%s: (%.6f, %.6f) is %.1fkm from (%.6f, %.6f)" % (
-                    fname, file_pos[0], file_pos[1], dist, pos[0], pos[1]))
+        found = self.near_index.Nearest(file_pos)
+        if found:
+            closest, ii = found
+            nearest = self.near[ii]
+        else:
+            self.Debug(1, "%s: (%.6f, %.6f) is not within %.1fkm of %d points" % (
+                fname, file_pos[0], file_pos[1], self.options.near_dist,
+                len(self.near)))
 
         if nearest:
             self.Verbose("%s: (%.6f, %.6f) is %.1fkm from (%.6f, %.6f)" % (
@@ -407,15 +1134,77 @@ class TagBoy(object):
         return False
 
     def AllExec(self, var_list):
-        """Run all --exec commands."""
-        for et in self.exec_tmpl:
-            cmd = et.safe_substitute(var_list)
-            if self.options.verbose or self.options.noexec:
-                print "Executing: %s" % (cmd)
-            if self.options.noexec:
+        """Run all --exec commands (or add this file to each --exec-batch)."""
+        for ii, et in enumerate(self.exec_tmpl):
+            if self.options.exec_batch > 1:
+                batch = self.exec_batches[ii]
+                batch.append(var_list['_'+self.FILEPATH])
+                if len(batch) >= self.options.exec_batch:
+                    self._FlushExecBatch(ii)
                 continue
-            p = subprocess.Popen(cmd, shell=True)
-            sts = os.waitpid(p.pid, 0)[1]
+            self._StartExec(et.safe_substitute(var_list))
+
+    def _FlushExecBatch(self, ii):
+        """Run exec template ii once with all its pending paths appended."""
+        paths = self.exec_batches[ii]
+        self.exec_batches[ii] = list()
+        base = self.exec_tmpl[ii].safe_substitute({
+            '_'+self.ARG: self.options.argument,
+            '_'+self.VERSION: self.global_vars[self.VERSION]})
+        cmd = base
+        for pp in paths:
+            arg = ' ' + pipes.quote(pp)
+            if cmd != base and len(cmd) + len(arg) > self.EXEC_BATCH_BYTES:
+                self._StartExec(cmd)
+                cmd = base
+            cmd += arg
+        if cmd != base:
+            self._StartExec(cmd)
+
+    def _StartExec(self, cmd):
+        """Start a command.  Waits if --exec-jobs are already running."""
+        if self.options.verbose or self.options.noexec:
+            print "Executing: %s" % (cmd)
+        if self.options.noexec:
+            return
+        while len(self.exec_running) >= self.options.exec_jobs:
+            self._ReapExec(block=True)
+        sys.stdout.flush()      # keep our output ahead of the command's
+        self.exec_running.append((subprocess.Popen(cmd, shell=True), cmd))
+        self.exec_count += 1
+        if self.options.exec_jobs <= 1:
+            self._ReapExec(block=True)
+
+    def _ReapExec(self, block=False):
+        """Collect finished commands.  With block, wait for at least one."""
+        running = list()
+        for proc, cmd in self.exec_running:
+            if proc.poll() is None:
+                running.append((proc, cmd))
+            elif proc.returncode:
+                self.exec_failures.append((cmd, proc.returncode))
+        if block and running and len(running) == len(self.exec_running):
+            proc, cmd = running.pop(0) # nothing done yet.  Wait for oldest
+            if proc.wait():
+                self.exec_failures.append((cmd, proc.returncode))
+        self.exec_running = running
+
+    def FinishExec(self):
+        """Run any partial batches, wait for all commands, report failures."""
+        for ii in range(len(self.exec_batches)):
+            if self.exec_batches[ii]:
+                self._FlushExecBatch(ii)
+        while self.exec_running:
+            self._ReapExec(block=True)
+        if not self.exec_failures:
+            return
+        self.Error("%d of %d --exec commands failed:"
+                   % (len(self.exec_failures), self.exec_count))
+        for cmd, status in self.exec_failures:
+            if status < 0:
+                self.Error("  signal %d: %s" % (-status, cmd))
+            else:
+                self.Error("  exit %d: %s" % (status, cmd))
 
     def _Compile(self, statements, source=None):
         """Our compile with error handling."""
@@ -453,82 +1242,420 @@ class TagBoy(object):
             self.Error("Eval failed <%s>: %s" % (inst, code))
 
     def DoStart(self):
-        """Do setup for first file."""
-        if not self.begin_code:
-            return
+        """Do setup for first file.
+
+        When resuming from a --journal, the saved globals replace what
+        --begin set up.
+        """
+        self.started = True
         self.global_vars[self.FILECOUNT] = self.file_count
         for cc in self.begin_code:
             self._Eval(cc, {})
+        if self.journal and self.journal.state:
+            self.global_vars.update(self.journal.state.get('globals', {}))
+
+    def JournalState(self):
+        """Return the run state to checkpoint in the --journal.
+
+        Only the --begin/--eval globals that can be pickled are kept
+        (e.g. not modules or functions, which --begin makes again).
+        """
+        saved = dict()
+        skip = (self.ARG, self.FILECOUNT, self.MATCHCOUNT, self.VERSION,
+                self.EVALBATCH)
+        for kk, vv in self.global_vars.iteritems():
+            if kk.startswith('__') or kk in skip:
+                continue
+            try:
+                pickle.dumps(vv, pickle.HIGHEST_PROTOCOL)
+            except Exception:   # pickle raises many types
+                continue
+            saved[kk] = vv
+        return {'file_count': self.file_count,
+                'match_count': self.match_count,
+                'globals': saved,
+                'aggregates': [agg.State() for agg in self.aggregates]}
+
+    def Resumed(self, fn):
+        """Check if an earlier run (see --journal) already did fn."""
+        if self.journal and fn in self.journal:
+            self.Count('journal_skip')
+            return True
+        return False
+
+    def Processed(self, fn):
+        """Record a finished file in the --journal."""
+        if not self.journal:
+            return
+        self.journal.Add(fn)
+        if self.journal.Due():
+            self.Checkpoint()
+
+    def Checkpoint(self):
+        """Push out pending work, then checkpoint the --journal."""
+        self.EndBatch()
+        with self.stats.Phase('journal'):
+            self.journal.Checkpoint(self.JournalState())
+
+    def Suspend(self):
+        """Stop an interrupted --journal run so it can be resumed.
+
+        Finished work is written and checkpointed.  Unlike DoEnd, --end
+        and the final reports are left for the run that completes.
+        """
+        self.Checkpoint()
+        self.journal.Close()
+        if self.exec_tmpl:
+            self.FinishExec()
+        if self.writer:
+            self.writer.Close()
+        if self.sink:
+            self.sink.Close()
+        if self.walker:
+            self.walker.Close()
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        if self.cache:
+            self.cache.Close()
+        if self.index:
+            self.index.Close()
+        self.Error("Interrupted: %d files done.  Run again with --journal %s"
+                   " to resume" % (len(self.journal.done) + self.journal.written,
+                                   self.options.journal))
 
     def CheckMatch(self, fname):
         """Check if path matches a command line match expression."""
-        if not self.options.nameGlobs and not self.iname_globs:
-            return True         # Nothing means match all
-        # Note: fnmatch is only case insensitive if the filesystem is
-        for chk in self.iname_globs: # First try case insensitive
-            if fnmatch.fnmatchcase(fname.lower(), chk):
-                return True
-        for chk in self.options.nameGlobs: # always case sensitive
-            if fnmatch.fnmatchcase(fname, chk):
-                return True
-        return False
+        return self.name_matcher(fname)
+
+    def WalkDir(self, parg):
+        """Generate the path of every matching file under directory parg."""
+        if not self.walker:
+            self.walker = DirWalker(
+                self.name_matcher, self.options.maxdepth, self.options.follow,
+                self.options.walk_jobs, self.Debug)
+        return self.walker.Walk(parg)
+
+    def Watch(self, dirs, batches=None, seconds=None):
+        """Handle files as they are created or changed under dirs (--watch).
+
+        Runs until interrupted, or for at most batches batches or
+        seconds seconds (for testing).  Changed files are collected
+        until they have been quiet for --watch-delay seconds and then
+        handled as a batch.
+        Changes since StartWatch() (e.g. during the first walk) are
+        handled first.
+        """
+        if self.watcher is None:
+            self.StartWatch(dirs)
+        watcher = self.watcher
+        pending = Debouncer(self.options.watch_delay)
+        end = time.time() + seconds if seconds is not None else None
+        try:
+            while batches is None or batches > 0:
+                timeout = pending.Timeout()
+                if end is not None:
+                    left = max(end - time.time(), 0)
+                    if left <= 0:
+                        break
+                    timeout = left if timeout is None else min(timeout, left)
+                pending.Add(watcher.Read(timeout))
+                batch = pending.Ready()
+                if not batch:
+                    continue
+                self.Debug(1, "Watch batch of %d files" % len(batch))
+                self.Count('watch_batch')
+                self.EachFiles(batch)
+                self.EndBatch()
+                if batches is not None:
+                    batches -= 1
+        finally:
+            watcher.Close()
+            self.watcher = None
+
+    def StartWatch(self, dirs):
+        """Start watching dirs for --watch.
+
+        Call this before the first walk, so files that show up while
+        it runs are caught by Watch().
+        """
+        self.watcher = MakeWatcher(
+            dirs, self.name_matcher, self.options.maxdepth,
+            self.options.follow, self.options.watch_poll,
+            self.options.watch_delay, self.Debug)
+        self.Verbose("Watching %s (%s)" % (', '.join(dirs), self.watcher.NAME))
+
+    def EndBatch(self):
+        """Push out output and pending work between --watch batches."""
+        if self.evalbatch:
+            self.FlushEvalBatch()
+        for ii in range(len(self.exec_batches)):
+            if self.exec_batches[ii]:
+                self._FlushExecBatch(ii)
+        self._ReapExec()
+        if self.sink:
+            self.sink.Flush()
+        if self.writer:
+            with self.stats.Phase('write'):
+                self.writer.Flush()
+        if self.cache:
+            self.cache.Commit()
+        if self.index:
+            self.index.Commit()
+        sys.stdout.flush()
+
+    def EachArg(self, parg):
+        """Handle one command line argument: a directory or file."""
+        if self.options.use_index:
+            self.EachIndexed(parg)
+        elif os.path.isdir(parg):
+            self.EachDir(parg)
+        elif os.path.isfile(parg):
+            if not self.Resumed(parg):
+                self.EachFile(parg)
+        else:
+            print >> sys.stderr, ("Can't find a file/directory named: %s"
+                                  % (parg))
 
     def EachDir(self, parg):
         """Handle directory walk."""
-        if parg[-1] == os.sep: # trim final slash
-            parg = parg[:-1]
-        base_count = parg.count(os.sep)
-        for root, dirs, files in os.walk(parg, followlinks=self.options.follow):
-            depth = root.count(os.sep) - base_count
-            if (self.options.maxdepth >= 0
-                and depth >= self.options.maxdepth):
-                self.Debug(2, "Hit maxdepth.  Trimming %s" % dirs)
-                del dirs[:] # trim all sub directories
-            else:
-                for d in dirs:
-                    if d.startswith('.'): # ignore hidden directories
-                        self.Debug(2, "Trimming hidden: %s" % (d))
-                        dirs.remove(d)
-            for fn in files:
-                if not self.CheckMatch(fn):
-                    continue
-                self.EachFile(os.path.join(root, fn))
+        paths = self.WalkDir(parg)
+        if self.journal:
+            paths = (fn for fn in paths if not self.Resumed(fn))
+        self.EachFiles(paths)
 
-    def _MakeTagDict(self, meta, revmap, tags):
-        """Convert remap and meta into tags[key] -> value."""
-        for k in revmap.keys(): # clone tags as variables
-            tags[k] = self.HumanStr(meta, revmap[k])
+    def EachFiles(self, paths):
+        """Handle a sequence of files, using worker processes if --jobs > 1.
 
-    def EachFile(self, fn):
-        """Handle one file."""
-        meta = self.ReadMetadata(fn)
-        if not meta:
+        Workers do the reading, key mapping, grep, and near filtering.
+        Everything else (begin/eval/end and all output) happens here in
+        the original file order.
+        """
+        if self.options.jobs <= 1:
+            for fn in paths:
+                self.EachFile(fn)
             return
-        if self.file_count == 0:
+        if not self.pool:
+            self.pool = multiprocessing.Pool(
+                self.options.jobs, _InitWorker, (self,))
+        try:
+            for fn, readable, rec, output, stats, aggs in self.pool.imap(
+                    _ScanWorker, paths, self.JOB_CHUNK):
+                self.stats.Merge(stats)
+                for agg, state in zip(self.aggregates, aggs):
+                    if state:
+                        agg.Merge(state)
+                if readable:
+                    self._StartFile()
+                    if output:          # e.g. grep -v matches
+                        sys.stdout.write(output)
+                    if rec:
+                        rec.revmap = self.KeyMap(rec.meta)
+                        self.FinishFile(rec)
+                self.Processed(fn)
+        except KeyboardInterrupt:   # don't wait for queued files
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+            raise
+
+    def _MakeTagDict(self, meta, revmap, converted=None):
+        """Return tags[key] -> value for revmap and meta.
+
+        Values are only converted when used.  converted holds values
+        already known (e.g. from a --jobs worker).
+        """
+        return LazyTagDict(functools.partial(self.HumanStr, meta),
+                           revmap, converted)
+
+    def _StartFile(self):
+        """Count a readable file.  Runs --begin before the first one."""
+        if not self.started:
             self.DoStart()
-            if self.options.linkdir and self.options.symclear:
+            if (self.options.linkdir and self.options.symclear
+                and not self.options.symsync):
                 self.SymClear()
         self.file_count += 1
-        revmap = dict()
-        self.MakeKeyMap(meta, revmap)
+        if self.progress:
+            self.progress.Update(self.file_count, self.match_count)
 
-        if self.greps and not self.Grep(fn, meta, revmap):
-            return
+    def IndexFile(self, fn, meta):
+        """Add a file's tags to the --build-index database.
+
+        Returns the MetadataSnapshot that was stored.
+        """
+        if not isinstance(meta, MetadataSnapshot):
+            meta = MetadataSnapshot.FromMetadata(meta)
+        revmap = self.KeyMap(meta)
+        latlon = self._GetDecimalLatLon(self._MakeTagDict(meta, revmap))
+        rows = list()
+        for kk in meta.exif_keys + meta.iptc_keys + meta.xmp_keys:
+            if kk not in meta:  # value couldn't be read
+                continue
+            tag = meta[kk]
+            if kk in meta.iptc_keys and tag.repeatable:
+                values = tag.value
+            else:
+                values = [self.HumanStr(meta, kk)]
+            short = kk.split('.')[-1]
+            rows.extend((kk, short, vv) for vv in values)
+        try:
+            self.index.Store(fn, meta, latlon, rows)
+        except sqlite3.Error as inst:
+            self.Error("Index error storing %s: %s" % (fn, inst))
+            return meta
+        self.Count('index_store')
+        return meta
+
+    def EachIndexed(self, parg):
+        """Handle the files under parg in the --use-index database.
+
+        The index narrows down the files, then the usual tests run on
+        the stored snapshots.  No image files are opened.
+        """
+        for fn, meta in self.index.Query(parg, self.name_matcher, self.greps,
+                                         self.near, self.options.near_dist):
+            if self.Resumed(fn):
+                continue
+            self.Count('index_hit')
+            self._StartFile()
+            rec = self.ScanMetadata(fn, meta)
+            if rec:
+                self.FinishFile(rec)
+            self.Processed(fn)
+
+    def EachFile(self, fn):
+        """Handle one file."""
+        with self.stats.Phase('read'):
+            meta = self.ReadMetadata(fn)
+        if meta:
+            if self.options.build_index:
+                with self.stats.Phase('index'):
+                    meta = self.IndexFile(fn, meta)
+            self._StartFile()
+            rec = self.ScanMetadata(fn, meta)
+            if rec:
+                self.FinishFile(rec)
+        self.Processed(fn)
+
+    def ScanFile(self, fn):
+        """Read and filter one file in a --jobs worker.
+
+        Returns (fn, readable, record, output, stats, aggregates).  The
+        record is None if the file was filtered out.  Anything printed
+        (e.g. grep -v matches) is captured in output so the parent can
+        replay it in order.  Phase times, counters, and aggregates are
+        passed back and reset.  Without --eval, the outputs that don't
+        depend on file order (see EarlyOutput) are done here.
+        """
+        old_stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            with self.stats.Phase('read'):
+                meta = self.ReadMetadata(fn)
+            if meta and self.options.build_index:
+                with self.stats.Phase('index'):
+                    meta = self.IndexFile(fn, meta)
+            rec = None
+            if meta:
+                rec = self.ScanMetadata(fn, meta)
+            if rec and not (self.eval_code or self.evalbatch):
+                self.EarlyOutput(rec, meta)
+            if rec:             # make everything picklable
+                if not isinstance(meta, MetadataSnapshot):
+                    rec.meta = MetadataSnapshot.FromMetadata(
+                        meta, self.demand)
+                rec.tags = rec.tags.Converted()
+                rec.revmap = None # the parent has its own shared copy
+            return (fn, bool(meta), rec, sys.stdout.getvalue(),
+                    self.stats.Take(), [agg.Take() for agg in self.aggregates])
+        finally:
+            sys.stdout = old_stdout
+
+    def ScanMetadata(self, fn, meta):
+        """Map keys and apply --grep, --select, and --near to one file.
+
+        Returns a TagRecord, or None if the file doesn't match.
+        """
+        with self.stats.Phase('keymap'):
+            layout = self.KeyLayout(meta)
+            revmap = self.KeyMap(meta, layout)
+            expanded = self.ExpandGlobs(meta, revmap, layout)
+
+        if self.greps:
+            with self.stats.Phase('grep'):
+                if not self.Grep(fn, meta, revmap, expanded):
+                    return None
 
-        local_tags = dict()
         select_tags = None
         if self.selects:
-            select_tags = dict()
-            for ss in self.selects:
-                keys = fnmatch.filter(revmap.keys(), ss)
-                for kk in keys:
-                    select_tags[kk] = revmap[kk]
-            self.Debug(2, "Matched keys: %s" % keys)
+            with self.stats.Phase('select'):
+                select_tags = dict()
+                for ss in self.selects:
+                    keys = expanded[ss]
+                    for kk in keys:
+                        select_tags[kk] = revmap[kk]
+                self.Debug(2, "Matched keys: %s" % keys)
+
+        local_tags = self._MakeTagDict(meta, revmap)
+        if self.near:
+            local_tags['_near'] = ""      # clear any old values
+            local_tags['_distance'] = ""
+            with self.stats.Phase('near'):
+                if not self.Near(fn, local_tags):
+                    return None
+
+        return TagRecord(fn, meta, revmap, select_tags, local_tags)
+
+    def TagChanges(self, meta, revmap, local_tags):
+        """Return {long name: (old, new)} of the tags --eval changed."""
+        changes = dict()
+        for k, v in local_tags.Converted().iteritems(): # look for changes
+            if k[0] == '_':     # internal variable (e.g. _near)
+                continue
+            if not revmap.has_key(k):
+                # TODO: create the tag (if possible)
+                self.Debug(0, "New tag '%s' is ignored" % k)
+                continue
+            long_name = revmap[k]
+            old = self.HumanStr(meta, long_name)
+            if old != v and (long_name not in changes or k == long_name):
+                changes[long_name] = (old, v)
+        return changes
+
+    def WriteChanges(self, fn, changes):
+        """Queue --eval tag changes for --write, or show them (dry run)."""
+        self.change_files += 1
+        self.change_tags += len(changes)
+        if self.writer is None or self.options.verbose:
+            self.Error("--- %s" % fn)
+            for kk in sorted(changes):
+                old, new = changes[kk]
+                self.Error("-%s: %s" % (kk, old))
+                self.Error("+%s: %s" % (kk, new))
+        if self.writer is not None:
+            with self.stats.Phase('write'):
+                self.writer.Add(fn, dict((kk, new) for kk, (old, new)
+                                         in changes.iteritems()))
+
+    def FinishFile(self, rec):
+        """Run --eval for a file record from ScanMetadata, then output it.
+
+        With --evalbatch, the output waits for the batch to run.
+        """
+        fn = rec.path
+        meta = rec.meta
+        revmap = rec.revmap
+        select_tags = rec.selected
+        local_tags = rec.tags
+        rec.file_count = self.file_count
+        if not isinstance(local_tags, LazyTagDict): # from a --jobs worker
+            local_tags = self._MakeTagDict(meta, revmap, local_tags)
         if self.eval_code:
             self.global_vars[self.FILECOUNT] = self.file_count
             self.global_vars[self.MATCHCOUNT] = self.match_count
             local_vars = dict()
-            self._MakeTagDict(meta, revmap, local_tags)
             # FIX??? why no leading _ here???
             local_vars[self.FILENAME] = os.path.basename(fn)
             local_vars[self.FILEPATH] = fn
@@ -539,61 +1666,347 @@ class TagBoy(object):
             local_vars[self.SKIP] = 0
 
             for cc in self.eval_code:
-                self._Eval(cc, local_vars)
+                with self.stats.Phase('eval'):
+                    self._Eval(cc, local_vars)
                 if local_vars[self.SKIP]:
                     return
-            for k, v in local_tags.iteritems(): # look for changes
-                if not revmap.has_key(k):
-                    # TODO: create the tag (if possible)
-                    self.Debug(0, "New tag '%s' is ignored")
-                    continue
-                if self.HumanStr(meta, revmap[k]) != v:
-                    # TODO: write changes to meta
-                    self.Debug(
-                        0, "Oh look, %s changed: %s -> %s (no writes, yet)" % (
-                            k, unified[k], v))
-                    pass
+            changes = self.TagChanges(meta, revmap, local_tags)
+            if changes:
+                self.WriteChanges(fn, changes)
+
+        if self.evalbatch:
+            if not isinstance(rec.meta, MetadataSnapshot): # held a while
+                rec.meta = MetadataSnapshot.FromMetadata(rec.meta, self.demand)
+                local_tags = self._MakeTagDict(rec.meta, revmap,
+                                               local_tags.Converted())
+                rec.tags = local_tags
+            self.eval_batch.append((rec, local_tags))
+            if len(self.eval_batch) >= self.options.evalbatch_size:
+                self.FlushEvalBatch()
+            return
+        self.OutputFile(rec, local_tags)
+
+    def FlushEvalBatch(self):
+        """Run --evalbatch on the waiting files, then output the kept ones.
+
+        The function gets a list of (path, tags, selected) and returns
+        None (keep all) or a skip flag for each record.
+        """
+        batch = self.eval_batch
+        self.eval_batch = list()
+        if not batch:
+            return
+        self.global_vars[self.FILECOUNT] = self.file_count
+        self.global_vars[self.MATCHCOUNT] = self.match_count
+        records = [(rec.path, tags, rec.selected) for rec, tags in batch]
+        skips = None
+        with self.stats.Phase('evalbatch'):
+            try:
+                skips = self.evalbatch(records)
+            except Exception as inst:
+                self.Error("Evalbatch failed <%s>: %s"
+                           % (inst, self.options.evalbatch))
+        if skips is not None and len(skips) != len(batch):
+            self.Error("Evalbatch returned %d skips for %d files.  Ignored"
+                       % (len(skips), len(batch)))
+            skips = None
+        for ii, (rec, tags) in enumerate(batch):
+            if skips is None or not skips[ii]:
+                self.OutputFile(rec, tags)
+
+    def Aggregate(self, local_tags, revmap, select_tags):
+        """Add a matching file to --count-tags and --distinct-values.
+
+        Only long tag names are used (select_tags maps to them).
+        """
+        with self.stats.Phase('aggregate'):
+            mapped = select_tags if select_tags is not None else revmap
+            names = set(mapped.itervalues())
+            for agg in self.aggregates:
+                agg.Add(local_tags, names)
 
+    def EarlyOutput(self, rec, meta):
+        """Do the outputs that don't need file order in a --jobs worker.
+
+        Only used without --eval (which could still skip the file).
+        """
+        if self.aggregates:
+            self.Aggregate(rec.tags, rec.revmap, rec.selected)
+        if self.options.thumbnails:
+            with self.stats.Phase('thumbnail'):
+                self.Thumbnail(rec.path, meta)
+        rec.early = True
+
+    @staticmethod
+    def PreviewData(meta):
+        """Return (bytes, extension) of the largest embedded preview.
+
+        Falls back to the EXIF thumbnail.  Returns (None, None) if there
+        is neither.
+        """
+        previews = getattr(meta, 'previews', None)
+        if previews:
+            best = max(previews, key=lambda pp: (
+                    pp.dimensions[0] * pp.dimensions[1], pp.size))
+            return best.data, best.extension or '.jpg'
+        thumb = getattr(meta, 'exif_thumbnail', None)
+        if thumb is not None and thumb.data:
+            return thumb.data, thumb.extension or '.jpg'
+        return None, None
+
+    @staticmethod
+    def ThumbnailStem(fn):
+        """Return the unique --thumbnails output name (without type) for fn."""
+        digest = hashlib.sha1(os.path.abspath(fn)).hexdigest()
+        return "%s-%s" % (os.path.splitext(os.path.basename(fn))[0], digest[:8])
+
+    def Thumbnail(self, fn, meta):
+        """Copy the preview image of fn into --thumbnails (not re-encoded).
+
+        The output is OUTDIR/NAME-HASH.EXT, and is skipped if it is
+        newer than the file.  HASH comes from the full path, since
+        cameras reuse names (and NAME.JPG often has a NAME.CR2).
+        Returns the output path, or None.
+        """
+        outdir = self.options.thumbnails
+        stem = self.ThumbnailStem(fn)
+        old = self.thumb_names.get(stem)
+        if old:
+            try:
+                if (os.stat(os.path.join(outdir, old)).st_mtime
+                    >= os.stat(fn).st_mtime):
+                    self.Count('thumb_current')
+                    return None
+            except OSError:     # gone, so write it
+                pass
+        if isinstance(meta, MetadataSnapshot): # no image data
+            meta = ex.ImageMetadata(fn)
+            try:
+                meta.read()
+            except IOError:
+                self.Error("Error reading: %s" % fn)
+                return None
+        data, ext = self.PreviewData(meta)
+        if not data:
+            self.Count('thumb_none')
+            return None
+        name = stem + ext
+        out = os.path.join(outdir, name)
+        if os.path.abspath(out) == os.path.abspath(fn):
+            self.Error("Warning: thumbnail would replace its image: %s" % fn)
+            return None
+        tmp = os.path.join(outdir, '.%s.%d' % (name, os.getpid()))
+        try:
+            with open(tmp, 'wb') as fp:
+                fp.write(data)
+            os.rename(tmp, out) # readers never see a partial file
+        except (IOError, OSError) as inst:
+            self.Error("Unable to write %s: %s" % (out, inst))
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return None
+        if old and old != name: # e.g. the preview type changed
+            try:
+                os.unlink(os.path.join(outdir, old))
+            except OSError:
+                pass
+        self.thumb_names[stem] = name
+        self.Count('thumb_written')
+        self.Verbose("Thumbnail: %s -> %s" % (fn, out))
+        return out
+
+    def ClusterReport(self):
+        """Print the --cluster-gps groups of matching files."""
+        with self.stats.Phase('cluster'):
+            groups = clusters(self.positions,
+                              self.options.cluster_gps / 1000.0)
+        print "Found %d positions in %d matching files (%d files looked at)." % (
+            len(self.positions), self.match_count, self.file_count)
+        print "Here are the %d places within %gm:" % (
+            len(groups), self.options.cluster_gps)
+        for ids in groups:
+            lat, lon = centroid([self.positions[ii] for ii in ids])
+            print "@@ %.6f, %.6f (%d files):\n%s" % (
+                lat, lon, len(ids),
+                "\n".join(self.position_paths[ii] for ii in ids))
+
+    def OutputFile(self, rec, local_tags):
+        """Count a matching file and do all the outputs for it."""
+        fn = rec.path
+        meta = rec.meta
+        revmap = rec.revmap
+        select_tags = rec.selected
         self.match_count += 1
-        if not local_tags: # the following outputs need a tag-value map
-            self._MakeTagDict(meta, revmap, local_tags)
         local_tags['_'+self.ARG] = self.options.argument
-        local_tags['_'+self.FILECOUNT] = self.file_count
+        if rec.file_count is not None: # counted when it was queued
+            local_tags['_'+self.FILECOUNT] = rec.file_count
+        else:
+            local_tags['_'+self.FILECOUNT] = self.file_count
         local_tags['_'+self.FILENAME] = os.path.basename(fn)
         local_tags['_'+self.FILEPATH] = fn
         local_tags['_'+self.MATCHCOUNT] = self.match_count
         local_tags['_'+self.VERSION] = self.global_vars[self.VERSION]
 
-        if self.near:
-            local_tags['_near'] = ""      # clear any old values
-            local_tags['_distance'] = ""
-            if not self.Near(fn, local_tags):
-                return
-
         if self.options.printpath:
             print fn
 
         for et in self.echo_tmpl:
-            out = et.safe_substitute(local_tags)
+            with self.stats.Phase('template'):
+                out = et.safe_substitute(local_tags)
             self.Debug(1, "%r -> %r" % (et, out))   # DEBUG
             print out
 
         if self.options.ls:
-            self.List(fn, local_tags, meta, revmap, select_tags)
+            with self.stats.Phase('list'):
+                self.List(fn, local_tags, meta, revmap, select_tags)
 
         if self.exec_tmpl:
-            self.AllExec(meta, local_tags)
+            with self.stats.Phase('exec'):
+                self.AllExec(local_tags)
 
         if self.options.linkdir:
-            self.SymLink(fn)
+            with self.stats.Phase('symlink'):
+                self.SymLink(fn)
+
+        if self.sink:
+            with self.stats.Phase('format'):
+                self.sink.Write(fn, self.SinkItems(local_tags, select_tags))
+
+        if not rec.early:
+            if self.aggregates:
+                self.Aggregate(local_tags, revmap, select_tags)
+            if self.options.thumbnails:
+                with self.stats.Phase('thumbnail'):
+                    self.Thumbnail(fn, meta)
+
+        if self.positions is not None:
+            pos = self._GetDecimalLatLon(local_tags)
+            if pos:
+                self.positions.append(pos)
+                self.position_paths.append(fn)
+
+        if self.table is not None:
+            with self.stats.Phase('table'):
+                self.table.Add(fn, self.SinkItems(local_tags, select_tags),
+                               self._GetDecimalLatLon(local_tags))
 
     def DoEnd(self):
         """Do final code block after last file.
         Returns: True if there were matches, else False
         """
+        if self.evalbatch:
+            self.FlushEvalBatch()
+        if self.sink:
+            with self.stats.Phase('format'):
+                self.sink.Close()
+            self.Verbose("Output: %d records, %d bytes, %.3f sec to format/write"
+                         % (self.sink.records, self.sink.bytes,
+                            self.sink.seconds))
+        if self.table is not None:
+            try:
+                with self.stats.Phase('table'):
+                    self.table.Save(self.options.table)
+                self.Verbose("Table: %d rows, %d tag columns written to %s"
+                             % (len(self.table), len(self.table.order),
+                                self.options.table))
+            except (IOError, OSError) as inst:
+                self.Error("Unable to write %s: %s" % (self.options.table, inst))
+        if self.exec_tmpl:
+            with self.stats.Phase('exec'):
+                self.FinishExec()
+        if self.writer:
+            with self.stats.Phase('write'):
+                self.writer.Close()
+            self.Verbose("Write: %d tags in %d files, %d files failed, %.3f sec"
+                         % (self.writer.tags, self.writer.files,
+                            self.writer.failed, self.writer.seconds))
+        elif self.change_files:
+            self.Error("Dry run: %d tags changed in %d files (use --write)"
+                       % (self.change_tags, self.change_files))
+        if self.watcher:        # interrupted before Watch()
+            self.watcher.Close()
+            self.watcher = None
+        if self.walker:
+            self.walker.Close()
+            self.stats.Add('walk', self.walker.elapsed, None,
+                           self.walker.dir_count)
+            self.Verbose("Walk: %d files in %d directories, %.0f files/sec"
+                         % (self.walker.file_count, self.walker.dir_count,
+                            self.walker.Rate()))
+        if self.options.linkdir and self.options.symsync:
+            if self.interrupted: # we don't know the full set of links
+                self.Error("Interrupted: --symsync left %s unchanged"
+                           % self.options.linkdir)
+            else:
+                with self.stats.Phase('symsync'):
+                    self.SymSync()
+        if self.pool:           # all results are in, so this is quick
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.cache:
+            pruned = self.cache.Prune()
+            self.cache.Close()
+            self.Verbose("Cache: %d hits, %d misses, %d deleted files dropped"
+                         % (self.counters.get('cache_hit', 0),
+                            self.counters.get('cache_miss', 0), pruned))
+        if self.index:
+            if self.options.build_index:
+                pruned = self.index.Prune()
+                self.Verbose("Index: %d files stored, %d deleted files dropped"
+                             % (self.counters.get('index_store', 0), pruned))
+            else:
+                self.Verbose("Index: %d files found"
+                             % self.counters.get('index_hit', 0))
+            self.index.Close()
+        if self.journal:
+            self.journal.Checkpoint()
+            self.journal.Close(ended=True)
+            self.Verbose("Journal: %d files skipped as done, %d recorded"
+                         % (self.counters.get('journal_skip', 0),
+                            self.journal.written))
+        if self.options.thumbnails:
+            self.Verbose("Thumbnails: %d written, %d up to date, %d without a preview"
+                         % (self.counters.get('thumb_written', 0),
+                            self.counters.get('thumb_current', 0),
+                            self.counters.get('thumb_none', 0)))
+        if self.options.fast_read:
+            self.Verbose("Fast read: %d files, %d fell back to pyexiv2"
+                         % (self.counters.get('fast_read', 0),
+                            self.counters.get('fast_fallback', 0)))
+        if self.file_count > 0:
+            self.Verbose("Key maps: built for %d key layouts, reused %d times"
+                         % (self.counters.get('keymap_miss', 0),
+                            self.counters.get('keymap_hit', 0)))
+        if self.greps or self.selects:
+            self.Verbose("Tag globs: expanded for %d key layouts, reused %d times"
+                         % (self.counters.get('glob_miss', 0),
+                            self.counters.get('glob_hit', 0)))
+        if self.positions is not None and self.file_count > 0:
+            self.ClusterReport()
+        if self.file_count > 0:
+            for agg in self.aggregates:
+                for line in agg.Report(self.file_count):
+                    print line
         if self.file_count > 0 and self.end_code:
+            if not self.started: # resumed, but nothing was left to do
+                self.DoStart()
             self.global_vars[self.FILECOUNT] = self.file_count
             self.global_vars[self.MATCHCOUNT] = self.match_count
             for cc in self.end_code:
                 self._Eval(cc, dict())
+        if self.progress:
+            self.progress.Done(self.file_count, self.match_count)
+        if self.options.stats:
+            for line in self.stats.Report(self.file_count, self.match_count):
+                self.Error(line)
+        if self.options.stats_json:
+            try:
+                self.stats.WriteJson(self.options.stats_json,
+                                     self.file_count, self.match_count)
+            except IOError as inst:
+                self.Error("Unable to write %s: %s"
+                           % (self.options.stats_json, inst))
         return self.match_count > 0
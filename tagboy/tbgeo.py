@@ -0,0 +1,242 @@
+# ******************************************************************************
+#
+# Copyright (C) 2018 Dan Christian <DanChristian65@gmail.com>
+#
+# This file is part of tagboy distribution.
+#
+# tagboy is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# tagboy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tagboy; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, 5th Floor, Boston, MA 02110-1301 USA.
+#
+# Author: Dan Christian <DanChristian65@gmail.com>
+
+# Spatial index for lat/lon positions
+
+from __future__ import absolute_import
+from __future__ import division
+
+import math
+try:
+    import numpy as np
+except ImportError:
+    np = None                   # fall back to tbutil.distance
+
+from tbutil import distance
+
+KM_PER_DEG = 111.195            # km per degree of latitude (12742 * pi / 360)
+
+
+def distances(latlon, lats, lons):
+    """Vectorized tbutil.distance() from latlon to numpy arrays of positions."""
+    lat1, lon1 = latlon
+    p = 0.017453292519943295     #Pi/180
+    a = (0.5 - np.cos((lats - lat1) * p)/2
+         + math.cos(lat1 * p) * np.cos(lats * p) * (1 - np.cos((lons - lon1) * p)) / 2)
+    return 12742 * np.arcsin(np.sqrt(a))
+
+
+class PointIndex(object):
+    """Grid of (lat, lon) points for finding the nearest one within a radius.
+
+    Points are bucketed into cells about radius_km (or cell_km) on a
+    side.  A query only looks at the cells overlapping a bounding box
+    around the position, then checks exact distances for those
+    candidates.
+    """
+    MIN_CELL = 1e-4             # degrees.  Keeps the grid size sane
+    NUMPY_MIN = 16              # candidates needed before numpy is worth it
+
+    def __init__(self, points, radius_km, cell_km=None):
+        self.points = list(points)
+        self.radius = float(radius_km)
+        if cell_km is None:
+            cell_km = self.radius
+        self.cell = max(cell_km / KM_PER_DEG, self.MIN_CELL)
+        self.ncols = int(math.ceil(360.0 / self.cell))
+        self.grid = dict()      # row -> {col -> [point index...]}
+        for ii, (lat, lon) in enumerate(self.points):
+            row, col = self._Cell(lat, lon)
+            self.grid.setdefault(row, dict()).setdefault(col, []).append(ii)
+        if np is not None:
+            self.lats = np.array([pp[0] for pp in self.points], dtype=float)
+            self.lons = np.array([pp[1] for pp in self.points], dtype=float)
+
+    def __len__(self):
+        return len(self.points)
+
+    def _Cell(self, lat, lon):
+        """Return the (row, col) of the cell holding a position."""
+        return (int(math.floor(lat / self.cell)),
+                int(math.floor((lon + 180.0) / self.cell)) % self.ncols)
+
+    def Cells(self):
+        """Generate (row, col, [point index...]) for every cell in use."""
+        for row in sorted(self.grid):
+            cols = self.grid[row]
+            for col in sorted(cols):
+                yield row, col, cols[col]
+
+    def CellsNear(self, row, col):
+        """Generate (row, col, [point index...]) for cells near a cell.
+
+        Includes every cell that could hold a point within the radius
+        of a point in (row, col), and the cell itself.
+        """
+        lat = row * self.cell
+        lon = col * self.cell - 180.0
+        return self._CellsNear(lat, lat + self.cell, lon, lon + self.cell)
+
+    def _CellsNear(self, lat_lo, lat_hi, lon_lo, lon_hi):
+        """Generate the cells near the bounding box of some positions."""
+        dlat = self.radius / KM_PER_DEG
+        # where longitude degrees are shortest
+        widest = min(max(abs(lat_lo), abs(lat_hi)) + dlat, 90.0)
+        coslat = math.cos(math.radians(widest))
+        dlon = 360.0 if coslat < 1e-9 else dlat / coslat
+        row_lo = int(math.floor((lat_lo - dlat) / self.cell))
+        row_hi = int(math.floor((lat_hi + dlat) / self.cell))
+        col_lo = int(math.floor((lon_lo + 180.0 - dlon) / self.cell)) - 1
+        col_hi = int(math.floor((lon_hi + 180.0 + dlon) / self.cell)) + 1
+        every_col = (col_hi - col_lo + 1) >= self.ncols
+
+        for row in xrange(row_lo, row_hi + 1):
+            cols = self.grid.get(row)
+            if not cols:
+                continue
+            if every_col or len(cols) <= col_hi - col_lo:
+                for col, cell_ids in cols.iteritems():
+                    if every_col or (col - col_lo) % self.ncols <= col_hi - col_lo:
+                        yield row, col, cell_ids
+            else:
+                for col in xrange(col_lo, col_hi + 1):
+                    cell_ids = cols.get(col % self.ncols)
+                    if cell_ids:
+                        yield row, col % self.ncols, cell_ids
+
+    def Candidates(self, pos):
+        """Return the sorted indexes of points near the bounding box of pos."""
+        lat, lon = pos
+        ids = []
+        for row, col, cell_ids in self._CellsNear(lat, lat, lon, lon):
+            ids.extend(cell_ids)
+        ids.sort()
+        return ids
+
+    def Nearest(self, pos):
+        """Return (distance_km, index) of the closest point within the radius.
+
+        Ties go to the point listed first.  Returns None if nothing is
+        within the radius.
+        """
+        ids = self.Candidates(pos)
+        if not ids:
+            return None
+        if np is not None and len(ids) >= self.NUMPY_MIN:
+            idx = np.array(ids)
+            dists = distances(pos, self.lats[idx], self.lons[idx])
+            dists[dists > self.radius] = np.inf
+            pick = int(np.argmin(dists)) # first of any ties
+            if np.isinf(dists[pick]):
+                return None
+            return (float(dists[pick]), ids[pick])
+        best = None
+        for ii in ids:
+            dist = distance(pos, self.points[ii])
+            if dist <= self.radius and (best is None or dist < best[0]):
+                best = (dist, ii)
+        return best
+
+
+def centroid(points):
+    """Return the mean (lat, lon) of points (averaged on the sphere)."""
+    x = y = z = 0.0
+    for lat, lon in points:
+        lat, lon = math.radians(lat), math.radians(lon)
+        x += math.cos(lat) * math.cos(lon)
+        y += math.cos(lat) * math.sin(lon)
+        z += math.sin(lat)
+    return (math.degrees(math.atan2(z, math.hypot(x, y))),
+            math.degrees(math.atan2(y, x)))
+
+
+def clusters(points, radius_km):
+    """Group (lat, lon) points that are within radius_km of each other.
+
+    Points join a cluster if they are within the radius of any member
+    (single linkage).  Returns lists of point indexes, in order, with
+    clusters ordered by their first point.
+
+    Points are bucketed into cells radius_km / 2 on a side, so all the
+    points in a cell are close and join without being compared.  A
+    pair of nearby cells is only checked until one close pair is
+    found.  The worst case is still every point of one crowded cell
+    against every point of another, when the two are just too far
+    apart to join (or the radius is too small for the grid).
+    """
+    index = PointIndex(points, radius_km, cell_km=radius_km / 2.0)
+    # Two points in a cell are at most a cell of latitude plus a cell
+    # of longitude apart, which is no more than the radius.
+    whole_cells = index.cell * KM_PER_DEG * 2 <= index.radius
+    parent = range(len(index))
+
+    def find(ii):
+        root = ii
+        while parent[root] != root:
+            root = parent[root]
+        while parent[ii] != root:   # compress the path
+            parent[ii], ii = root, parent[ii]
+        return root
+
+    def join(ii, jj):
+        root_ii, root_jj = find(ii), find(jj)
+        if root_ii != root_jj:
+            parent[max(root_ii, root_jj)] = min(root_ii, root_jj)
+
+    def link(ii, ids):
+        """Join ii with any of ids within the radius.  Returns True if any."""
+        root = find(ii)
+        ids = [jj for jj in ids if find(jj) != root]
+        if not ids:
+            return False
+        pos = index.points[ii]
+        if np is not None and len(ids) >= index.NUMPY_MIN:
+            idx = np.array(ids)
+            dists = distances(pos, index.lats[idx], index.lons[idx])
+            near = idx[dists <= index.radius].tolist()
+        else:
+            near = [jj for jj in ids
+                    if distance(pos, index.points[jj]) <= index.radius]
+        for jj in near:
+            join(ii, jj)
+        return bool(near)
+
+    for row, col, ids in index.Cells():
+        if whole_cells:
+            for jj in ids[1:]:
+                join(ids[0], jj)
+        else:
+            for kk, ii in enumerate(ids):
+                link(ii, ids[kk + 1:])
+        for other_row, other_col, other_ids in index.CellsNear(row, col):
+            if (other_row, other_col) <= (row, col):
+                continue        # each pair of cells is checked once
+            if whole_cells and find(ids[0]) == find(other_ids[0]):
+                continue        # already one cluster
+            for ii in ids:
+                if link(ii, other_ids) and whole_cells:
+                    break       # both cells are now one cluster
+
+    groups = dict()             # root -> [point index...]
+    for ii in xrange(len(index)):
+        groups.setdefault(find(ii), []).append(ii)
+    return [groups[root] for root in sorted(groups)]
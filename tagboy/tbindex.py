@@ -0,0 +1,231 @@
+# ******************************************************************************
+#
+# Copyright (C) 2018 Dan Christian <DanChristian65@gmail.com>
+#
+# This file is part of tagboy distribution.
+#
+# tagboy is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# tagboy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tagboy; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, 5th Floor, Boston, MA 02110-1301 USA.
+#
+# Author: Dan Christian <DanChristian65@gmail.com>
+
+# Searchable tag index (sqlite3) for --build-index and --use-index
+
+from __future__ import absolute_import
+from __future__ import division
+
+import cPickle
+import fnmatch
+import math
+import os
+import random
+import sqlite3
+import sre_constants
+import sre_parse
+
+from tbgeo import KM_PER_DEG
+from tbmeta import MetadataSnapshot
+
+
+def _Text(value):
+    """Return value as unicode for sqlite.  Non utf-8 bytes map 1:1."""
+    if isinstance(value, unicode):
+        return value
+    value = str(value)
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value.decode('latin-1')
+
+
+def RequiredLiteral(pattern):
+    """Return the longest ASCII string that every match of pattern holds.
+
+    Only literals at the top level of the regex are used (anything
+    optional, repeated, or in a group ends a run).  Returns '' if
+    there are none.
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (sre_constants.error, TypeError):
+        return ''
+    best = run = ''
+    for op, arg in parsed:
+        if op == sre_constants.LITERAL and arg < 128:
+            run += chr(arg)
+            continue
+        if len(run) > len(best):
+            best = run
+        run = ''
+    if len(run) > len(best):
+        best = run
+    return best
+
+
+class TagIndex(object):
+    """sqlite index of every file's tags for fast queries.
+
+    Each file has a row in files (with its position, if known, and a
+    MetadataSnapshot) and a row per tag value in tags.  If sqlite has
+    the fts5 trigram tokenizer, the values are also in a full text
+    table so --grep can skip values that can't match.  Like TagCache,
+    each process opens its own connection and commits every file as
+    it is stored.
+    """
+    TIMEOUT = 60                # seconds to wait for another writer
+    MIN_LITERAL = 3             # trigram searches need 3 characters
+
+    def __init__(self, path):
+        self.path = path
+        self.run_id = random.getrandbits(62) # marks entries seen this run
+        self.fts = False          # values are in the tag_text fts table
+        self._db = None
+        self._pid = None
+
+    def _Connect(self):
+        """Return a connection for this process (connections can't be forked)."""
+        if self._db is not None and self._pid == os.getpid():
+            return self._db
+        self._db = sqlite3.connect(self.path, timeout=self.TIMEOUT)
+        self._db.text_factory = str
+        self._pid = os.getpid()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL") # WAL commits don't sync
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " id INTEGER PRIMARY KEY, path TEXT UNIQUE, abspath TEXT,"
+            " lat REAL, lon REAL, seen INTEGER, snapshot BLOB)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tags ("
+            " file_id INTEGER, name TEXT, short TEXT, value TEXT)")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS tags_file ON tags (file_id)")
+        try:
+            self._db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS tag_text"
+                " USING fts5(value, tokenize='trigram')")
+            self.fts = True
+        except sqlite3.OperationalError: # old sqlite: no fts5 or trigram
+            self.fts = False
+        self._db.commit()
+        return self._db
+
+    def _DeleteFile(self, db, file_id):
+        if self.fts:
+            db.execute("DELETE FROM tag_text WHERE rowid IN"
+                       " (SELECT rowid FROM tags WHERE file_id = ?)",
+                       (file_id,))
+        db.execute("DELETE FROM tags WHERE file_id = ?", (file_id,))
+        db.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+    def Store(self, fname, snap, latlon, rows):
+        """Add or replace fname.  rows is [(long name, short name, value)...]."""
+        lat, lon = latlon if latlon else (None, None)
+        blob = cPickle.dumps(snap.GetState(), cPickle.HIGHEST_PROTOCOL)
+        db = self._Connect()
+        with db:                # one transaction, rolled back on errors
+            row = db.execute("SELECT id FROM files WHERE path = ?",
+                             (fname,)).fetchone()
+            if row:
+                self._DeleteFile(db, row[0])
+            file_id = db.execute(
+                "INSERT INTO files (path, abspath, lat, lon, seen, snapshot)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (fname, os.path.abspath(fname), lat, lon, self.run_id,
+                 sqlite3.Binary(blob))).lastrowid
+            db.executemany(
+                "INSERT INTO tags VALUES (?, ?, ?, ?)",
+                [(file_id, name, short, _Text(value))
+                 for name, short, value in rows])
+            if self.fts:
+                db.execute("INSERT INTO tag_text (rowid, value)"
+                           " SELECT rowid, value FROM tags WHERE file_id = ?",
+                           (file_id,))
+
+    def Prune(self):
+        """Drop entries for deleted files.  Returns the number dropped."""
+        db = self._Connect()
+        gone = [file_id for (file_id, pp) in db.execute(
+            "SELECT id, path FROM files WHERE seen != ?", (self.run_id,)
+            ).fetchall() if not os.path.exists(pp)]
+        for file_id in gone:
+            self._DeleteFile(db, file_id)
+        db.commit()
+        return len(gone)
+
+    def Query(self, top, name_match=None, greps=(), near=(), near_km=0.0):
+        """Generate (path, MetadataSnapshot) for files under top that may match.
+
+        The tests are the same as --iname/--name (name_match), --grep
+        [(regex, tag glob)...], and --near (points within near_km), but
+        only narrow the choice.  The caller still applies them.
+        """
+        db = self._Connect()
+        top = os.path.abspath(top)
+        where = ["(abspath = ? OR substr(abspath, 1, ?) = ?)"]
+        params = [top, len(top) + 1, os.path.join(top, '')]
+
+        if name_match is not None and not name_match.match_all:
+            db.create_function(
+                'tb_name', 1, lambda pp: bool(name_match(os.path.basename(pp))))
+            where.append("tb_name(path)")
+
+        db.create_function(
+            'tb_glob', 2, lambda name, glob: fnmatch.fnmatchcase(name, glob))
+        db.create_function(
+            'tb_grep', 2,
+            lambda ii, value: greps[ii][0].search(value) is not None)
+        for ii, (regex, tag_glob) in enumerate(greps):
+            test = ("(tb_glob(name, ?) OR tb_glob(short, ?))"
+                    " AND tb_grep(?, value)")
+            args = [tag_glob, tag_glob, ii]
+            literal = RequiredLiteral(regex.pattern) if self.fts else ''
+            if len(literal) >= self.MIN_LITERAL:
+                test += (" AND rowid IN"
+                         " (SELECT rowid FROM tag_text WHERE tag_text MATCH ?)")
+                args.append('"%s"' % literal.replace('"', '""'))
+            where.append("id IN (SELECT file_id FROM tags WHERE %s)" % test)
+            params.extend(args)
+
+        if near:
+            boxes = []
+            for lat, lon in near:
+                dlat = near_km / KM_PER_DEG
+                box = "(lat BETWEEN ? AND ?"
+                params.extend([lat - dlat, lat + dlat])
+                coslat = math.cos(math.radians(min(abs(lat) + dlat, 90.0)))
+                if coslat > 0:
+                    dlon = dlat / coslat
+                    if dlon < 180 and -180 <= lon - dlon and lon + dlon <= 180:
+                        box += " AND lon BETWEEN ? AND ?" # else any lon
+                        params.extend([lon - dlon, lon + dlon])
+                boxes.append(box + ")")
+            where.append("(%s)" % " OR ".join(boxes))
+
+        for path, blob in db.execute(
+                "SELECT path, snapshot FROM files WHERE %s ORDER BY id"
+                % " AND ".join(where), params):
+            yield path, MetadataSnapshot.FromState(cPickle.loads(str(blob)))
+
+    def Commit(self):
+        """Write out any pending changes."""
+        if self._db is not None and self._pid == os.getpid():
+            self._db.commit()
+
+    def Close(self):
+        """Commit and close this process's connection."""
+        self.Commit()
+        if self._db is not None and self._pid == os.getpid():
+            self._db.close()
+        self._db = None
@@ -0,0 +1,157 @@
+# ******************************************************************************
+#
+# Copyright (C) 2018 Dan Christian <DanChristian65@gmail.com>
+#
+# This file is part of tagboy distribution.
+#
+# tagboy is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# tagboy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tagboy; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, 5th Floor, Boston, MA 02110-1301 USA.
+#
+# Author: Dan Christian <DanChristian65@gmail.com>
+
+# Processed file journal (--journal) for resuming interrupted runs
+
+from __future__ import absolute_import
+
+import cPickle as pickle
+import os
+import time
+
+
+class Journal(object):
+    """Append only record of the files a run has finished.
+
+    Paths are buffered and written in batches, each ending with a
+    numbered checkpoint line and an fsync.  The state at a checkpoint
+    (e.g. --begin/--eval globals) is pickled to a side file, path.state,
+    replaced (by rename) each time, so the journal only grows with the
+    paths.  When read back, only paths covered by a checkpoint count,
+    so a batch cut off by a crash is simply done again.  A run that
+    finishes writes an end line, and the next run starts a new journal.
+
+    Lines are: F<tab>path, C<tab>checkpoint number, E
+    """
+    BATCH_FILES = 1000          # paths per checkpoint
+    BATCH_SECONDS = 30.0        # or this often, if files are slow
+
+    def __init__(self, path):
+        self.path = path
+        self.state_path = path + '.state'
+        self.done = set()       # paths finished by earlier runs
+        self.state = None       # state from the last checkpoint
+        self.buffer = list()    # paths finished since the last checkpoint
+        self.last = time.time()
+        self.number = 0         # of the last checkpoint
+        self.written = 0        # paths checkpointed by this run
+        self.ended = self._Load()
+        self.fp = open(path, 'w' if self.ended else 'a')
+        if self.ended:          # the last run finished.  Start over
+            self.done = set()
+            self.state = None
+            self.number = 0
+            self._RemoveState()
+
+    def _Load(self):
+        """Read an existing journal.  Returns True if it has an end line."""
+        try:
+            fp = open(self.path)
+        except IOError:
+            return False
+        pending = list()
+        ended = False
+        with fp:
+            for line in fp:
+                if not line.endswith('\n'): # cut off by a crash
+                    break
+                kind, _, value = line[:-1].partition('\t')
+                if kind == 'F':
+                    pending.append(value.decode('string_escape'))
+                elif kind == 'C':
+                    self.done.update(pending)
+                    pending = list()
+                    self.number = int(value)
+                elif kind == 'E':
+                    ended = True
+        number, self.state = self._LoadState()
+        if number == self.number + 1: # saved just before its checkpoint line
+            self.done.update(pending)
+            self.number = number
+        elif number > self.number: # not from this journal
+            self.state = None
+        return ended
+
+    def _LoadState(self):
+        """Return (checkpoint number, state) from the state file."""
+        try:
+            with open(self.state_path, 'rb') as fp:
+                return pickle.load(fp)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return 0, None
+
+    def _SaveState(self, state):
+        """Replace the state file (write, sync, rename)."""
+        temp = self.state_path + '.tmp'
+        with open(temp, 'wb') as fp:
+            pickle.dump((self.number, state), fp, pickle.HIGHEST_PROTOCOL)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(temp, self.state_path)
+
+    def _RemoveState(self):
+        try:
+            os.remove(self.state_path)
+        except OSError:
+            pass
+
+    def __contains__(self, path):
+        return path in self.done
+
+    def Add(self, path):
+        """Record that path is finished (written at the next checkpoint)."""
+        self.buffer.append(path)
+
+    def Due(self):
+        """Check if it's time for a checkpoint."""
+        return self.buffer and (
+            len(self.buffer) >= self.BATCH_FILES
+            or time.time() - self.last >= self.BATCH_SECONDS)
+
+    def Checkpoint(self, state=None):
+        """Write the buffered paths and state, and sync them to disk.
+
+        The paths are synced before the state is saved, so a crash
+        between the two still leaves a state that matches the journal.
+        """
+        self.fp.write(''.join('F\t%s\n' % pp.encode('string_escape')
+                              for pp in self.buffer))
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.number += 1
+        if state is not None:
+            self._SaveState(state)
+        self.fp.write('C\t%d\n' % self.number)
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.written += len(self.buffer)
+        self.buffer = list()
+        self.last = time.time()
+
+    def Close(self, ended=False):
+        """Close the journal.  ended marks the run as finished."""
+        if ended:
+            self.fp.write('E\n')
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+            self._RemoveState()
+        self.fp.close()
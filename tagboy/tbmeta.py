@@ -0,0 +1,291 @@
+# ******************************************************************************
+#
+# Copyright (C) 2018 Dan Christian <DanChristian65@gmail.com>
+#
+# This file is part of tagboy distribution.
+#
+# tagboy is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# tagboy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tagboy; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, 5th Floor, Boston, MA 02110-1301 USA.
+#
+# Author: Dan Christian <DanChristian65@gmail.com>
+
+# Picklable stand-ins for pyexiv2 metadata
+
+from __future__ import absolute_import
+
+import weakref
+
+from tbutil import NameMatcher
+
+
+class TagDemand(object):
+    """The tags a run uses, as names and globs (long or short names).
+
+    Tags that aren't wanted are left out of the name mapping and their
+    values are never decoded.  A short name that is used wants every
+    tag with that name, so it still maps to the same long name.
+    """
+
+    def __init__(self, names=(), globs=()):
+        self.names = frozenset(names)
+        self.globs = list(globs)
+        self.matcher = NameMatcher(self.globs) if self.globs else None
+        self.wanted = dict()    # key -> bool
+
+    def Wants(self, key):
+        """Check if the tag key is needed."""
+        try:
+            return self.wanted[key]
+        except KeyError:
+            pass
+        short = key.split('.')[-1]
+        want = (key in self.names or short in self.names
+                or (self.matcher is not None
+                    and (self.matcher(key) or self.matcher(short))))
+        self.wanted[key] = want
+        return want
+
+    def __repr__(self):
+        return "<TagDemand %s %s>" % (sorted(self.names), self.globs)
+
+
+def _Intern(name):
+    """Return the shared copy of a tag name or label string."""
+    if type(name) is str:
+        return intern(name)
+    return name
+
+
+class SnapshotTag(object):
+    """The subset of a pyexiv2 tag that tagboy (and --eval code) uses."""
+    __slots__ = ('key', 'human_value', 'raw_value', 'value', 'repeatable',
+                 'label', 'title')
+
+    def __init__(self, key, human_value, raw_value, value=None,
+                 repeatable=False, label=None, title=None):
+        self.key = key
+        self.human_value = human_value
+        self.raw_value = raw_value
+        self.value = value
+        self.repeatable = repeatable
+        self.label = label
+        self.title = title
+
+    def __repr__(self):
+        return "<SnapshotTag %s = %r>" % (self.key, self.raw_value)
+
+
+class TagSchema(object):
+    """The tag keys of one key layout, shared by all files that have it.
+
+    Files from the same camera (and firmware) have the same keys, so
+    the (interned) names are stored once here and a snapshot only holds
+    its values, in key order.  Get() hands out one schema per layout for
+    as long as something uses it.
+    """
+    __slots__ = ('exif_keys', 'iptc_keys', 'xmp_keys', 'keys', 'index',
+                 '__weakref__')
+    _shared = weakref.WeakValueDictionary() # layout -> TagSchema
+
+    def __init__(self, exif_keys, iptc_keys, xmp_keys):
+        self.exif_keys = tuple(_Intern(kk) for kk in exif_keys)
+        self.iptc_keys = tuple(_Intern(kk) for kk in iptc_keys)
+        self.xmp_keys = tuple(_Intern(kk) for kk in xmp_keys)
+        self.keys = self.exif_keys + self.iptc_keys + self.xmp_keys
+        self.index = dict()     # key -> position in keys (first one wins)
+        for ii, kk in enumerate(self.keys):
+            self.index.setdefault(kk, ii)
+
+    @classmethod
+    def Get(cls, exif_keys=(), iptc_keys=(), xmp_keys=()):
+        """Return the shared schema for a key layout."""
+        layout = (tuple(exif_keys), tuple(iptc_keys), tuple(xmp_keys))
+        schema = cls._shared.get(layout)
+        if schema is None:
+            schema = cls(*layout)
+            cls._shared[schema.Layout()] = schema
+        return schema
+
+    def Layout(self):
+        """Return the hashable (exif_keys, iptc_keys, xmp_keys)."""
+        return (self.exif_keys, self.iptc_keys, self.xmp_keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __reduce__(self):       # unpickles to the shared copy
+        return (_SharedSchema, self.Layout())
+
+    def __repr__(self):
+        return "<TagSchema %d/%d/%d keys>" % (
+            len(self.exif_keys), len(self.iptc_keys), len(self.xmp_keys))
+
+
+def _SharedSchema(exif_keys, iptc_keys, xmp_keys):
+    """Unpickle a TagSchema (a classmethod can't be pickled)."""
+    return TagSchema.Get(exif_keys, iptc_keys, xmp_keys)
+
+
+class TagRecord(object):
+    """A file that passed --grep/--select/--near, on its way to output.
+
+    See TagBoy.ScanMetadata().  early is set once a --jobs worker has
+    done the outputs that don't need file order.  file_count is set
+    once the file is counted, since its output may wait for a batch.
+    """
+    __slots__ = ('path', 'meta', 'revmap', 'selected', 'tags', 'early',
+                 'file_count')
+
+    def __init__(self, path, meta, revmap, selected, tags):
+        self.path = path
+        self.meta = meta          # pyexiv2 metadata or MetadataSnapshot
+        self.revmap = revmap      # name -> long name
+        self.selected = selected  # --select name -> long name, or None
+        self.tags = tags          # name -> value
+        self.early = False
+        self.file_count = None    # _filecount for the outputs
+
+    def __getstate__(self):
+        return (self.path, self.meta, self.revmap, self.selected, self.tags,
+                self.early, self.file_count)
+
+    def __setstate__(self, state):
+        (self.path, self.meta, self.revmap, self.selected, self.tags,
+         self.early, self.file_count) = state
+
+
+class MetadataSnapshot(object):
+    """Read only copy of pyexiv2.ImageMetadata that can be pickled.
+
+    The keys live in a shared TagSchema.  Each tag value is a plain
+    tuple, in schema order (None if it wasn't copied), and is turned
+    back into a SnapshotTag object on access.  This keeps snapshots
+    small, and the pickle independent of the pickle protocol.
+    """
+    __slots__ = ('schema', 'values')
+
+    def __init__(self, exif_keys=(), iptc_keys=(), xmp_keys=(), tags=None):
+        self.schema = TagSchema.Get(exif_keys, iptc_keys, xmp_keys)
+        if tags:
+            self.values = tuple(self._Value(tags.get(kk))
+                                for kk in self.schema.keys)
+        else:
+            self.values = (None, ) * len(self.schema)
+
+    @staticmethod
+    def _Value(value):
+        """Share the label string of a tag value tuple."""
+        if value is None:
+            return None
+        human, raw, values, repeatable, label = value
+        return (human, raw, values, repeatable, _Intern(label))
+
+    @property
+    def exif_keys(self):
+        return self.schema.exif_keys
+
+    @property
+    def iptc_keys(self):
+        return self.schema.iptc_keys
+
+    @property
+    def xmp_keys(self):
+        return self.schema.xmp_keys
+
+    @property
+    def tags(self):
+        """The copied tags as {key -> tuple}."""
+        return dict((kk, vv) for kk, vv in zip(self.schema.keys, self.values)
+                    if vv is not None)
+
+    @classmethod
+    def FromMetadata(cls, meta, demand=None):
+        """Copy everything tagboy uses out of a live pyexiv2 object.
+
+        With a TagDemand, only the wanted tag values are copied.
+        """
+        exif_keys = meta.exif_keys
+        iptc_keys = meta.iptc_keys
+        xmp_keys = meta.xmp_keys
+        tags = dict()
+        for kk in exif_keys:
+            if demand is None or demand.Wants(kk):
+                cls._CopyTag(tags, meta, kk, True)
+        for kk in iptc_keys + xmp_keys:
+            if demand is None or demand.Wants(kk):
+                cls._CopyTag(tags, meta, kk, False)
+        return cls(exif_keys, iptc_keys, xmp_keys, tags)
+
+    @classmethod
+    def FromState(cls, state):
+        """Rebuild a snapshot from the output of GetState()."""
+        exif_keys, iptc_keys, xmp_keys, tags = state
+        return cls(exif_keys, iptc_keys, xmp_keys, tags)
+
+    def GetState(self):
+        """Return the snapshot as built-in types (e.g. for storage)."""
+        return (list(self.exif_keys), list(self.iptc_keys),
+                list(self.xmp_keys), self.tags)
+
+    @staticmethod
+    def _CopyTag(tags, meta, key, is_exif):
+        """Copy one tag.  Values that can't be converted are skipped."""
+        try:
+            tag = meta[key]
+            raw = tag.raw_value
+            if is_exif:
+                human = tag.human_value
+                label = tag.label
+                values = None
+                repeatable = False
+            else:
+                human = raw
+                label = tag.title
+                repeatable = bool(getattr(tag, 'repeatable', False))
+                values = None
+                if repeatable:
+                    values = [str(vv) for vv in tag.value]
+        except Exception:
+            return
+        tags[key] = (human, raw, values, repeatable, label)
+
+    def __getstate__(self):
+        return (self.schema, self.values)
+
+    def __setstate__(self, state):
+        self.schema, self.values = state
+
+    def __len__(self):
+        return len(self.schema)
+
+    def _Find(self, key):
+        """Return the value tuple of key, or None."""
+        ii = self.schema.index.get(key)
+        if ii is None:
+            return None
+        return self.values[ii]
+
+    def __contains__(self, key):
+        return self._Find(key) is not None
+
+    def __getitem__(self, key):
+        value = self._Find(key)
+        if value is None:
+            raise KeyError(key)
+        human, raw, values, repeatable, label = value
+        return SnapshotTag(key, human, raw, values, repeatable, label, label)
+
+    def read(self):
+        """Snapshots are always read.  Provided for pyexiv2 compatibility."""
+        pass
@@ -0,0 +1,158 @@
+# ******************************************************************************
+#
+# Copyright (C) 2018 Dan Christian <DanChristian65@gmail.com>
+#
+# This file is part of tagboy distribution.
+#
+# tagboy is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# tagboy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tagboy; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, 5th Floor, Boston, MA 02110-1301 USA.
+#
+# Author: Dan Christian <DanChristian65@gmail.com>
+
+# Machine readable output formats (--format)
+
+from __future__ import absolute_import
+
+import collections
+import cStringIO
+import csv
+import json
+import sys
+import time
+
+
+def _Utf8(value):
+    """Return value as a utf-8 byte string."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _Text(value):
+    """Return value as unicode (for json).  Bad utf-8 is replaced."""
+    if isinstance(value, unicode):
+        return value
+    return str(value).decode('utf-8', 'replace')
+
+
+def _Json(value):
+    """Return value for json: lists and dicts (e.g. XMP bags) kept as such."""
+    if isinstance(value, (list, tuple)):
+        return [_Json(vv) for vv in value]
+    if isinstance(value, dict):
+        return collections.OrderedDict(
+            (_Text(kk), _Json(vv)) for kk, vv in sorted(value.iteritems()))
+    return _Text(value)
+
+
+class RecordSink(object):
+    """Write one record per matched file, buffered into large writes.
+
+    Write() takes the file path and a list of (tag name, value).
+    Subclasses define Format(path, items), which returns one record as
+    a byte string.  seconds is the time spent formatting and writing.
+    """
+    BUFFER_BYTES = 1 << 20
+
+    def __init__(self, out=None):
+        self.out = out          # file to write, None means sys.stdout
+        self.buf = list()       # formatted records not yet written
+        self.size = 0           # bytes in buf
+        self.records = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def Write(self, path, items):
+        start = time.time()
+        data = self.Format(path, items)
+        self.buf.append(data)
+        self.size += len(data)
+        self.records += 1
+        if self.size >= self.BUFFER_BYTES:
+            self.Flush()
+        self.seconds += time.time() - start
+
+    def Flush(self):
+        if not self.buf:
+            return
+        start = time.time()
+        out = self.out or sys.stdout
+        out.write(''.join(self.buf))
+        out.flush()
+        self.bytes += self.size
+        self.buf = list()
+        self.size = 0
+        self.seconds += time.time() - start
+
+    def Close(self):
+        self.Flush()
+
+
+class JsonLinesSink(RecordSink):
+    """One JSON object per line: {"path": ..., tag: value, ...}"""
+
+    def Format(self, path, items):
+        rec = collections.OrderedDict()
+        rec['path'] = _Text(path)
+        for kk, vv in items:
+            rec[kk] = _Json(vv)
+        return json.dumps(rec) + '\n'
+
+
+class CsvSink(RecordSink):
+    """Comma (or tab) separated values with a header row of columns."""
+
+    def __init__(self, columns, delimiter=',', out=None):
+        RecordSink.__init__(self, out)
+        self.columns = columns
+        self.text = cStringIO.StringIO()
+        self.writer = csv.writer(self.text, delimiter=delimiter,
+                                 lineterminator='\n')
+        self.header = True      # header not written yet
+
+    def _Row(self, values):
+        self.writer.writerow([_Utf8(vv) for vv in values])
+
+    def Format(self, path, items):
+        if self.header:
+            self._Row(['path'] + list(self.columns))
+            self.header = False
+        self._Row([path] + [vv for kk, vv in items])
+        data = self.text.getvalue()
+        self.text.seek(0)
+        self.text.truncate()
+        return data
+
+
+class Print0Sink(RecordSink):
+    """NUL terminated paths (for xargs -0)."""
+
+    def Format(self, path, items):
+        return _Utf8(path) + '\0'
+
+
+FORMATS = ('jsonl', 'csv', 'tsv', 'print0')
+
+
+def MakeSink(fmt, columns=(), out=None):
+    """Return the RecordSink for a --format name."""
+    if fmt == 'jsonl':
+        return JsonLinesSink(out)
+    if fmt == 'csv':
+        return CsvSink(columns, ',', out)
+    if fmt == 'tsv':
+        return CsvSink(columns, '\t', out)
+    if fmt == 'print0':
+        return Print0Sink(out)
+    raise ValueError("Unknown format: %s" % fmt)
@@ -0,0 +1,594 @@
+# ******************************************************************************
+#
+# Copyright (C) 2018 Dan Christian <DanChristian65@gmail.com>
+#
+# This file is part of tagboy distribution.
+#
+# tagboy is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# tagboy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tagboy; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, 5th Floor, Boston, MA 02110-1301 USA.
+#
+# Author: Dan Christian <DanChristian65@gmail.com>
+
+# Header only EXIF/IPTC/XMP reader for JPEG and TIFF (--fast-read)
+
+# Only the metadata segments are touched (the file is memory mapped),
+# so big images cost about the same as small ones.  Tag names follow
+# exiv2 (e.g. Exif.Photo.DateTimeOriginal, Iptc.Application2.Keywords,
+# Xmp.dc.subject).  Raw values are formatted like exiv2, but only a few
+# human readable forms are done (GPS positions, exposure).  Maker notes
+# and XMP structures are skipped.  Anything else returns None and the
+# caller should fall back to pyexiv2.
+
+from __future__ import absolute_import
+from __future__ import division
+
+import mmap
+import re
+import struct
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+from tbmeta import MetadataSnapshot
+
+# exiv2 tag names by IFD group.  Unknown tags are named like 0x1234
+IMAGE_TAGS = {
+    0x000b: 'ProcessingSoftware', 0x00fe: 'NewSubfileType',
+    0x00ff: 'SubfileType', 0x0100: 'ImageWidth', 0x0101: 'ImageLength',
+    0x0102: 'BitsPerSample', 0x0103: 'Compression',
+    0x0106: 'PhotometricInterpretation', 0x010d: 'DocumentName',
+    0x010e: 'ImageDescription', 0x010f: 'Make', 0x0110: 'Model',
+    0x0111: 'StripOffsets', 0x0112: 'Orientation', 0x0115: 'SamplesPerPixel',
+    0x0116: 'RowsPerStrip', 0x0117: 'StripByteCounts', 0x011a: 'XResolution',
+    0x011b: 'YResolution', 0x011c: 'PlanarConfiguration',
+    0x0128: 'ResolutionUnit', 0x012d: 'TransferFunction', 0x0131: 'Software',
+    0x0132: 'DateTime', 0x013b: 'Artist', 0x013c: 'HostComputer',
+    0x013e: 'WhitePoint', 0x013f: 'PrimaryChromaticities',
+    0x014a: 'SubIFDs', 0x0201: 'JPEGInterchangeFormat',
+    0x0202: 'JPEGInterchangeFormatLength', 0x0211: 'YCbCrCoefficients',
+    0x0212: 'YCbCrSubSampling', 0x0213: 'YCbCrPositioning',
+    0x0214: 'ReferenceBlackWhite', 0x02bc: 'XMLPacket', 0x4746: 'Rating',
+    0x4749: 'RatingPercent', 0x8298: 'Copyright', 0x83bb: 'IPTCNAA',
+    0x8649: 'ImageResources', 0x8769: 'ExifTag', 0x8773: 'InterColorProfile',
+    0x8825: 'GPSTag', 0x9c9b: 'XPTitle', 0x9c9c: 'XPComment',
+    0x9c9d: 'XPAuthor', 0x9c9e: 'XPKeywords', 0x9c9f: 'XPSubject',
+    0xc4a5: 'PrintImageMatching', 0xc612: 'DNGVersion',
+    0xc614: 'UniqueCameraModel',
+}
+
+PHOTO_TAGS = {
+    0x829a: 'ExposureTime', 0x829d: 'FNumber', 0x8822: 'ExposureProgram',
+    0x8824: 'SpectralSensitivity', 0x8827: 'ISOSpeedRatings', 0x8828: 'OECF',
+    0x8830: 'SensitivityType', 0x8831: 'StandardOutputSensitivity',
+    0x8832: 'RecommendedExposureIndex', 0x8833: 'ISOSpeed',
+    0x9000: 'ExifVersion', 0x9003: 'DateTimeOriginal',
+    0x9004: 'DateTimeDigitized', 0x9010: 'OffsetTime',
+    0x9011: 'OffsetTimeOriginal', 0x9012: 'OffsetTimeDigitized',
+    0x9101: 'ComponentsConfiguration', 0x9102: 'CompressedBitsPerPixel',
+    0x9201: 'ShutterSpeedValue', 0x9202: 'ApertureValue',
+    0x9203: 'BrightnessValue', 0x9204: 'ExposureBiasValue',
+    0x9205: 'MaxApertureValue', 0x9206: 'SubjectDistance',
+    0x9207: 'MeteringMode', 0x9208: 'LightSource', 0x9209: 'Flash',
+    0x920a: 'FocalLength', 0x9214: 'SubjectArea', 0x927c: 'MakerNote',
+    0x9286: 'UserComment', 0x9290: 'SubSecTime',
+    0x9291: 'SubSecTimeOriginal', 0x9292: 'SubSecTimeDigitized',
+    0xa000: 'FlashpixVersion', 0xa001: 'ColorSpace',
+    0xa002: 'PixelXDimension', 0xa003: 'PixelYDimension',
+    0xa004: 'RelatedSoundFile', 0xa005: 'InteroperabilityTag',
+    0xa20b: 'FlashEnergy', 0xa20e: 'FocalPlaneXResolution',
+    0xa20f: 'FocalPlaneYResolution', 0xa210: 'FocalPlaneResolutionUnit',
+    0xa214: 'SubjectLocation', 0xa215: 'ExposureIndex',
+    0xa217: 'SensingMethod', 0xa300: 'FileSource', 0xa301: 'SceneType',
+    0xa302: 'CFAPattern', 0xa401: 'CustomRendered', 0xa402: 'ExposureMode',
+    0xa403: 'WhiteBalance', 0xa404: 'DigitalZoomRatio',
+    0xa405: 'FocalLengthIn35mmFilm', 0xa406: 'SceneCaptureType',
+    0xa407: 'GainControl', 0xa408: 'Contrast', 0xa409: 'Saturation',
+    0xa40a: 'Sharpness', 0xa40b: 'DeviceSettingDescription',
+    0xa40c: 'SubjectDistanceRange', 0xa420: 'ImageUniqueID',
+    0xa430: 'CameraOwnerName', 0xa431: 'BodySerialNumber',
+    0xa432: 'LensSpecification', 0xa433: 'LensMake', 0xa434: 'LensModel',
+    0xa435: 'LensSerialNumber',
+}
+
+GPS_TAGS = {
+    0: 'GPSVersionID', 1: 'GPSLatitudeRef', 2: 'GPSLatitude',
+    3: 'GPSLongitudeRef', 4: 'GPSLongitude', 5: 'GPSAltitudeRef',
+    6: 'GPSAltitude', 7: 'GPSTimeStamp', 8: 'GPSSatellites', 9: 'GPSStatus',
+    10: 'GPSMeasureMode', 11: 'GPSDOP', 12: 'GPSSpeedRef', 13: 'GPSSpeed',
+    14: 'GPSTrackRef', 15: 'GPSTrack', 16: 'GPSImgDirectionRef',
+    17: 'GPSImgDirection', 18: 'GPSMapDatum', 19: 'GPSDestLatitudeRef',
+    20: 'GPSDestLatitude', 21: 'GPSDestLongitudeRef', 22: 'GPSDestLongitude',
+    23: 'GPSDestBearingRef', 24: 'GPSDestBearing', 25: 'GPSDestDistanceRef',
+    26: 'GPSDestDistance', 27: 'GPSProcessingMethod',
+    28: 'GPSAreaInformation', 29: 'GPSDateStamp', 30: 'GPSDifferential',
+}
+
+IOP_TAGS = {
+    0x0001: 'InteroperabilityIndex', 0x0002: 'InteroperabilityVersion',
+    0x1000: 'RelatedImageFileFormat', 0x1001: 'RelatedImageWidth',
+    0x1002: 'RelatedImageLength',
+}
+
+GROUP_TAGS = {'Image': IMAGE_TAGS, 'Thumbnail': IMAGE_TAGS,
+              'Photo': PHOTO_TAGS, 'GPSInfo': GPS_TAGS, 'Iop': IOP_TAGS}
+
+SUB_IFDS = {0x8769: 'Photo', 0x8825: 'GPSInfo', 0xa005: 'Iop'}
+SKIP_TAGS = set([0x927c])       # MakerNote: exiv2 decodes it per vendor
+
+# IPTC datasets: record -> (group, {dataset -> name}).  Repeatable names
+# have lists of values.
+IPTC_RECORDS = {
+    1: ('Envelope', {
+        0: 'ModelVersion', 5: 'Destination', 20: 'FileFormat',
+        22: 'FileVersion', 30: 'ServiceId', 40: 'EnvelopeNumber',
+        50: 'ProductId', 60: 'EnvelopePriority', 70: 'DateSent',
+        80: 'TimeSent', 90: 'CharacterSet', 100: 'UNO'}),
+    2: ('Application2', {
+        0: 'RecordVersion', 3: 'ObjectType', 4: 'ObjectAttribute',
+        5: 'ObjectName', 7: 'EditStatus', 10: 'Urgency', 12: 'Subject',
+        15: 'Category', 20: 'SuppCategory', 22: 'FixtureId', 25: 'Keywords',
+        26: 'LocationCode', 27: 'LocationName', 30: 'ReleaseDate',
+        35: 'ReleaseTime', 37: 'ExpirationDate', 38: 'ExpirationTime',
+        40: 'SpecialInstructions', 42: 'ActionAdvised',
+        45: 'ReferenceService', 47: 'ReferenceDate', 50: 'ReferenceNumber',
+        55: 'DateCreated', 60: 'TimeCreated', 62: 'DigitizationDate',
+        63: 'DigitizationTime', 65: 'Program', 70: 'ProgramVersion',
+        75: 'ObjectCycle', 80: 'Byline', 85: 'BylineTitle', 90: 'City',
+        92: 'SubLocation', 95: 'ProvinceState', 100: 'CountryCode',
+        101: 'CountryName', 103: 'TransmissionReference', 105: 'Headline',
+        110: 'Credit', 115: 'Source', 116: 'Copyright', 118: 'Contact',
+        120: 'Caption', 122: 'Writer', 130: 'ImageType',
+        131: 'ImageOrientation', 135: 'Language'}),
+}
+IPTC_REPEATABLE = set([
+    'Destination', 'ProductId', 'ObjectAttribute', 'Subject', 'SuppCategory',
+    'Keywords', 'LocationCode', 'LocationName', 'ReferenceService',
+    'ReferenceDate', 'ReferenceNumber', 'Byline', 'BylineTitle', 'Contact',
+    'Writer'])
+IPTC_SHORTS = set(['ModelVersion', 'FileVersion', 'RecordVersion'])
+IPTC_DATES = set(['DateSent', 'ReleaseDate', 'ExpirationDate', 'DateCreated',
+                  'DigitizationDate', 'ReferenceDate'])
+IPTC_TIMES = set(['TimeSent', 'ReleaseTime', 'ExpirationTime', 'TimeCreated',
+                  'DigitizationTime'])
+
+# XMP namespace -> exiv2 prefix.  Others use the document's prefix.
+XMP_PREFIXES = {
+    'http://purl.org/dc/elements/1.1/': 'dc',
+    'http://ns.adobe.com/xap/1.0/': 'xmp',
+    'http://ns.adobe.com/xap/1.0/rights/': 'xmpRights',
+    'http://ns.adobe.com/xap/1.0/mm/': 'xmpMM',
+    'http://ns.adobe.com/xap/1.0/bj/': 'xmpBJ',
+    'http://ns.adobe.com/xap/1.0/t/pg/': 'xmpTPg',
+    'http://ns.adobe.com/xmp/1.0/DynamicMedia/': 'xmpDM',
+    'http://ns.adobe.com/pdf/1.3/': 'pdf',
+    'http://ns.adobe.com/photoshop/1.0/': 'photoshop',
+    'http://ns.adobe.com/camera-raw-settings/1.0/': 'crs',
+    'http://ns.adobe.com/tiff/1.0/': 'tiff',
+    'http://ns.adobe.com/exif/1.0/': 'exif',
+    'http://ns.adobe.com/exif/1.0/aux/': 'aux',
+    'http://iptc.org/std/Iptc4xmpCore/1.0/xmlns/': 'iptc',
+    'http://iptc.org/std/Iptc4xmpExt/2008-02-29/': 'iptcExt',
+    'http://ns.useplus.org/ldf/xmp/1.0/': 'plus',
+    'http://ns.adobe.com/lightroom/1.0/': 'lr',
+    'http://ns.microsoft.com/photo/1.0/': 'MicrosoftPhoto',
+    'http://www.digikam.org/ns/1.0/': 'digiKam',
+    'http://cipa.jp/exif/1.0/': 'exifEX',
+    'http://www.metadataworkinggroup.com/schemas/regions/': 'mwg-rs',
+    'http://ns.google.com/photos/1.0/panorama/': 'GPano',
+}
+RDF_NS = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+XMLNS_RE = re.compile(r'xmlns:([\w.-]+)\s*=\s*["\']([^"\']*)["\']')
+
+XMP_HEADER = 'http://ns.adobe.com/xap/1.0/\x00'
+EXIF_HEADER = 'Exif\x00\x00'
+PHOTOSHOP_HEADER = 'Photoshop 3.0\x00'
+
+# TIFF type -> (size, struct code).  Rationals are read as two longs.
+# BYTE, ASCII, and UNDEFINED are read as strings
+TIFF_TYPES = {
+    1: (1, 'B'), 2: (1, 'B'), 3: (2, 'H'), 4: (4, 'L'), 5: (8, 'L'),
+    6: (1, 'b'), 7: (1, 'B'), 8: (2, 'h'), 9: (4, 'l'), 10: (8, 'l'),
+    11: (4, 'f'), 12: (8, 'd'), 13: (4, 'L'),
+}
+MAX_VALUE_BYTES = 64 * 1024     # skip bigger values (e.g. embedded profiles)
+
+GPS_REFS = {
+    'GPSLatitudeRef': {'N': 'North', 'S': 'South'},
+    'GPSLongitudeRef': {'E': 'East', 'W': 'West'},
+    'GPSDestLatitudeRef': {'N': 'North', 'S': 'South'},
+    'GPSDestLongitudeRef': {'E': 'East', 'W': 'West'},
+}
+GPS_DEGREES = set(['GPSLatitude', 'GPSLongitude',
+                   'GPSDestLatitude', 'GPSDestLongitude'])
+ORIENTATIONS = {
+    1: 'top, left', 2: 'top, right', 3: 'bottom, right', 4: 'bottom, left',
+    5: 'left, top', 6: 'right, top', 7: 'right, bottom', 8: 'left, bottom',
+}
+
+LABEL_RE = re.compile(r'(?<=[a-z0-9])(?=[A-Z])')
+
+
+def Label(name):
+    """Guess a readable label from a tag name.  e.g. ExposureTime."""
+    return LABEL_RE.sub(' ', name)
+
+
+def _Degrees(values):
+    """Format a degree, minute, second triple the way exiv2 does.
+
+    e.g. 37deg 16' 25.870"  (trailing zero parts are left off)
+    """
+    units = ('deg', "'", '"')
+    precision = (7, 5, 3)
+    last = 2
+    while last > 0 and values[last][0] == 0:
+        last -= 1
+    out = ''
+    for ii in range(last + 1):
+        num, den = values[ii]
+        if den == 0:
+            return '(%s)' % ' '.join(['%d/%d' % vv for vv in values])
+        prec = 0 if num % den == 0 else precision[ii]
+        out += '%.*f%s ' % (prec, num / den, units[ii])
+    return out
+
+
+def _Exposure(num, den):
+    """Format an exposure time like exiv2.  e.g. 1/250 s"""
+    if den == 0:
+        return '(%d/%d)' % (num, den)
+    if num == 0 or num >= den:
+        return '%g s' % (num / den)
+    return '1/%d s' % int(den / num + 0.5)
+
+
+class _Tiff(object):
+    """Minimal TIFF IFD reader over a buffer (e.g. an mmap)."""
+
+    def __init__(self, buf, base, end):
+        self.buf = buf
+        self.base = base        # offsets are relative to the TIFF header
+        self.end = end
+        order = buf[base:base+2]
+        if order == 'II':
+            self.order = '<'
+        elif order == 'MM':
+            self.order = '>'
+        else:
+            raise ValueError("Not a TIFF header")
+        if self._Unpack('H', 2)[0] != 42:
+            raise ValueError("Bad TIFF magic")
+        self.first_ifd = self._Unpack('L', 4)[0]
+
+    def _Unpack(self, fmt, offset):
+        """Unpack struct fmt at offset from the TIFF header."""
+        fmt = self.order + fmt
+        pos = self.base + offset
+        if offset < 0 or pos + struct.calcsize(fmt) > self.end:
+            raise ValueError("TIFF offset out of range")
+        return struct.unpack_from(fmt, self.buf, pos)
+
+    def Entries(self, offset):
+        """Return ([(tag, type, count, value_offset)...], next_ifd_offset)."""
+        count = self._Unpack('H', offset)[0]
+        entries = []
+        for ii in range(count):
+            pos = offset + 2 + 12 * ii
+            tag, typ, num = self._Unpack('HHL', pos)
+            entries.append((tag, typ, num, pos + 8))
+        next_ifd = self._Unpack('L', offset + 2 + 12 * count)[0]
+        return entries, next_ifd
+
+    def Bytes(self, typ, count, pos):
+        """Return the raw bytes of an entry's value."""
+        total = TIFF_TYPES[typ][0] * count
+        if total > MAX_VALUE_BYTES:
+            raise ValueError("Value too big")
+        if total > 4:           # value is somewhere else
+            pos = self._Unpack('L', pos)[0]
+        if pos < 0 or self.base + pos + total > self.end:
+            raise ValueError("TIFF offset out of range")
+        return self.buf[self.base + pos:self.base + pos + total]
+
+    def Values(self, typ, count, pos):
+        """Return the values of an entry as a list (or str for ASCII)."""
+        size, code = TIFF_TYPES[typ]
+        if typ == 2:
+            return self.Bytes(typ, count, pos).split('\x00', 1)[0]
+        if typ in (1, 7):
+            return [ord(cc) for cc in self.Bytes(typ, count, pos)]
+        if size * count > MAX_VALUE_BYTES:
+            raise ValueError("Value too big")
+        if size * count > 4:    # value is somewhere else
+            pos = self._Unpack('L', pos)[0]
+        if typ in (5, 10):
+            vals = self._Unpack('%d%s' % (2 * count, code), pos)
+            return [(vals[ii], vals[ii+1]) for ii in range(0, len(vals), 2)]
+        return list(self._Unpack('%d%s' % (count, code), pos))
+
+
+def _RawString(typ, values):
+    """Format TIFF values like exiv2's raw_value."""
+    if typ == 2:
+        return values
+    if typ in (5, 10):
+        return ' '.join(['%d/%d' % vv for vv in values])
+    return ' '.join([str(vv) for vv in values])
+
+
+class FastReader(object):
+    """Collect EXIF, IPTC, and XMP tags into a MetadataSnapshot."""
+
+    def __init__(self, buf, demand=None):
+        self.buf = buf
+        self.demand = demand    # TagDemand, or None to decode everything
+        self.exif_keys = list()
+        self.iptc_keys = list()
+        self.xmp_keys = list()
+        self.tags = dict()      # key -> value tuple (see MetadataSnapshot)
+        self.keys = set()
+
+    def _Wants(self, key):
+        """Add key (first one wins, like exiv2).  True if it needs a value."""
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        if key.startswith('Exif.'):
+            self.exif_keys.append(key)
+        elif key.startswith('Iptc.'):
+            self.iptc_keys.append(key)
+        else:
+            self.xmp_keys.append(key)
+        return self.demand is None or self.demand.Wants(key)
+
+    def _AddTag(self, key, human, raw, values=None, repeatable=False):
+        if self._Wants(key):
+            self.tags[key] = (human, raw, values, repeatable,
+                              Label(key.split('.')[-1]))
+
+    def Snapshot(self):
+        """Return the tags read as a MetadataSnapshot."""
+        return MetadataSnapshot(self.exif_keys, self.iptc_keys, self.xmp_keys,
+                                self.tags)
+
+    # EXIF
+    def ReadTiff(self, base, end):
+        """Read all the IFDs of a TIFF structure."""
+        tiff = _Tiff(self.buf, base, end)
+        visited = set()
+        self._ReadIfd(tiff, tiff.first_ifd, 'Image', visited)
+
+    def _ReadIfd(self, tiff, offset, group, visited):
+        if not offset or offset in visited:
+            return
+        visited.add(offset)
+        try:
+            entries, next_ifd = tiff.Entries(offset)
+        except (ValueError, struct.error):
+            return
+        names = GROUP_TAGS[group]
+        for tag, typ, count, pos in entries:
+            if tag in SKIP_TAGS or typ not in TIFF_TYPES:
+                continue
+            name = names.get(tag, '0x%04x' % tag)
+            key = 'Exif.%s.%s' % (group, name)
+            if (self.demand is not None and tag not in SUB_IFDS
+                and tag not in (0x02bc, 0x83bb)
+                and not self.demand.Wants(key)):
+                self._Wants(key) # key only.  Value isn't needed
+                continue
+            try:
+                values = tiff.Values(typ, count, pos)
+            except (ValueError, struct.error):
+                continue
+            raw = _RawString(typ, values)
+            self._AddTag(key, self._Human(name, typ, values, raw), raw)
+            if tag == 0x02bc and group == 'Image': # XMLPacket
+                self.ReadXmp(tiff.Bytes(typ, count, pos))
+            elif tag == 0x83bb and group == 'Image': # IPTCNAA
+                self.ReadIptc(tiff.Bytes(typ, count, pos))
+            elif tag in SUB_IFDS and values:
+                self._ReadIfd(tiff, values[0], SUB_IFDS[tag], visited)
+        if group == 'Image':
+            self._ReadIfd(tiff, next_ifd, 'Thumbnail', visited)
+
+    def _Human(self, name, typ, values, raw):
+        """Return a human readable value for a few common tags."""
+        try:
+            if name in GPS_DEGREES and len(values) == 3:
+                return _Degrees(values)
+            if name in GPS_REFS:
+                return GPS_REFS[name].get(values.strip(), values)
+            if name == 'ExposureTime' and len(values) == 1:
+                return _Exposure(*values[0])
+            if name == 'FNumber' and len(values) == 1 and values[0][1]:
+                return 'F%.1f' % (values[0][0] / values[0][1])
+            if name == 'FocalLength' and len(values) == 1 and values[0][1]:
+                return '%.1f mm' % (values[0][0] / values[0][1])
+            if name == 'Orientation' and len(values) == 1:
+                return ORIENTATIONS.get(values[0], '(%d)' % values[0])
+        except (TypeError, ValueError, IndexError):
+            pass
+        return raw
+
+    # IPTC
+    def ReadPhotoshop(self, data):
+        """Find the IPTC block in Photoshop image resources."""
+        pos = 0
+        while pos + 12 <= len(data) and data[pos:pos+4] == '8BIM':
+            res_id = struct.unpack('>H', data[pos+4:pos+6])[0]
+            name_len = ord(data[pos+6])
+            pos += 7 + name_len
+            pos += pos % 2      # pascal name is padded to even
+            if pos + 4 > len(data): # truncated
+                break
+            size = struct.unpack('>L', data[pos:pos+4])[0]
+            pos += 4
+            if res_id == 0x0404:
+                self.ReadIptc(data[pos:pos+size])
+            pos += size + size % 2
+
+    def ReadIptc(self, data):
+        """Read IPTC IIM datasets."""
+        pos = 0
+        found = dict()          # key -> [values]
+        order = []
+        while pos + 5 <= len(data) and data[pos] == '\x1c':
+            record, dataset = ord(data[pos+1]), ord(data[pos+2])
+            size = struct.unpack('>H', data[pos+3:pos+5])[0]
+            pos += 5
+            if size & 0x8000:   # extended size.  Not used for text
+                break
+            value = data[pos:pos+size]
+            pos += size
+            group, names = IPTC_RECORDS.get(record, (None, None))
+            if not group:
+                continue
+            name = names.get(dataset, '0x%04x' % dataset)
+            if name in IPTC_SHORTS and len(value) == 2:
+                value = str(struct.unpack('>H', value)[0])
+            elif name in IPTC_DATES and len(value) == 8:
+                value = '%s-%s-%s' % (value[:4], value[4:6], value[6:])
+            elif name in IPTC_TIMES and len(value) == 11:
+                value = '%s:%s:%s%s:%s' % (value[:2], value[2:4], value[4:6],
+                                          value[6:9], value[9:])
+            key = 'Iptc.%s.%s' % (group, name)
+            if key not in found:
+                found[key] = []
+                order.append(key)
+            found[key].append(value)
+        for key in order:
+            repeatable = key.split('.')[-1] in IPTC_REPEATABLE
+            self._AddTag(key, found[key], found[key],
+                         found[key] if repeatable else None, repeatable)
+
+    # XMP
+    def ReadXmp(self, packet):
+        """Read simple XMP properties, bags, sequences, and alternatives."""
+        start = packet.find('<')
+        end = packet.rfind('>')
+        if start < 0 or end < 0:
+            return
+        packet = packet[start:end+1]
+        prefixes = dict(XMLNS_RE.findall(packet))
+        prefixes = dict([(uri, pp) for pp, uri in prefixes.iteritems()])
+        prefixes.update(XMP_PREFIXES)
+        try:
+            root = ElementTree.fromstring(packet)
+        except Exception:       # expat errors vary by version
+            return
+        for desc in root.iter('{%s}Description' % RDF_NS):
+            for attr, value in desc.attrib.iteritems():
+                self._AddXmp(prefixes, attr, _Utf8(value))
+            for prop in desc:
+                self._AddXmp(prefixes, prop.tag, self._XmpValue(prop))
+
+    def _XmpValue(self, prop):
+        """Return the raw_value of a property element (None for structures)."""
+        for container in prop:
+            if container.tag in ('{%s}Bag' % RDF_NS, '{%s}Seq' % RDF_NS):
+                return [_Utf8(li.text or '') for li in container]
+            if container.tag == '{%s}Alt' % RDF_NS:
+                return dict([(li.get(XML_LANG, 'x-default'), _Utf8(li.text or ''))
+                             for li in container])
+            return None         # structure
+        if prop.get('{%s}resource' % RDF_NS):
+            return _Utf8(prop.get('{%s}resource' % RDF_NS))
+        if prop.get('{%s}parseType' % RDF_NS) == 'Resource':
+            return None
+        return _Utf8(prop.text or '')
+
+    def _AddXmp(self, prefixes, tag, value):
+        if value is None or not tag.startswith('{'):
+            return
+        uri, name = tag[1:].split('}', 1)
+        if uri == RDF_NS or uri not in prefixes:
+            return
+        self._AddTag('Xmp.%s.%s' % (prefixes[uri], name), value, value)
+
+    # Files
+    def ReadJpeg(self):
+        """Walk the JPEG markers up to the image data."""
+        buf = self.buf
+        pos = 2
+        size = len(buf)
+        while pos + 4 <= size:
+            if buf[pos] != '\xff':
+                break
+            marker = ord(buf[pos+1])
+            if marker == 0xff:  # fill byte
+                pos += 1
+                continue
+            if marker in (0xd9, 0xda): # end of image, start of scan
+                break
+            if 0xd0 <= marker <= 0xd7 or marker == 0x01:
+                pos += 2
+                continue
+            length = struct.unpack('>H', buf[pos+2:pos+4])[0]
+            start = pos + 4
+            end = min(pos + 2 + length, size)
+            try:                # skip a damaged segment
+                if marker == 0xe1 and buf[start:start+6] == EXIF_HEADER:
+                    self.ReadTiff(start + 6, end)
+                elif marker == 0xe1 and buf[start:start+29] == XMP_HEADER:
+                    self.ReadXmp(buf[start+29:end])
+                elif marker == 0xed and buf[start:start+14] == PHOTOSHOP_HEADER:
+                    self.ReadPhotoshop(buf[start+14:end])
+            except (ValueError, struct.error, IndexError):
+                pass
+            pos = pos + 2 + length
+
+
+def _Utf8(text):
+    """ElementTree gives unicode for non-ASCII.  Everything else is str."""
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+def ReadFast(fname, demand=None):
+    """Return a MetadataSnapshot for a JPEG or TIFF file.
+
+    With a TagDemand, only the wanted values are decoded.  Returns None
+    for anything else (or if the file is unreadable), so the caller can
+    fall back to pyexiv2.
+    """
+    try:
+        fd = open(fname, 'rb')
+    except IOError:
+        return None
+    try:
+        try:
+            buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError): # e.g. empty file
+            return None
+        try:
+            reader = FastReader(buf, demand)
+            head = buf[:4]
+            if head[:2] == '\xff\xd8':
+                reader.ReadJpeg()
+            elif head in ('II*\x00', 'MM\x00*'):
+                try:
+                    reader.ReadTiff(0, len(buf))
+                except (ValueError, struct.error, IndexError):
+                    return None
+            else:
+                return None
+            return reader.Snapshot()
+        finally:
+            buf.close()
+    finally:
+        fd.close()
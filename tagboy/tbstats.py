@@ -0,0 +1,194 @@
+# ******************************************************************************
+#
+# Copyright (C) 2018 Dan Christian <DanChristian65@gmail.com>
+#
+# This file is part of tagboy distribution.
+#
+# tagboy is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# tagboy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tagboy; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, 5th Floor, Boston, MA 02110-1301 USA.
+#
+# Author: Dan Christian <DanChristian65@gmail.com>
+
+# Run statistics (--stats) and progress (--progress)
+
+from __future__ import absolute_import
+from __future__ import division
+
+import json
+import sys
+import time
+
+try:
+    _cpu = time.process_time    # python 3.3+
+except AttributeError:
+    _cpu = time.clock           # python 2: CPU time on unix
+
+
+class _Timer(object):
+    """Context manager that adds its run time to a phase."""
+    __slots__ = ('stats', 'name', 'wall', 'cpu')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = _cpu()
+
+    def __exit__(self, *exc_info):
+        self.stats.Add(self.name, time.time() - self.wall, _cpu() - self.cpu)
+        return False
+
+
+class _NoTimer(object):
+    """Context manager that does nothing (--stats is off)."""
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NO_TIMER = _NoTimer()
+
+
+class PhaseStats(object):
+    """Call counts, wall and CPU seconds per named phase, plus counters.
+
+    Phases are only timed if enabled, but counters are always kept.
+    A phase's cpu is None if only wall time is known.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases = dict()    # name -> [calls, wall, cpu]
+        self.counters = dict()  # event name -> count (e.g. cache hits)
+        self.start = time.time()
+        self.start_cpu = _cpu()
+
+    def Phase(self, name):
+        """Return a context manager that times one call of phase name."""
+        if not self.enabled:
+            return _NO_TIMER
+        return _Timer(self, name)
+
+    def Add(self, name, wall, cpu=None, calls=1):
+        """Add time to a phase."""
+        phase = self.phases.get(name)
+        if phase is None:
+            self.phases[name] = [calls, wall, cpu]
+            return
+        phase[0] += calls
+        phase[1] += wall
+        if cpu is not None:
+            phase[2] = cpu if phase[2] is None else phase[2] + cpu
+
+    def Count(self, name, count=1):
+        """Add to a named event counter."""
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def Take(self):
+        """Return the state since the last Take() (e.g. from a worker)."""
+        state = (dict((kk, list(vv)) for kk, vv in self.phases.iteritems()),
+                 dict(self.counters))
+        self.phases.clear()
+        self.counters.clear()
+        return state
+
+    def Merge(self, state):
+        """Add in the output of Take()."""
+        phases, counters = state
+        for name, (calls, wall, cpu) in phases.iteritems():
+            self.Add(name, wall, cpu, calls)
+        for name, count in counters.iteritems():
+            self.Count(name, count)
+
+    def Summary(self, files, matched):
+        """Return the statistics as built-in types (e.g. for json)."""
+        elapsed = time.time() - self.start
+        return {
+            'files': files,
+            'matched': matched,
+            'elapsed': elapsed,
+            'cpu': _cpu() - self.start_cpu,
+            'files_per_sec': files / elapsed if elapsed > 0 else 0.0,
+            'phases': dict((kk, {'calls': calls, 'wall': wall, 'cpu': cpu})
+                           for kk, (calls, wall, cpu)
+                           in self.phases.iteritems()),
+            'counters': dict(self.counters),
+            }
+
+    def Report(self, files, matched):
+        """Return the statistics as a list of lines to show."""
+        summary = self.Summary(files, matched)
+        elapsed = summary['elapsed']
+        lines = ["Stats: %d files (%d matched) in %.3f sec, %.1f files/sec"
+                 % (files, matched, elapsed, summary['files_per_sec'])]
+        lines.append("  %-12s %9s %10s %10s %7s"
+                     % ('phase', 'calls', 'wall sec', 'cpu sec', 'wall %'))
+        for name, (calls, wall, cpu) in sorted(
+                self.phases.iteritems(), key=lambda kv: -kv[1][1]):
+            lines.append("  %-12s %9d %10.3f %10s %7.1f" % (
+                name, calls, wall, '-' if cpu is None else '%.3f' % cpu,
+                100.0 * wall / elapsed if elapsed > 0 else 0.0))
+        for name in sorted(self.counters):
+            lines.append("  %-12s %9d" % (name, self.counters[name]))
+        return lines
+
+    def WriteJson(self, path, files, matched):
+        """Write Summary() to path as json."""
+        with open(path, 'w') as fd:
+            json.dump(self.Summary(files, matched), fd, indent=2,
+                      sort_keys=True)
+            fd.write('\n')
+
+
+class Progress(object):
+    """Throttled, single line progress report (on stderr).
+
+    total is the number of files expected, if known (for the ETA).
+    """
+    INTERVAL = 1.0              # seconds between updates
+
+    def __init__(self, total=None, out=None):
+        self.total = total
+        self.out = out          # None means sys.stderr
+        self.start = time.time()
+        self.next = self.start + self.INTERVAL
+        self.width = 0          # length of the last line shown
+
+    def Update(self, files, matched, force=False):
+        now = time.time()
+        if now < self.next and not force:
+            return
+        self.next = now + self.INTERVAL
+        rate = files / (now - self.start) if now > self.start else 0.0
+        line = "%d files, %d matched, %.1f files/sec" % (files, matched, rate)
+        if self.total and rate > 0:
+            left = max(self.total - files, 0)
+            eta = int(left / rate)
+            line += ", %d%% ETA %d:%02d:%02d" % (
+                100 * files // self.total, eta // 3600, eta // 60 % 60,
+                eta % 60)
+        out = self.out or sys.stderr
+        out.write("\r" + line.ljust(self.width))
+        out.flush()
+        self.width = len(line)
+
+    def Done(self, files, matched):
+        """Show the final counts and end the line."""
+        self.Update(files, matched, force=True)
+        (self.out or sys.stderr).write("\n")
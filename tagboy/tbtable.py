@@ -0,0 +1,135 @@
+# ******************************************************************************
+#
+# Copyright (C) 2018 Dan Christian <DanChristian65@gmail.com>
+#
+# This file is part of tagboy distribution.
+#
+# tagboy is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# tagboy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tagboy; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, 5th Floor, Boston, MA 02110-1301 USA.
+#
+# Author: Dan Christian <DanChristian65@gmail.com>
+
+# Columnar tag table (--table) saved as numpy .npz
+
+from __future__ import absolute_import
+
+import array
+import re
+try:
+    import numpy as np
+except ImportError:
+    np = None                   # --table is unavailable
+HAVE_NUMPY = np is not None
+
+INT_RE = re.compile(r'[-+]?\d+\Z')
+FLOAT_RE = re.compile(r'[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\Z')
+INT_LIMIT = 2 ** 63
+
+
+class _Column(object):
+    """Dictionary encoded values of one tag.  Code -1 is missing."""
+
+    def __init__(self, rows):
+        self.codes = array.array('l', [-1]) * rows
+        self.vocab = dict()     # value -> code
+
+    def Append(self, value):
+        code = self.vocab.get(value)
+        if code is None:
+            code = self.vocab[value] = len(self.vocab)
+        self.codes.append(code)
+
+    def Words(self):
+        """Return the vocabulary in code order."""
+        words = [None] * len(self.vocab)
+        for word, code in self.vocab.iteritems():
+            words[code] = word
+        return words
+
+
+class TagTable(object):
+    """Collect tag values per file, then save them as numpy columns.
+
+    In the .npz file, 'path' holds the file paths, and 'lat'/'lon'
+    decimal positions (NaN if unknown).  Each tag column NAME is one of:
+      int64 or float64 values, plus NAME:mask (True where missing)
+      int32 codes (-1 where missing), plus NAME:vocab of strings
+    A column is numeric if every value is a plain number.
+    '_columns' lists the tag columns in the order they were first seen.
+    """
+
+    def __init__(self):
+        self.paths = list()
+        self.lats = array.array('d')
+        self.lons = array.array('d')
+        self.columns = dict()   # tag name -> _Column
+        self.order = list()     # tag names in the order first seen
+
+    def __len__(self):
+        return len(self.paths)
+
+    def Add(self, path, items, latlon=None):
+        """Add a row.  items is [(tag name, value)...]."""
+        rows = len(self.paths)
+        self.paths.append(path)
+        lat, lon = latlon if latlon else (float('nan'), float('nan'))
+        self.lats.append(lat)
+        self.lons.append(lon)
+        for name, value in items:
+            col = self.columns.get(name)
+            if col is None:
+                col = self.columns[name] = _Column(rows)
+                self.order.append(name)
+            elif len(col.codes) > rows: # repeated name.  First one wins
+                continue
+            col.Append(str(value))
+        for col in self.columns.itervalues():
+            if len(col.codes) == rows: # missing from this file
+                col.codes.append(-1)
+
+    @staticmethod
+    def _Encode(name, col, arrays):
+        """Add the numpy arrays for one column to arrays."""
+        codes = np.array(col.codes, dtype=np.int64)
+        missing = codes < 0
+        words = col.Words()
+        values = None
+        if words and all(INT_RE.match(ww) for ww in words):
+            numbers = [int(ww) for ww in words]
+            if all(-INT_LIMIT <= nn < INT_LIMIT for nn in numbers):
+                values = np.array(numbers, dtype=np.int64)
+        if values is None and words and all(FLOAT_RE.match(ww) for ww in words):
+            values = np.array([float(ww) for ww in words], dtype=np.float64)
+        if values is not None:
+            column = np.zeros(len(codes), dtype=values.dtype)
+            column[~missing] = values[codes[~missing]]
+            if values.dtype == np.float64:
+                column[missing] = np.nan
+            arrays[name] = column
+            arrays[name + ':mask'] = missing
+        else:
+            arrays[name] = codes.astype(np.int32)
+            arrays[name + ':vocab'] = np.array(words, dtype=object).astype(str) \
+                if words else np.array([], dtype=str)
+
+    def Save(self, path):
+        """Write the table as a compressed .npz file."""
+        arrays = dict()
+        arrays['path'] = np.array(self.paths, dtype=str)
+        arrays['lat'] = np.array(self.lats, dtype=np.float64)
+        arrays['lon'] = np.array(self.lons, dtype=np.float64)
+        for name in self.order:
+            self._Encode(name, self.columns[name], arrays)
+        arrays['_columns'] = np.array(self.order, dtype=str)
+        np.savez_compressed(path, **arrays)
@@ -25,6 +25,17 @@
 from __future__ import absolute_import
 
 from math import cos, asin, sqrt
+import fnmatch
+import os
+import re
+import stat
+try:
+    from os import scandir      # python 3.5+
+except ImportError:
+    try:
+        from scandir import scandir # pip install scandir
+    except ImportError:
+        scandir = None
 
 
 def distance(latlon1, latlon2):
@@ -37,3 +48,114 @@ def distance(latlon1, latlon2):
     p = 0.017453292519943295     #Pi/180
     a = 0.5 - cos((lat2 - lat1) * p)/2 + cos(lat1 * p) * cos(lat2 * p) * (1 - cos((lon2 - lon1) * p)) / 2
     return 12742 * asin(sqrt(a)) #2*R*asin...
+
+
+class DirEntry(object):
+    """Minimal os.DirEntry for when scandir isn't available.
+
+    Uses lstat (and stat for symlinks) on demand.
+    """
+
+    def __init__(self, dir_path, name):
+        self.name = name
+        self.path = os.path.join(dir_path, name)
+        self._lstat = None
+
+    def stat(self, follow_symlinks=True):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        if follow_symlinks and stat.S_ISLNK(self._lstat.st_mode):
+            return os.stat(self.path)
+        return self._lstat
+
+    def inode(self):
+        return self.stat(follow_symlinks=False).st_ino
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:         # e.g. broken symlink
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+
+def list_dir(path):
+    """Return a list of DirEntry-like objects for path (like os.scandir)."""
+    if scandir is not None:
+        return list(scandir(path))
+    return [DirEntry(path, name) for name in os.listdir(path)]
+
+
+class FrozenDict(dict):
+    """A dict that can't be changed, so it can be shared safely."""
+
+    def _ReadOnly(self, *args, **kwargs):
+        raise TypeError("%s is read only" % type(self).__name__)
+
+    __setitem__ = __delitem__ = _ReadOnly
+    clear = pop = popitem = setdefault = update = _ReadOnly
+
+    def copy(self):
+        """Return a changeable copy."""
+        return dict(self)
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self), ))
+
+
+class NameMatcher(object):
+    """Match a file name against many shell globs in one call.
+
+    Gives the same answer as trying fnmatch.fnmatchcase with each glob.
+    Globs of the form *.ext become one str.endswith test and the rest
+    are joined into a single compiled regex.  iglobs are case
+    insensitive (the name is lowered once), globs are case sensitive.
+    """
+    GLOB_CHARS = frozenset('*?[')
+
+    def __init__(self, globs=(), iglobs=()):
+        self.match_all = not globs and not iglobs # nothing means match all
+        self.suffixes, self.regex = self._Compile(globs)
+        self.isuffixes, self.iregex = self._Compile(
+            [gg.lower() for gg in iglobs])
+
+    @classmethod
+    def _Compile(cls, globs):
+        """Split globs into (suffix tuple, compiled regex or None)."""
+        suffixes = []
+        patterns = []
+        for gg in globs:
+            if gg.startswith('*') and not cls.GLOB_CHARS.intersection(gg[1:]):
+                suffixes.append(gg[1:])
+                continue
+            pat = fnmatch.translate(gg)
+            if pat.endswith('\\Z(?ms)'): # python 2 form
+                pat = pat[:-len('\\Z(?ms)')] + '\\Z'
+            patterns.append('(?:%s)' % pat)
+        regex = None
+        if patterns:
+            regex = re.compile('|'.join(patterns), re.S).match
+        return tuple(suffixes), regex
+
+    def __call__(self, name):
+        if self.match_all:
+            return True
+        if self.isuffixes or self.iregex:
+            lname = name.lower()
+            if self.isuffixes and lname.endswith(self.isuffixes):
+                return True
+            if self.iregex and self.iregex(lname):
+                return True
+        if self.suffixes and name.endswith(self.suffixes):
+            return True
+        if self.regex and self.regex(name):
+            return True
+        return False
@@ -0,0 +1,142 @@
+# ******************************************************************************
+#
+# Copyright (C) 2018 Dan Christian <DanChristian65@gmail.com>
+#
+# This file is part of tagboy distribution.
+#
+# tagboy is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# tagboy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tagboy; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, 5th Floor, Boston, MA 02110-1301 USA.
+#
+# Author: Dan Christian <DanChristian65@gmail.com>
+
+# Directory tree walker
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+from tbutil import list_dir
+
+
+class DirWalker(object):
+    """Walk directory trees and generate matching file paths.
+
+    Uses scandir entry types, so most entries are never stat'ed.  File
+    names are matched, and hidden and too deep directories are dropped,
+    before anything is descended.  With jobs > 1, directories are
+    listed ahead of time by a thread pool (listing mostly waits on the
+    file system), but paths still come out in the same order.
+    """
+    MAX_AHEAD = 256             # directory listings to queue per thread
+
+    def __init__(self, match=None, maxdepth=-1, follow=False, jobs=1,
+                 debug=None):
+        self.match = match      # function(file_name) -> bool
+        self.maxdepth = maxdepth
+        self.follow = follow    # descend symbolic links to directories
+        self.jobs = jobs
+        self.debug = debug      # function(level, message)
+        self.pool = ThreadPool(jobs) if jobs > 1 else None
+        self.ahead = 0          # listings queued in the pool
+        self.dir_count = 0      # directories listed
+        self.file_count = 0     # matching files generated
+        self.elapsed = 0.0      # seconds spent walking (not processing)
+
+    def Rate(self):
+        """Return the walk rate in files/sec."""
+        if self.elapsed <= 0:
+            return 0.0
+        return self.file_count / self.elapsed
+
+    def Close(self):
+        """Stop the thread pool."""
+        if self.pool:
+            self.pool.terminate()
+            self.pool = None
+
+    def _Debug(self, level, msg):
+        if self.debug:
+            self.debug(level, msg)
+
+    def WantDir(self, path, name, depth, is_symlink):
+        """Check if a directory at depth should be walked.
+
+        is_symlink is called only if needed.
+        """
+        if self.maxdepth >= 0 and depth > self.maxdepth:
+            return False
+        if name.startswith('.'): # ignore hidden directories
+            self._Debug(2, "Trimming hidden: %s" % path)
+            return False
+        if not self.follow and is_symlink():
+            return False
+        return True
+
+    def Scan(self, path, depth):
+        """List one directory.  Returns ([file paths], [(dir path, depth)])."""
+        files = []
+        subdirs = []
+        try:
+            entries = list_dir(path)
+        except OSError as inst:
+            self._Debug(1, "Unable to list %s: %s" % (path, inst))
+            return files, subdirs
+        descend = self.maxdepth < 0 or depth < self.maxdepth
+        for entry in entries:
+            if not entry.is_dir(): # follows symlinks, like os.walk
+                if self.match is None or self.match(entry.name):
+                    files.append(entry.path)
+                continue
+            if descend and self.WantDir(entry.path, entry.name, depth + 1,
+                                        entry.is_symlink):
+                subdirs.append((entry.path, depth + 1))
+        if not descend:
+            self._Debug(2, "Hit maxdepth.  Trimming %s" % path)
+        return files, subdirs
+
+    def _Submit(self, path, depth):
+        """Queue a directory listing if there is room, else defer it."""
+        if self.pool and self.ahead < self.MAX_AHEAD * self.jobs:
+            self.ahead += 1
+            return (self.pool.apply_async(self.Scan, (path, depth)), None)
+        return (None, (path, depth))
+
+    def _Result(self, pending):
+        """Return the (files, subdirs) of a _Submit result."""
+        async_result, args = pending
+        if async_result is None:
+            return self.Scan(*args)
+        self.ahead -= 1
+        return async_result.get()
+
+    def Walk(self, top):
+        """Generate the matching file paths under top (depth first)."""
+        if len(top) > 1 and top.endswith(os.sep): # trim final slash
+            top = top.rstrip(os.sep) or os.sep
+        start = time.time()
+        stack = [self._Submit(top, 0)]
+        while stack:
+            files, subdirs = self._Result(stack.pop())
+            self.dir_count += 1
+            stack.extend(reversed([self._Submit(dd, depth)
+                                   for dd, depth in subdirs]))
+            for fn in files:
+                self.file_count += 1
+                self.elapsed += time.time() - start
+                yield fn
+                start = time.time()
+        self.elapsed += time.time() - start
@@ -0,0 +1,241 @@
+# ******************************************************************************
+#
+# Copyright (C) 2018 Dan Christian <DanChristian65@gmail.com>
+#
+# This file is part of tagboy distribution.
+#
+# tagboy is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# tagboy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tagboy; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, 5th Floor, Boston, MA 02110-1301 USA.
+#
+# Author: Dan Christian <DanChristian65@gmail.com>
+
+# Watch directory trees for new or changed files (--watch)
+
+from __future__ import absolute_import
+from __future__ import division
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+from tbwalk import DirWalker
+
+# From <sys/inotify.h>
+IN_MODIFY      = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = 0x00000800
+IN_CLOEXEC     = 0x00080000
+
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len (then the name)
+
+
+def _LoadInotify():
+    """Return libc if it has inotify, else None."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                       ctypes.c_uint32]
+    return libc
+
+
+class Debouncer(object):
+    """Collect changed paths until they have been quiet for delay seconds.
+
+    Repeated events for a path (e.g. a file being written) restart its
+    wait, and only show up once.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.pending = dict()   # path -> time of the last event
+
+    def Add(self, paths, now=None):
+        now = time.time() if now is None else now
+        for pp in paths:
+            self.pending[pp] = now
+
+    def Timeout(self, now=None):
+        """Return seconds until a path is ready, or None if none are pending."""
+        if not self.pending:
+            return None
+        now = time.time() if now is None else now
+        return max(min(self.pending.itervalues()) + self.delay - now, 0.0)
+
+    def Ready(self, now=None):
+        """Remove and return (in order) the paths that are quiet."""
+        now = time.time() if now is None else now
+        ready = sorted(pp for pp, tt in self.pending.iteritems()
+                       if now - tt >= self.delay)
+        for pp in ready:
+            del self.pending[pp]
+        return ready
+
+
+class PollWatcher(object):
+    """Find changes by walking the trees every interval seconds.
+
+    Works everywhere (e.g. network file systems), but each pass stats
+    every matching file.
+    """
+    NAME = 'poll'
+
+    def __init__(self, walker, roots, interval=2.0):
+        self.walker = walker
+        self.roots = roots
+        self.interval = interval
+        self.files = self._Scan() # path -> (size, mtime)
+        self.next = time.time() + interval
+
+    def _Scan(self):
+        files = dict()
+        for top in self.roots:
+            for fn in self.walker.Walk(top):
+                try:
+                    st = os.stat(fn)
+                except OSError:  # deleted while walking
+                    continue
+                files[fn] = (st.st_size, st.st_mtime)
+        return files
+
+    def Read(self, timeout=None):
+        """Wait up to timeout (None is forever).  Returns changed paths."""
+        wait = self.next - time.time()
+        if timeout is not None:
+            wait = min(wait, timeout)
+        if wait > 0:
+            time.sleep(wait)
+        if time.time() < self.next:
+            return []
+        self.next = time.time() + self.interval
+        files = self._Scan()
+        changed = [fn for fn, sig in files.iteritems()
+                   if self.files.get(fn) != sig]
+        self.files = files
+        return changed
+
+    def Close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Find changes with Linux inotify (through ctypes).
+
+    Each directory in the trees gets a watch, and new directories are
+    added (and their files reported) as they show up.
+    """
+    NAME = 'inotify'
+    FILE_EVENTS = IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO
+    READ_BYTES = 65536
+
+    def __init__(self, libc, walker, roots):
+        self.libc = libc
+        self.walker = walker
+        self.roots = roots
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = dict()      # watch descriptor -> (path, depth)
+        for top in roots:
+            self._AddTree(top, 0)
+
+    def _AddTree(self, top, depth):
+        """Watch top and its sub-directories.  Returns the files in them."""
+        found = list()
+        stack = [(top, depth)]
+        while stack:
+            path, depth = stack.pop()
+            wd = self.libc.inotify_add_watch(
+                self.fd, path, self.FILE_EVENTS)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    raise OSError(err, "Out of inotify watches"
+                                  " (see fs.inotify.max_user_watches)")
+                continue        # e.g. removed already
+            self.dirs[wd] = (path, depth)
+            files, subdirs = self.walker.Scan(path, depth)
+            found.extend(files)
+            stack.extend(reversed(subdirs))
+        return found
+
+    def Read(self, timeout=None):
+        """Wait up to timeout (None is forever).  Returns changed paths."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, self.READ_BYTES)
+        except OSError as inst:
+            if inst.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+        changed = list()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW: # events were lost.  Check everything
+                for wd, (path, depth) in self.dirs.items():
+                    changed.extend(self.walker.Scan(path, depth)[0])
+                continue
+            if mask & IN_IGNORED: # directory removed
+                self.dirs.pop(wd, None)
+                continue
+            if wd not in self.dirs or not name:
+                continue
+            parent, depth = self.dirs[wd]
+            path = os.path.join(parent, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and self.walker.WantDir(
+                        path, name, depth + 1,
+                        lambda: os.path.islink(path)):
+                    changed.extend(self._AddTree(path, depth + 1))
+            elif self.walker.match is None or self.walker.match(name):
+                changed.append(path)
+        return changed
+
+    def Close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def MakeWatcher(roots, match=None, maxdepth=-1, follow=False, poll=False,
+                interval=2.0, debug=None):
+    """Return an InotifyWatcher if possible, else a PollWatcher."""
+    walker = DirWalker(match, maxdepth, follow, debug=debug)
+    libc = None if poll else _LoadInotify()
+    if libc:
+        try:
+            return InotifyWatcher(libc, walker, roots)
+        except OSError as inst:
+            if debug:
+                debug(1, "inotify unavailable (%s).  Polling" % inst)
+    return PollWatcher(walker, roots, interval)
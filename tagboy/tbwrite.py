@@ -0,0 +1,156 @@
+# ******************************************************************************
+#
+# Copyright (C) 2018 Dan Christian <DanChristian65@gmail.com>
+#
+# This file is part of tagboy distribution.
+#
+# tagboy is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# tagboy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tagboy; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, 5th Floor, Boston, MA 02110-1301 USA.
+#
+# Author: Dan Christian <DanChristian65@gmail.com>
+
+# Tag write-back (--write) from a pool of writer threads
+
+from __future__ import absolute_import
+
+import collections
+import os
+import shutil
+import time
+from multiprocessing.pool import ThreadPool
+
+
+class TagWriter(object):
+    """Write changed tag values back into image files.
+
+    Each file's changes are applied with a single metadata.write().
+    Writes run in a thread pool so the next files can be read in the
+    meantime.  With temp, a copy of the file is changed and renamed over
+    the original, so the image is never left half written.
+
+    Only text tags are written, since their raw value is the string
+    that --eval sees.  A file with any other tag changed is left alone
+    and reported as an error.
+    """
+    MAX_PENDING = 16            # queued files per thread before we wait
+    TEXT_TYPES = frozenset([    # pyexiv2 tag types that hold plain text
+            'Ascii', 'String',  # Exif, Iptc
+            'Text', 'bag Text', 'seq Text', 'ProperName', 'bag ProperName',
+            'seq ProperName', 'AgentName', 'URI', 'URL', 'MIMEType'])
+
+    def __init__(self, open_meta, jobs=2, temp=False, error=None):
+        self.open_meta = open_meta # function(path) -> pyexiv2 metadata
+        self.jobs = jobs
+        self.temp = temp
+        self.error = error      # function(message)
+        self.pool = None        # started on first use (not in --jobs forks)
+        self.pending = collections.deque() # AsyncResult or result tuple
+        self.files = 0          # files written
+        self.tags = 0           # tag values written
+        self.failed = 0         # files that couldn't be written
+        self.seconds = 0.0      # time spent writing (summed over threads)
+
+    @staticmethod
+    def _Str(value):
+        """Return value as a utf-8 byte string."""
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return str(value)
+
+    def _Apply(self, meta, changes):
+        """Set the new values on the tags of meta.
+
+        Raises ValueError (before changing anything) if a tag isn't text.
+        """
+        for key in changes:
+            if meta[key].type not in self.TEXT_TYPES:
+                raise ValueError("%s is %s, only text tags can be written"
+                                 % (key, meta[key].type))
+        for key, value in changes.iteritems():
+            tag = meta[key]
+            if key.startswith('Iptc.'):
+                if not isinstance(value, (list, tuple)):
+                    value = [value]
+                tag.raw_value = [self._Str(vv) for vv in value]
+            elif key.startswith('Xmp.') and isinstance(value, (list, tuple)):
+                tag.raw_value = [self._Str(vv) for vv in value]
+            else:
+                tag.raw_value = self._Str(value)
+
+    def Write(self, path, changes):
+        """Apply changes {long tag name: value} to one file.
+
+        Returns (path, tag count, seconds, error message or None).
+        """
+        start = time.time()
+        target = path
+        if self.temp:
+            head, tail = os.path.split(path)
+            target = os.path.join(head, '.%s.%d.tbw' % (tail, os.getpid()))
+        try:
+            if self.temp:
+                shutil.copy2(path, target)
+            meta = self.open_meta(target)
+            meta.read()
+            self._Apply(meta, changes)
+            meta.write()
+            if self.temp:
+                os.rename(target, path)
+        except Exception as inst:   # pyexiv2 raises many types
+            if self.temp:
+                try:
+                    os.unlink(target)
+                except OSError:
+                    pass
+            return (path, 0, time.time() - start, str(inst) or repr(inst))
+        return (path, len(changes), time.time() - start, None)
+
+    def Add(self, path, changes):
+        """Queue changes {long tag name: value} for one file."""
+        if self.jobs <= 1:
+            self.pending.append(self.Write(path, changes))
+        else:
+            if self.pool is None:
+                self.pool = ThreadPool(self.jobs)
+            self.pending.append(
+                self.pool.apply_async(self.Write, (path, changes)))
+        self._Collect(self.MAX_PENDING * self.jobs)
+
+    def _Collect(self, keep):
+        """Wait for results until at most keep files are pending."""
+        while len(self.pending) > keep:
+            result = self.pending.popleft()
+            if not isinstance(result, tuple):
+                result = result.get()
+            path, tags, seconds, err = result
+            self.seconds += seconds
+            if err is None:
+                self.files += 1
+                self.tags += tags
+            else:
+                self.failed += 1
+                if self.error:
+                    self.error("Unable to write tags to %s: %s" % (path, err))
+
+    def Flush(self):
+        """Wait for every queued write to finish."""
+        self._Collect(0)
+
+    def Close(self):
+        """Finish the queued writes and stop the threads."""
+        self.Flush()
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -24,10 +24,22 @@
 #
 # ******************************************************************************
 
+import cPickle
+import csv
+import fnmatch
+import json
 import os
+import shutil
+import string
 import StringIO
 import sys
+import tempfile
+import threading
 import unittest
+try:
+    import numpy
+except ImportError:
+    numpy = None
 try:
     import tagboy
 except ImportError:
@@ -40,6 +52,7 @@ class RegressTests(unittest.TestCase):
              'IMAG0166.jpg', 'butterfly-tagtest.jpg']
     gps_files = 'DSCN0443.JPG', 'IMAG0160.jpg', 'IMAG0166.jpg'
     near_files = 'IMAG0160.jpg', 'IMAG0166.jpg'
+    position_files = 'IMAG0160.jpg', 'IMAG0166.jpg', 'butterfly-tagtest.jpg'
 
     def setUp(self):
         if os.path.isdir('testdata'):
@@ -162,6 +175,1161 @@ class RegressTests(unittest.TestCase):
             self.assert_(fn in output,
                          "Expected '%s' in output: %s" % (fn, output))
 
+    def testJobs(self):
+        """Test that --jobs gives the same output as a single process."""
+        outputs = []
+        for jobs in ('1', '3'):
+            sys.stdout = StringIO.StringIO() # redirect stdout
+            tb = tagboy.TagBoy()
+            options, pos_args = self.parser.parse_args([
+                self.testdata, '--iname', '*.jpg',
+                '--grep', '.', '*GPS*', '--print', '--jobs', jobs])
+            args = tb.HandleArgs(options, pos_args)
+
+            tb.EachDir(self.testdata)
+            tb.DoEnd()
+            outputs.append(sys.stdout.getvalue())
+            sys.stdout.close()      # free memory
+            sys.stdout = self.old_stdout
+
+        for fn in self.gps_files:
+            self.assert_(fn in outputs[1],
+                         "Expected '%s' in output: %s" % (fn, outputs[1]))
+        self.assertEqual(outputs[0], outputs[1],
+                         "--jobs output differs: %s != %s" % tuple(outputs))
+
+    def testCache(self):
+        """Test that a second --cache run doesn't re-read any files."""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for count in range(2):
+                sys.stdout = StringIO.StringIO() # redirect stdout
+                tb = tagboy.TagBoy()
+                options, pos_args = self.parser.parse_args([
+                    self.testdata, '--iname', '*.jpg', '--print',
+                    '--cache', os.path.join(tmp_dir, 'cache.db')])
+                args = tb.HandleArgs(options, pos_args)
+
+                tb.EachDir(self.testdata)
+                tb.DoEnd()
+                output = sys.stdout.getvalue()
+                sys.stdout.close()      # free memory
+                sys.stdout = self.old_stdout
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertEqual(tb.counters.get('cache_miss', 0), 0,
+                         "Unexpected cache misses: %s" % tb.counters)
+        self.assert_(tb.counters.get('cache_hit', 0) >= len(self.files),
+                     "Expected %d cache hits: %s"
+                     % (len(self.files), tb.counters))
+        for fn in self.files:
+            self.assert_(fn in output,
+                         "Expected '%s' in output: %s" % (fn, output))
+
+    def testCacheShared(self):
+        """Test that cache users (e.g. --jobs workers) don't block each other."""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            db_path = os.path.join(tmp_dir, 'cache.db')
+            paths = [os.path.join(tmp_dir, nn) for nn in ('a.jpg', 'b.jpg')]
+            for pp in paths:
+                open(pp, 'w').close()
+            snap = tagboy.MetadataSnapshot(['Exif.Image.Make'], [], [])
+            caches = [tagboy.TagCache(db_path) for ii in range(2)]
+            for cache in caches:
+                cache.TIMEOUT = 1
+            sig = caches[0].Signature(paths[0])
+            caches[0].Store(paths[0], sig, snap)
+            self.assert_(caches[1].Lookup(paths[0], sig) is not None)
+            self.assert_(caches[0].Lookup(paths[0], sig) is not None)
+            caches[1].Store(paths[1], caches[1].Signature(paths[1]), snap)
+
+            pruner = tagboy.TagCache(db_path) # a later run
+            os.remove(paths[1])
+            self.assertEqual(pruner.Prune(), 1)
+            self.assert_(pruner.Lookup(paths[0], sig) is not None)
+            for cache in caches + [pruner]:
+                cache.Close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def testCachePrune(self):
+        """Test that Prune only checks files not seen this run."""
+        tmp_dir = tempfile.mkdtemp()
+        real_exists = os.path.exists
+        checked = []
+        def exists(pp):
+            checked.append(pp)
+            return real_exists(pp)
+        try:
+            db_path = os.path.join(tmp_dir, 'cache.db')
+            paths = [os.path.join(tmp_dir, nn) for nn in ('a.jpg', 'b.jpg')]
+            for pp in paths:
+                open(pp, 'w').close()
+            snap = tagboy.MetadataSnapshot(['Exif.Image.Make'], [], [])
+            cache = tagboy.TagCache(db_path)
+            sigs = [cache.Signature(pp) for pp in paths]
+            for pp, sig in zip(paths, sigs):
+                cache.Store(pp, sig, snap)
+            cache.Close()
+
+            cache = tagboy.TagCache(db_path) # a later run only finds a.jpg
+            self.assert_(cache.Lookup(paths[0], sigs[0]) is not None)
+            os.remove(paths[1])
+            os.path.exists = exists
+            try:
+                self.assertEqual(cache.Prune(), 1)
+            finally:
+                os.path.exists = real_exists
+            self.assertEqual(checked, paths[1:])
+            cache.Close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def testLazyTags(self):
+        """Test that tag values are only converted when used."""
+        converted = []
+        def convert(long_name):
+            converted.append(long_name)
+            return long_name.upper()
+        tags = tagboy.LazyTagDict(convert, {'Make': 'Exif.Image.Make',
+                                            'Exif.Image.Make': 'Exif.Image.Make',
+                                            'Model': 'Exif.Image.Model'})
+        out = string.Template('$Make $Other').safe_substitute(tags)
+        self.assertEqual(out, 'EXIF.IMAGE.MAKE $Other')
+        self.assertEqual(converted, ['Exif.Image.Make'])
+        self.assert_('Model' in tags and 'Other' not in tags)
+        self.assertEqual(len(converted), 1)
+        tags['Model'] = 'X'
+        self.assertEqual(sorted(tags.keys()), ['Exif.Image.Make', 'Make', 'Model'])
+        self.assertEqual(tags['Model'], 'X')
+        self.assertEqual(len(converted), 2)
+
+        revmap = {'Make': 'Exif.Image.Make', 'Model': 'Exif.Image.Model'}
+        tags = tagboy.LazyTagDict(convert, revmap)
+        del tags['Make']        # never converted
+        self.assert_('Make' not in tags)
+        self.assertEqual(tags.pop('Model'), 'EXIF.IMAGE.MODEL')
+        self.assertEqual(tags.keys(), [])
+        self.assertEqual(len(revmap), 2) # shared, not changed
+
+    def testSnapshotSchema(self):
+        """Test that snapshots with the same keys share one schema."""
+        keys = (['Exif.Image.Make', 'Exif.Image.Model'],
+                ['Iptc.Application2.Keywords'], [])
+        tags = {'Exif.Image.Make': ('Canon', 'Canon', None, False, 'Make')}
+        snaps = [tagboy.MetadataSnapshot(*(keys + (tags, ))) for ii in range(3)]
+        snaps.append(cPickle.loads(cPickle.dumps(snaps[0], 2)))
+        snaps.append(cPickle.loads(cPickle.dumps(snaps[0], 0)))
+        snaps.append(tagboy.MetadataSnapshot.FromState(snaps[0].GetState()))
+        for snap in snaps:
+            self.assert_(snap.schema is snaps[0].schema)
+            self.assertEqual(list(snap.exif_keys), keys[0])
+            self.assertEqual(snap['Exif.Image.Make'].human_value, 'Canon')
+            self.assert_('Exif.Image.Make' in snap)
+            self.assert_('Exif.Image.Model' not in snap) # no value copied
+            self.assertEqual(snap.tags, tags)
+        other = tagboy.MetadataSnapshot(keys[0], [], [])
+        self.assert_(other.schema is not snaps[0].schema)
+
+        record = tagboy.TagRecord('a.jpg', snaps[0], {}, None, {'Make': 'X'})
+        record.early = True
+        copy = cPickle.loads(cPickle.dumps(record, 2))
+        self.assertEqual((copy.path, copy.tags, copy.early),
+                         ('a.jpg', {'Make': 'X'}, True))
+        self.assert_(copy.meta.schema is snaps[0].schema)
+
+    def testGlobCache(self):
+        """Test that tag glob expansion is reused for identical key layouts."""
+        sys.stdout = StringIO.StringIO() # redirect stdout
+        fpath = os.path.join(self.testdata, self.files[0])
+        options, pos_args = self.parser.parse_args([
+            fpath, '--grep', '.', '*Make*', '--select', '*Model', '--print'])
+        args = self.tb.HandleArgs(options, pos_args)
+
+        for count in range(3):
+            self.tb.EachFile(fpath)
+        output = sys.stdout.getvalue()
+        sys.stdout.close()      # free memory
+        sys.stdout = self.old_stdout
+
+        self.assertEqual(output.count(fpath), 3,
+                         "Expected 3 matches in output: %s" % output)
+        self.assertEqual(self.tb.counters.get('glob_miss'), 1,
+                         "Expected 1 glob expansion: %s" % self.tb.counters)
+        self.assertEqual(self.tb.counters.get('glob_hit'), 2,
+                         "Expected 2 reused expansions: %s" % self.tb.counters)
+
+    def testKeyMapCache(self):
+        """Test that name mappings are shared, read only, and LRU limited."""
+        options, pos_args = self.parser.parse_args(['--ls'])
+        self.tb.HandleArgs(options, pos_args)
+        self.tb.KEYMAP_CACHE_SIZE = 2
+        keys = (['Exif.Image.Make'], [], ['Xmp.tiff.Make'])
+        first = self.tb.KeyMap(tagboy.MetadataSnapshot(*keys))
+        again = self.tb.KeyMap(tagboy.MetadataSnapshot(*keys))
+        self.assert_(again is first)
+        self.assertEqual(first['Make'], 'Xmp.tiff.Make') # XMP wins
+        self.assertRaises(TypeError, first.__setitem__, 'Make', 'x')
+        self.assertRaises(TypeError, first.update, {})
+        self.assertEqual(cPickle.loads(cPickle.dumps(first, 2)), first)
+
+        self.tb.KeyMap(tagboy.MetadataSnapshot(['Exif.Image.Model'], [], []))
+        self.assert_(self.tb.KeyMap(tagboy.MetadataSnapshot(*keys)) is first)
+        self.tb.KeyMap(tagboy.MetadataSnapshot(['Exif.Image.Artist'], [], []))
+        self.assertEqual(len(self.tb.keymap_cache), 2) # Model was dropped
+        self.assert_(self.tb.KeyMap(tagboy.MetadataSnapshot(*keys)) is first)
+        self.assertEqual(self.tb.counters.get('keymap_miss'), 3)
+        self.assertEqual(self.tb.counters.get('keymap_hit'), 3)
+
+        self.tb.options.long = True # a different mapping
+        self.assert_('Make' not in self.tb.KeyMap(
+            tagboy.MetadataSnapshot(*keys)))
+
+    def testNearFile(self):
+        """Test of --near-file with many places."""
+        tmp_dir = tempfile.mkdtemp()
+        near_file = os.path.join(tmp_dir, 'near.txt')
+        fd = open(near_file, 'w')
+        fd.write("# lat, lon\n")
+        for ii in range(-80, 80):
+            fd.write("%d.5, %d.25\n" % (ii, ii * 2))
+        fd.write("(37.273852, -107.884577)\n")
+        fd.close()
+        sys.stdout = StringIO.StringIO() # redirect stdout
+        options, pos_args = self.parser.parse_args([
+            self.testdata, '--iname', '*.jpg',
+            '--near-file', near_file, '--distance', '5',
+            '--echo', '$_filename is $_distance from $_near'])
+        args = self.tb.HandleArgs(options, pos_args)
+
+        self.tb.EachDir(self.testdata)
+        output = sys.stdout.getvalue()
+        sys.stdout.close()      # free memory
+        sys.stdout = self.old_stdout
+        shutil.rmtree(tmp_dir)
+
+        self.assert_('IMAG0160.jpg' in output, # IMAG0166 is 351km away
+                     "Expected 'IMAG0160.jpg' in output: %s" % output)
+        self.assert_('IMAG0166.jpg' not in output,
+                     "Unexpected 'IMAG0166.jpg' in output: %s" % output)
+        self.assert_("(37.273852, -107.884577)" in output,
+                     "Expected nearest place in output: %s" % output)
+
+    def testPointIndex(self):
+        """Compare PointIndex against checking every point."""
+        points = [(lat / 3.0, lon / 2.0)
+                  for lat in range(-270, 271, 7) for lon in range(-360, 360, 11)]
+        points.append((89.99, 10.0))
+        for radius in (1, 50, 400):
+            index = tagboy.PointIndex(points, radius)
+            for pos in ((0, 0), (37.2, -107.8), (-45.1, 179.9), (45.1, -179.9),
+                        (89.9, -170.0), (10.01, 20.0)):
+                best = None
+                for ii, pp in enumerate(points):
+                    dist = tagboy.distance(pos, pp)
+                    if dist <= radius and (best is None or dist < best[0]):
+                        best = (dist, ii)
+                found = index.Nearest(pos)
+                if best is None:
+                    self.assertEqual(found, None)
+                else:
+                    self.assertEqual(found[1], best[1],
+                                     "%s at %dkm: %s != %s"
+                                     % (pos, radius, found, best))
+
+    def testClustersCrowded(self):
+        """Test that points crowded into a cell aren't all compared."""
+        tbgeo = sys.modules[tagboy.clusters.__module__]
+        compared = [0]
+        real_distance, real_distances = tbgeo.distance, tbgeo.distances
+        def distance(pos1, pos2):
+            compared[0] += 1
+            return real_distance(pos1, pos2)
+        def distances(pos, lats, lons):
+            compared[0] += len(lats)
+            return real_distances(pos, lats, lons)
+        points = [(45.0 + ii * 1e-6, 7.0 + ii * 1e-6) for ii in range(2000)]
+        points += [(45.1 + ii * 1e-6, 7.0) for ii in range(2000)] # 11km away
+        tbgeo.distance, tbgeo.distances = distance, distances
+        try:
+            found = tagboy.clusters(points, 1)
+        finally:
+            tbgeo.distance, tbgeo.distances = real_distance, real_distances
+        self.assertEqual(found, [range(2000), range(2000, 4000)])
+        self.assert_(compared[0] < 2 * len(points), # not n squared
+                     "%d distances" % compared[0])
+
+    def testClusters(self):
+        """Compare GPS clusters against linking every close pair."""
+        points = [(lat / 500.0, lon / 400.0)
+                  for lat in range(-20, 20, 3) for lon in range(-25, 25, 4)]
+        points += [(80.0, 179.999), (80.0, -179.999), (80.0, 179.9),
+                   (-60.0, 1.0), (-60.0, 1.0)]
+        for radius in (0.01, 0.05, 1, 4):
+            expect = list()
+            todo = range(len(points))
+            while todo:         # connected components, the slow way
+                group, edge = [todo.pop(0)], 0
+                while edge < len(group):
+                    near = [jj for jj in todo if tagboy.distance(
+                            points[group[edge]], points[jj]) <= radius]
+                    group.extend(near)
+                    todo = [jj for jj in todo if jj not in near]
+                    edge += 1
+                expect.append(sorted(group))
+            self.assertEqual(tagboy.clusters(points, radius), expect,
+                             "Clusters differ at %gkm" % radius)
+
+        sys.stdout = StringIO.StringIO() # redirect stdout
+        options, pos_args = self.parser.parse_args([
+            self.testdata, '--iname', '*.jpg', '--cluster-gps', '30'])
+        args = self.tb.HandleArgs(options, pos_args)
+        self.tb.EachDir(self.testdata)
+        self.tb.DoEnd()
+        output = sys.stdout.getvalue()
+        sys.stdout.close()      # free memory
+        sys.stdout = self.old_stdout
+        places = output.split('@@ ')[1:] # all far apart (0/0 has no position)
+        self.assertEqual(len(places), len(self.position_files),
+                         "Expected %d places: %s"
+                         % (len(self.position_files), output))
+        for fn in self.position_files:
+            alone = [pp for pp in places if fn in pp and '(1 files)' in pp]
+            self.assertEqual(len(alone), 1, "Expected %s alone: %s"
+                             % (fn, output))
+
+    def testFastRead(self):
+        """Test of --fast-read with grep, near, and echo."""
+        sys.stdout = StringIO.StringIO() # redirect stdout
+        options, pos_args = self.parser.parse_args([
+            self.testdata, '--iname', '*.jpg', '--fast-read',
+            '--grep', '.', 'Make',
+            '--near', '(37.273852, -107.884577)', '--distance', '999',
+            '--echo', '$_filename by ${Make} is $_distance'])
+        args = self.tb.HandleArgs(options, pos_args)
+
+        self.tb.EachDir(self.testdata)
+        output = sys.stdout.getvalue()
+        sys.stdout.close()      # free memory
+        sys.stdout = self.old_stdout
+
+        self.assert_(self.tb.counters.get('fast_read', 0) >= len(self.files),
+                     "Expected %d fast reads: %s"
+                     % (len(self.files), self.tb.counters))
+        for fn in self.near_files:
+            self.assert_(fn + ' by HTC is' in output,
+                         "Expected '%s' in output: %s" % (fn, output))
+
+    def testFastReadDamaged(self):
+        """Test that --fast-read skips a truncated Photoshop (IPTC) segment."""
+        resources = '8BIM\x04\x04\x05abcde\x00\x00' # no room for the size
+        segment = 'Photoshop 3.0\x00' + resources
+        fd, fpath = tempfile.mkstemp(suffix='.jpg')
+        os.write(fd, '\xff\xd8\xff\xed%s%s\xff\xd9' % (
+            chr((len(segment) + 2) >> 8) + chr((len(segment) + 2) & 0xff),
+            segment))
+        os.close(fd)
+        try:
+            options, pos_args = self.parser.parse_args([fpath, '--fast-read'])
+            args = self.tb.HandleArgs(options, pos_args)
+            meta = self.tb.ReadMetadata(fpath)
+        finally:
+            os.remove(fpath)
+        self.assertEqual(self.tb.counters.get('fast_read'), 1)
+        self.assertEqual(len(meta), 0)
+
+    def testExecJobs(self):
+        """Test that concurrent --exec failures are collected."""
+        options, pos_args = self.parser.parse_args([
+            self.testdata, '--iname', '*.jpg',
+            '--exec', 'test ! -f $_filepath', '--exec-jobs', '3'])
+        args = self.tb.HandleArgs(options, pos_args)
+
+        self.tb.EachDir(self.testdata)
+        self.tb.DoEnd()
+
+        self.assertEqual(self.tb.exec_count, self.tb.match_count)
+        self.assertEqual(len(self.tb.exec_failures), self.tb.match_count,
+                         "Expected %d failures: %s"
+                         % (self.tb.match_count, self.tb.exec_failures))
+
+    def testExecBatch(self):
+        """Test that --exec-batch appends paths to each command."""
+        options, pos_args = self.parser.parse_args([
+            self.testdata, '--iname', '*.jpg',
+            '--exec', 'false', '--exec-batch', '4'])
+        args = self.tb.HandleArgs(options, pos_args)
+
+        self.tb.EachDir(self.testdata)
+        self.tb.DoEnd()
+
+        self.assert_(self.tb.match_count >= len(self.files))
+        self.assertEqual(self.tb.exec_count, (self.tb.match_count + 3) // 4)
+        self.assertEqual(len(self.tb.exec_failures), self.tb.exec_count,
+                         "Every false command should fail: %s"
+                         % self.tb.exec_failures)
+        counts = [cmd.count(self.testdata) for cmd, status
+                  in self.tb.exec_failures]
+        self.assertEqual(sum(counts), self.tb.match_count)
+        self.assert_(max(counts) == 4, "Expected batches of 4: %s" % counts)
+
+    def testSymSync(self):
+        """Test that --symsync only changes links that need it."""
+        link_dir = tempfile.mkdtemp()
+        keep_path = os.path.abspath(os.path.join(self.testdata, self.files[0]))
+        keep_link = os.path.join(link_dir, self.files[0])
+        os.symlink(keep_path, keep_link)
+        keep_inode = os.lstat(keep_link).st_ino
+        os.symlink('/no/such/file.jpg', os.path.join(link_dir, 'old.jpg'))
+        options, pos_args = self.parser.parse_args([
+            self.testdata, '--iname', '*.jpg',
+            '--symlink', link_dir, '--symsync'])
+        args = self.tb.HandleArgs(options, pos_args)
+
+        self.tb.EachDir(self.testdata)
+        self.tb.DoEnd()
+        links = sorted(os.listdir(link_dir))
+        inode = os.lstat(keep_link).st_ino
+        shutil.rmtree(link_dir)
+
+        self.assertEqual(inode, keep_inode, "Unchanged link was replaced")
+        self.assert_('old.jpg' not in links, "Stale link not removed: %s" % links)
+        for fn in self.files:
+            self.assert_(fn in links, "Expected '%s' in %s" % (fn, links))
+        self.assertEqual(len(links), self.tb.match_count)
+
+        link_dir = tempfile.mkdtemp()  # a failed link doesn't stop the rest
+        try:
+            self.tb = tagboy.TagBoy()
+            options, pos_args = tagboy.ArgParser().parse_args([
+                self.testdata, '--symlink', link_dir, '--symsync'])
+            args = self.tb.HandleArgs(options, pos_args)
+            self.tb.sym_links = {'no/such.jpg': keep_path, 'x.jpg': keep_path,
+                                 'y.jpg': keep_path}
+            sys.stderr = StringIO.StringIO()
+            result = self.tb.SymSync()
+            sys.stderr = self.old_stderr
+            self.assertEqual(result, (2, 0, 0))
+            self.assertEqual(sorted(os.listdir(link_dir)), ['x.jpg', 'y.jpg'])
+        finally:
+            shutil.rmtree(link_dir)
+
+    def testWalkDir(self):
+        """Test walk pruning and that --walk-jobs keeps the walk order."""
+        top = tempfile.mkdtemp()
+        for dd in ('a/b/c', 'a/.hidden', 'd', '.e'):
+            os.makedirs(os.path.join(top, dd))
+        for fn in ('1.jpg', 'a/2.jpg', 'a/b/3.jpg', 'a/b/c/4.jpg',
+                   'a/.hidden/5.jpg', 'd/6.jpg', 'd/7.txt', '.e/8.jpg'):
+            open(os.path.join(top, fn), 'w').close()
+        os.symlink(os.path.join(top, 'a'), os.path.join(top, 'link'))
+        walks = []
+        for extra in ([], ['--walk-jobs', '4'], ['--maxdepth', '1']):
+            self.tb = tagboy.TagBoy()
+            options, pos_args = self.parser.parse_args(
+                [top, '--iname', '*.jpg'] + extra)
+            args = self.tb.HandleArgs(options, pos_args)
+            walks.append([os.path.relpath(fn, top)
+                          for fn in self.tb.WalkDir(top + os.sep)])
+            self.tb.DoEnd()
+        shutil.rmtree(top)
+
+        self.assertEqual(sorted(walks[0]),
+                         ['1.jpg', 'a/2.jpg', 'a/b/3.jpg', 'a/b/c/4.jpg',
+                          'd/6.jpg'])
+        self.assertEqual(walks[1], walks[0])
+        self.assertEqual(sorted(walks[2]), ['1.jpg', 'a/2.jpg', 'd/6.jpg'])
+
+    def testNameMatcher(self):
+        """Test that NameMatcher agrees with fnmatch for every glob."""
+        globs = ['*.jpg', '*.JPG', 'IMG_*', 'DSC?????.jpg', '*.[ch]', '*',
+                 '*.tar.gz', '*[!0-9].png', 'a+b(c).txt', '*.', '']
+        names = ['x.jpg', 'X.JPG', 'x.Jpg', 'IMG_1.cr2', 'img_1.cr2',
+                 'DSCF2132.jpg', 'DSCF213.jpg', 'm.c', 'm.h', 'm.cc',
+                 'a.tar.gz', 'a.gz', 'a.png', '1.png', 'a+b(c).txt',
+                 'abbc.txt', 'x.', '', 'new\nline.jpg', '.jpg']
+        for gg in globs:
+            for case_globs, icase_globs in (([gg], []), ([], [gg]),
+                                            (globs, []), ([], globs)):
+                matcher = tagboy.NameMatcher(case_globs, icase_globs)
+                for nn in names:
+                    expected = (
+                        any(fnmatch.fnmatchcase(nn, cc) for cc in case_globs)
+                        or any(fnmatch.fnmatchcase(nn.lower(), cc.lower())
+                               for cc in icase_globs))
+                    self.assertEqual(matcher(nn), expected,
+                                     "%r %r %r" % (case_globs, icase_globs, nn))
+        self.assert_(tagboy.NameMatcher()('anything'))
+
+    def testFormat(self):
+        """Test --format jsonl, csv, and print0 output."""
+        outputs = dict()
+        for fmt, select in (('jsonl', 'Make;Model'), ('csv', 'Model;_filename'),
+                            ('print0', 'Model')):
+            sys.stdout = StringIO.StringIO() # redirect stdout
+            self.tb = tagboy.TagBoy()
+            options, pos_args = tagboy.ArgParser().parse_args([
+                self.testdata, '--iname', '*.jpg', '--format', fmt,
+                '--select', select])
+            args = self.tb.HandleArgs(options, pos_args)
+            self.tb.EachDir(self.testdata)
+            self.tb.DoEnd()
+            outputs[fmt] = sys.stdout.getvalue(), self.tb.match_count
+            sys.stdout.close()      # free memory
+            sys.stdout = self.old_stdout
+
+        output, count = outputs['jsonl']
+        records = [json.loads(ll) for ll in output.splitlines()]
+        self.assertEqual(len(records), count)
+        names = set(os.path.basename(rr['path']) for rr in records)
+        self.assert_(set(self.files) <= names, "Missing files in %s" % names)
+        for rr in records:
+            self.assert_(set(rr.keys()) <= set(['path', 'Make', 'Model']),
+                         "Unexpected keys: %s" % rr.keys())
+        output, count = outputs['csv']
+        rows = list(csv.reader(StringIO.StringIO(output)))
+        self.assertEqual(rows[0], ['path', 'Model', '_filename'])
+        self.assertEqual(len(rows), count + 1)
+        for rr in rows[1:]:
+            self.assertEqual(os.path.basename(rr[0]), rr[2])
+        output, count = outputs['print0']
+        paths = output.split('\0')
+        self.assertEqual(paths[-1], '')
+        self.assertEqual(len(paths) - 1, count)
+
+        sys.stdout = StringIO.StringIO() # redirect stdout
+        self.tb = tagboy.TagBoy()
+        options, pos_args = tagboy.ArgParser().parse_args([
+            '.', '--format', 'jsonl', '--select', 'Keywords;Make'])
+        args = self.tb.HandleArgs(options, pos_args)
+        keywords = ['beach', u'caf\xe9']
+        snap = tagboy.MetadataSnapshot(
+            ['Exif.Image.Make'], ['Iptc.Application2.Keywords'], [],
+            {'Exif.Image.Make': ('HTC', 'HTC', None, False, 'Make'),
+             'Iptc.Application2.Keywords': (keywords, keywords, keywords,
+                                            True, 'Keywords')})
+        self.tb.FinishFile(self.tb.ScanMetadata('a.jpg', snap))
+        self.tb.DoEnd()
+        output = sys.stdout.getvalue()
+        sys.stdout.close()      # free memory
+        sys.stdout = self.old_stdout
+        self.assertEqual(json.loads(output),
+                         {'path': 'a.jpg', 'Make': 'HTC', 'Keywords': keywords})
+
+    def testTable(self):
+        """Test --table column types, masks, and vocabularies."""
+        if numpy is None:
+            self.skipTest("numpy isn't installed")
+        tmpdir = tempfile.mkdtemp()
+        try:
+            table = tagboy.TagTable()
+            table.Add('a', [('Width', '640'), ('Exposure', '0.5'),
+                            ('Make', 'Canon')], (1.5, -2.0))
+            table.Add('b', [('Make', 'Nikon'), ('Width', '800')])
+            table.Add('c', [('Make', 'Canon'), ('Exposure', '2')])
+            table.Save(os.path.join(tmpdir, 'unit.npz'))
+            data = numpy.load(os.path.join(tmpdir, 'unit.npz'))
+            self.assertEqual(list(data['path']), ['a', 'b', 'c'])
+            self.assertEqual(list(data['_columns']),
+                             ['Width', 'Exposure', 'Make'])
+            self.assertEqual(data['Width'].dtype, numpy.int64)
+            self.assertEqual(list(data['Width'][:2]), [640, 800])
+            self.assertEqual(list(data['Width:mask']), [False, False, True])
+            self.assertEqual(data['Exposure'].dtype, numpy.float64)
+            self.assertEqual(list(data['Exposure:mask']), [False, True, False])
+            self.assertEqual(data['Exposure'][2], 2.0)
+            vocab = data['Make:vocab']
+            self.assertEqual([vocab[cc] for cc in data['Make']],
+                             ['Canon', 'Nikon', 'Canon'])
+            self.assertEqual(data['lat'][0], 1.5)
+            self.assert_(numpy.isnan(data['lon'][1]))
+
+            out = os.path.join(tmpdir, 'run.npz')
+            options, pos_args = self.parser.parse_args([
+                self.testdata, '--iname', '*.jpg', '--select', 'Model',
+                '--table', out])
+            args = self.tb.HandleArgs(options, pos_args)
+            self.tb.EachDir(self.testdata)
+            self.tb.DoEnd()
+            data = numpy.load(out)
+            self.assertEqual(len(data['path']), self.tb.match_count)
+            self.assertEqual(list(data['_columns']), ['Model'])
+            gps = set(os.path.basename(pp) for pp, lat
+                      in zip(data['path'], data['lat']) if not numpy.isnan(lat))
+            self.assertEqual(gps, set(self.position_files))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testAggregates(self):
+        """Test --count-tags and --distinct-values, with and without --jobs."""
+        outputs = list()
+        for jobs in ('1', '2'):
+            sys.stdout = StringIO.StringIO() # redirect stdout
+            self.tb = tagboy.TagBoy()
+            options, pos_args = tagboy.ArgParser().parse_args([
+                self.testdata, '--iname', 'IMAG*.jpg', '--select', 'Model;*Lat*',
+                '--count-tags', '--distinct-values', '--jobs', jobs])
+            args = self.tb.HandleArgs(options, pos_args)
+            self.tb.EachDir(self.testdata)
+            self.tb.DoEnd()
+            outputs.append(sys.stdout.getvalue())
+            sys.stdout.close()      # free memory
+            sys.stdout = self.old_stdout
+
+        self.assertEqual(outputs[0], outputs[1])
+        lines = outputs[0].splitlines()
+        counts = dict(ll.strip().split(': ') for ll in lines
+                      if ll.startswith(' '))
+        self.assertEqual(counts['Exif.Image.Model'], '3')
+        self.assertEqual(counts['Exif.GPSInfo.GPSLatitude'], '2')
+        self.assert_('Model' not in counts, "Short name counted: %s" % counts)
+        self.assertEqual(lines.count("Looked at 3 files"), 2)
+        changed = lines.index("These tags changed:")
+        self.assert_("== Exif.GPSInfo.GPSLatitudeRef: North"
+                     in lines[:changed], "Missing unchanged tag: %s" % lines)
+        self.assert_("=== Exif.GPSInfo.GPSLatitude (2):" in lines[changed:],
+                     "Missing changed tag: %s" % lines)
+
+    def testDistinctShortened(self):
+        """Test that --distinct-values compares values as tb-tagdiff did."""
+        tbcore = sys.modules[tagboy.TagBoy.__module__]
+        distinct = tbcore.DistinctValues()
+        for tail in ('a', 'b'):     # same first 80 characters
+            distinct.Add({'Exif.Photo.MakerNote': 'x' * 80 + tail,
+                          'Exif.Image.Model': tail}, ['Exif.Photo.MakerNote',
+                                                      'Exif.Image.Model'])
+        lines = distinct.Report(2)
+        self.assert_("== Exif.Photo.MakerNote: %s..." % ('x' * 80) in lines,
+                     "Expected one shortened value: %s" % lines)
+        self.assert_("=== Exif.Image.Model (2):\n\"a\", \"b\"" in lines,
+                     "Expected two values: %s" % lines)
+
+    def testThumbnails(self):
+        """Test --thumbnails picks the largest preview and skips current ones."""
+        class Preview(object):
+            def __init__(self, data, dimensions):
+                self.data, self.dimensions = data, dimensions
+                self.size, self.extension = len(data), '.jpg'
+
+        class Meta(object):
+            previews = [Preview('small', (160, 120)),
+                        Preview('large', (1600, 1200)),
+                        Preview('middle', (640, 480))]
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            outdir = os.path.join(tmpdir, 'thumbs')
+            image = os.path.join(tmpdir, 'photo.jpg')
+            with open(image, 'w') as fp:
+                fp.write('image')
+            options, pos_args = self.parser.parse_args([
+                image, '--thumbnails', outdir])
+            args = self.tb.HandleArgs(options, pos_args)
+            self.assert_(os.path.isdir(outdir))
+
+            out = self.tb.Thumbnail(image, Meta())
+            name = os.path.basename(out)
+            self.assert_(name.startswith('photo-') and name.endswith('.jpg'),
+                         "Unexpected thumbnail name: %s" % name)
+            with open(out) as fp:
+                self.assertEqual(fp.read(), 'large')
+            self.assertEqual(self.tb.Thumbnail(image, Meta()), None)
+            self.assertEqual(self.tb.counters['thumb_current'], 1)
+            past = os.stat(image).st_mtime - 10
+            os.utime(out, (past, past)) # image changed since
+            self.assertEqual(self.tb.Thumbnail(image, Meta()), out)
+            self.assertEqual(self.tb.counters['thumb_written'], 2)
+            self.assertEqual(os.listdir(outdir), [name])
+
+            others = [os.path.join(tmpdir, 'b', 'photo.jpg'), # same names
+                      os.path.join(tmpdir, 'photo.cr2')]
+            os.mkdir(os.path.join(tmpdir, 'b'))
+            for other in others:
+                with open(other, 'w') as fp:
+                    fp.write('image')
+                self.assert_(self.tb.Thumbnail(other, Meta()) not in (None, out))
+            self.assertEqual(self.tb.counters['thumb_written'], 4)
+            self.assertEqual(len(os.listdir(outdir)), 3)
+
+            self.tb = tagboy.TagBoy() # no previews in the test images
+            options, pos_args = tagboy.ArgParser().parse_args([
+                self.testdata, '--iname', '*.jpg', '--thumbnails', outdir,
+                '--jobs', '2', '--stats-json', os.path.join(tmpdir, 's.json')])
+            args = self.tb.HandleArgs(options, pos_args)
+            self.tb.EachDir(self.testdata)
+            self.tb.DoEnd()
+            with open(os.path.join(tmpdir, 's.json')) as fp:
+                counters = json.load(fp)['counters']
+            self.assertEqual(counters.get('thumb_none', 0)
+                             + counters.get('thumb_written', 0),
+                             self.tb.match_count)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testWrite(self):
+        """Test the --eval change diff and TagWriter."""
+        sys.stderr = StringIO.StringIO() # redirect stderr
+        options, pos_args = self.parser.parse_args([
+            self.testdata, '--iname', 'IMAG*.jpg',
+            '--eval', 'tags["Model"] = "New"; tags["Make"] = tags["Make"]'])
+        args = self.tb.HandleArgs(options, pos_args)
+        self.tb.EachDir(self.testdata)
+        self.tb.DoEnd()
+        output = sys.stderr.getvalue()
+        sys.stderr.close()      # free memory
+        sys.stderr = self.old_stderr
+        self.assertEqual(output.count("+Exif.Image.Model: New"), 3)
+        self.assert_("Make" not in output, "Unchanged tag shown: %s" % output)
+        self.assert_("Dry run: 3 tags changed in 3 files" in output,
+                     "Expected dry run summary: %s" % output)
+
+        class Tag(object):
+            raw_value = 'old'
+            def __init__(self, type):
+                self.type = type
+
+        class Meta(object):
+            written = dict()    # path -> {key: value}
+            def __init__(self, path):
+                self.path = path
+                self.tags = {'Exif.Image.Model': Tag('Ascii'),
+                             'Exif.GPSInfo.GPSAltitude': Tag('Rational'),
+                             'Iptc.Application2.Keywords': Tag('String')}
+            def read(self):
+                pass
+            def __getitem__(self, key):
+                return self.tags[key]
+            def write(self):
+                if 'bad' in self.path:
+                    raise IOError("can't write")
+                self.written[self.path] = dict(
+                    (kk, tt.raw_value) for kk, tt in self.tags.iteritems()
+                    if tt.raw_value != 'old')
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            image = os.path.join(tmpdir, 'photo.jpg')
+            with open(image, 'w') as fp:
+                fp.write('image')
+            errors = list()
+            writer = tagboy.TagWriter(Meta, jobs=2, temp=True,
+                                      error=errors.append)
+            writer.Add(image, {'Exif.Image.Model': 'New',
+                               'Iptc.Application2.Keywords': 'one'})
+            writer.Add(os.path.join(tmpdir, 'bad.jpg'),
+                       {'Exif.Image.Model': 'New'})
+            writer.Add(image, {'Exif.Image.Model': 'New', # not text
+                               'Exif.GPSInfo.GPSAltitude': '100 m'})
+            writer.Close()
+            self.assertEqual((writer.files, writer.tags, writer.failed),
+                             (1, 2, 2))
+            self.assertEqual(len(errors), 2)
+            self.assert_("GPSAltitude is Rational" in errors[1],
+                         "Expected a type error: %s" % errors)
+            temp_path, = Meta.written.keys() # the copy was changed...
+            self.assertNotEqual(temp_path, image)
+            self.assertEqual(Meta.written[temp_path],
+                             {'Exif.Image.Model': 'New',
+                              'Iptc.Application2.Keywords': ['one']})
+            self.assertEqual(os.listdir(tmpdir), ['photo.jpg']) # ...and renamed
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testJournal(self):
+        """Test that a --journal run can be interrupted and resumed."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            journal = os.path.join(tmpdir, 'journal')
+            args = [self.testdata, '--iname', '*.jpg', '--journal', journal,
+                    '--begin', 'global seen; seen = []',
+                    '--eval', 'seen.append(filename)',
+                    '--end', 'print sorted(seen)', '--distinct-values']
+            outputs = list()
+            for run in range(3):
+                sys.stdout = StringIO.StringIO() # redirect stdout
+                sys.stderr = StringIO.StringIO()
+                self.tb = tagboy.TagBoy()
+                options, pos_args = tagboy.ArgParser().parse_args(args)
+                self.tb.HandleArgs(options, pos_args)
+                self.tb.journal.BATCH_FILES = 2
+                if run == 0:    # stop part way through
+                    paths = list(self.tb.WalkDir(self.testdata))
+                    for fn in paths[:3]:
+                        self.tb.EachFile(fn)
+                    self.tb.Suspend()
+                    with open(journal) as fp:
+                        kinds = [line.split('\t')[0] for line in fp]
+                    saved = os.path.exists(journal + '.state')
+                else:
+                    self.tb.EachDir(self.testdata)
+                    self.tb.DoEnd()
+                outputs.append((sys.stdout.getvalue(), self.tb.file_count,
+                                self.tb.counters.get('journal_skip', 0)))
+                sys.stdout.close()      # free memory
+                sys.stdout = self.old_stdout
+                sys.stderr = self.old_stderr
+
+            first, resumed, fresh = outputs
+            self.assertEqual(first[0], '') # no --end yet
+            self.assertEqual(kinds, ['F', 'F', 'C', 'F', 'C']) # no state
+            self.assert_(saved, "Expected a state file")
+            self.assert_(not os.path.exists(journal + '.state'))
+            self.assertEqual(resumed[1], len(paths))
+            self.assertEqual(resumed[2], 3)
+            self.assertEqual(fresh[2], 0) # the finished journal starts over
+            self.assertEqual(resumed[0], fresh[0])
+            self.assert_(str(sorted(os.path.basename(pp) for pp in paths))
+                         in resumed[0], "Expected all files: %s" % resumed[0])
+
+            sys.stderr = StringIO.StringIO()
+            options, pos_args = tagboy.ArgParser().parse_args(
+                args + ['--symlink', tmpdir, '--symclear'])
+            self.assertRaises(SystemExit, tagboy.TagBoy().HandleArgs,
+                              options, pos_args) # would undo the first run
+            sys.stderr = self.old_stderr
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testJournalFiles(self):
+        """Test that resuming skips journaled file (and --use-index) arguments."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            journal = os.path.join(tmpdir, 'journal')
+            index = os.path.join(tmpdir, 'index.db')
+            paths = [os.path.join(self.testdata, fn) for fn in self.files]
+            for extra, use_index in ((['--build-index', index], False),
+                                     (['--use-index', index], True)):
+                args = paths + ['--journal', journal,
+                                '--begin', 'global seen; seen = []',
+                                '--eval', 'seen.append(filename)',
+                                '--end', 'print len(seen)'] + extra
+                for run in range(2):
+                    sys.stdout = StringIO.StringIO() # redirect stdout
+                    self.tb = tagboy.TagBoy()
+                    first = ['--iname', 'IMAG*'] if run == 0 else []
+                    options, pos_args = tagboy.ArgParser().parse_args(
+                        args + first)
+                    pargs = self.tb.HandleArgs(options, pos_args)
+                    if use_index:
+                        pargs = [self.testdata]
+                    elif run == 0:
+                        pargs = pargs[:2] # stop part way through
+                    for parg in pargs:
+                        self.tb.EachArg(parg)
+                    if run == 0:
+                        self.tb.Suspend()
+                    else:
+                        self.tb.DoEnd()
+                    output = sys.stdout.getvalue()
+                    sys.stdout.close()      # free memory
+                    sys.stdout = self.old_stdout
+                skipped = self.tb.counters.get('journal_skip', 0)
+                self.assert_(skipped > 0, "Expected skips: %s" % self.tb.counters)
+                self.assertEqual(output, "%d\n" % len(paths))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testJournalState(self):
+        """Test that a crash between saving state and checkpointing is safe."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            journal = os.path.join(tmpdir, 'journal')
+            first = tagboy.TagBoy()
+            options, pos_args = tagboy.ArgParser().parse_args([
+                self.testdata, '--journal', journal])
+            first.HandleArgs(options, pos_args)
+            Journal = type(first.journal)
+            for fn in ('a', 'b'):
+                first.journal.Add(fn)
+            first.journal.Checkpoint({'n': 2})
+            first.journal.Add('c')
+            first.journal.fp.write('F\tc\n') # paths synced...
+            first.journal.fp.flush()
+            first.journal.number += 1
+            first.journal._SaveState({'n': 3}) # ...state saved, then a crash
+            first.journal.fp.close()
+
+            resumed = Journal(journal)
+            self.assertEqual(sorted(resumed.done), ['a', 'b', 'c'])
+            self.assertEqual(resumed.state, {'n': 3})
+            resumed.Add('d')
+            resumed.Checkpoint({'n': 4})
+            resumed.Close()
+            again = Journal(journal)
+            self.assertEqual(sorted(again.done), ['a', 'b', 'c', 'd'])
+            self.assertEqual(again.state, {'n': 4})
+            again.Close(ended=True)
+            self.assertEqual(Journal(journal).done, set())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testStats(self):
+        """Test that --stats-json counts phases, including from --jobs."""
+        fd, stats_path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        sys.stderr = StringIO.StringIO() # redirect stderr
+        options, pos_args = self.parser.parse_args([
+            self.testdata, '--iname', '*.jpg', '--grep', '.', 'Make',
+            '--jobs', '2', '--stats-json', stats_path])
+        args = self.tb.HandleArgs(options, pos_args)
+        self.tb.EachDir(self.testdata)
+        self.tb.DoEnd()
+        report = sys.stderr.getvalue()
+        sys.stderr.close()      # free memory
+        sys.stderr = self.old_stderr
+        with open(stats_path) as fd:
+            stats = json.load(fd)
+        os.remove(stats_path)
+
+        self.assert_(report.startswith('Stats: '), "No report: %s" % report)
+        self.assertEqual(stats['files'], self.tb.file_count)
+        self.assertEqual(stats['matched'], self.tb.match_count)
+        self.assertEqual(stats['phases']['read']['calls'], self.tb.file_count)
+        self.assertEqual(stats['phases']['grep']['calls'], self.tb.file_count)
+        self.assert_('glob_miss' in stats['counters'],
+                     "Missing counters: %s" % stats['counters'])
+
+    def testIndex(self):
+        """Test that --use-index finds the same files as reading them."""
+        fd, index_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        os.remove(index_path)   # --build-index creates it
+        queries = (['--grep', '.', '*GPS*'],
+                   ['--near', '(37.273852, -107.884577)', '--distance', '999'],
+                   ['-i', '--grep', '2011', '*DateTime*'])
+
+        def Run(args):
+            sys.stdout = StringIO.StringIO() # redirect stdout
+            tb = tagboy.TagBoy()
+            options, pos_args = tagboy.ArgParser().parse_args(
+                [self.testdata, '--iname', '*.jpg', '--print'] + args)
+            for parg in tb.HandleArgs(options, pos_args):
+                if options.use_index:
+                    tb.EachIndexed(parg)
+                else:
+                    tb.EachDir(parg)
+            tb.DoEnd()
+            output = sys.stdout.getvalue()
+            sys.stdout.close()      # free memory
+            sys.stdout = self.old_stdout
+            return sorted(output.splitlines())
+
+        built = Run(['--build-index', index_path, '--jobs', '2'])
+        results = [(Run(qq), Run(qq + ['--use-index', index_path]))
+                   for qq in queries]
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(index_path + suffix):
+                os.remove(index_path + suffix)
+
+        self.assert_(set(self.files) <= set(os.path.basename(pp) for pp in built),
+                     "Expected all files in %s" % built)
+        for query, (read, indexed) in zip(queries, results):
+            self.assert_(read, "Expected matches for %s" % query)
+            self.assertEqual(indexed, read)
+
+    def testIndexShared(self):
+        """Test that index writers (e.g. --jobs workers) don't block each other."""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            db_path = os.path.join(tmp_dir, 'index.db')
+            snap = tagboy.MetadataSnapshot(['Exif.Image.Make'], [], [])
+            rows = [('Exif.Image.Make', 'Make', 'Canon')]
+            indexes = [tagboy.TagIndex(db_path) for ii in range(2)]
+            for index in indexes:
+                index.TIMEOUT = 1
+            indexes[0].Store('a.jpg', snap, None, rows)
+            indexes[1].Store('b.jpg', snap, (1.0, 2.0), rows)
+            indexes[0].Store('a.jpg', snap, None, rows) # replaced
+            found = sorted(pp for pp, meta in indexes[1].Query(tmp_dir))
+            self.assertEqual(found, [])  # not under tmp_dir
+            found = sorted(pp for pp, meta in indexes[1].Query('.'))
+            self.assertEqual(found, ['a.jpg', 'b.jpg'])
+            for index in indexes:
+                index.Close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def testWatch(self):
+        """Test that --watch handles new files (inotify and polling)."""
+        src = os.path.join(self.testdata, self.files[0])
+        for extra in ([], ['--watch-poll']):
+            top = tempfile.mkdtemp()
+            sys.stdout = StringIO.StringIO() # redirect stdout
+            self.tb = tagboy.TagBoy()
+            options, pos_args = tagboy.ArgParser().parse_args(
+                [top, '--iname', '*.jpg', '--print', '--watch',
+                 '--watch-delay', '0.2'] + extra)
+            args = self.tb.HandleArgs(options, pos_args)
+            self.tb.EachDir(top)
+            copier = threading.Timer(0.3, lambda: (
+                os.mkdir(os.path.join(top, 'new')),
+                shutil.copy(src, os.path.join(top, 'new', 'a.jpg')),
+                shutil.copy(src, os.path.join(top, 'b.txt'))))
+            copier.start()
+            self.tb.Watch([top], batches=1, seconds=10)
+            copier.join()
+            self.tb.DoEnd()
+            output = sys.stdout.getvalue()
+            sys.stdout.close()      # free memory
+            sys.stdout = self.old_stdout
+            shutil.rmtree(top)
+
+            self.assertEqual(output.splitlines(),
+                             [os.path.join(top, 'new', 'a.jpg')],
+                             "%s: %r" % (extra, output))
+
+    def testWatchStart(self):
+        """Test that --watch sees files added before Watch() starts."""
+        src = os.path.join(self.testdata, self.files[0])
+        for extra in ([], ['--watch-poll']):
+            top = tempfile.mkdtemp()
+            sys.stdout = StringIO.StringIO() # redirect stdout
+            self.tb = tagboy.TagBoy()
+            options, pos_args = tagboy.ArgParser().parse_args(
+                [top, '--iname', '*.jpg', '--print', '--watch',
+                 '--watch-delay', '0.2'] + extra)
+            args = self.tb.HandleArgs(options, pos_args)
+            self.tb.StartWatch([top])
+            self.tb.EachDir(top)
+            shutil.copy(src, os.path.join(top, 'late.jpg')) # walk is past it
+            self.tb.Watch([top], batches=1, seconds=10)
+            self.tb.DoEnd()
+            output = sys.stdout.getvalue()
+            sys.stdout.close()      # free memory
+            sys.stdout = self.old_stdout
+            shutil.rmtree(top)
+
+            self.assertEqual(output.splitlines(),
+                             [os.path.join(top, 'late.jpg')],
+                             "%s: %r" % (extra, output))
+
+    def testTagDemand(self):
+        """Test that only the tags used are decoded, with the same output."""
+        query = [self.testdata, '--iname', '*.jpg', '--fast-read',
+                 '--echo', '$_filename $Model', '--grep', '.', '*Make',
+                 '--eval', 'skip = tags.get("DateTimeOriginal") is None']
+        outputs = []
+        for extra in ([], ['--eval', 'x = len(tags)']): # 2nd uses all tags
+            sys.stdout = StringIO.StringIO() # redirect stdout
+            self.tb = tagboy.TagBoy()
+            options, pos_args = tagboy.ArgParser().parse_args(query + extra)
+            args = self.tb.HandleArgs(options, pos_args)
+            self.tb.EachDir(self.testdata)
+            outputs.append(sys.stdout.getvalue())
+            sys.stdout.close()      # free memory
+            sys.stdout = self.old_stdout
+            if not extra:
+                demand = self.tb.demand
+
+        self.assert_(demand is not None, "Expected a TagDemand")
+        for key in ('Exif.Image.Model', 'Exif.Image.Make',
+                    'Exif.Photo.DateTimeOriginal'):
+            self.assert_(demand.Wants(key), "Expected %s in %s" % (key, demand))
+        self.assert_(not demand.Wants('Exif.Image.Orientation'),
+                     "Unexpected Orientation in %s" % demand)
+        self.assert_(self.tb.demand is None, "Expected all tags for len(tags)")
+        self.assert_(outputs[0], "Expected output")
+        self.assertEqual(outputs[0], outputs[1])
+
+    def testTagDemandKeyMap(self):
+        """Test that unused tags are left out of the name mapping."""
+        tb = tagboy.TagBoy()
+        options, pos_args = tagboy.ArgParser().parse_args([
+            self.testdata, '--eval',
+            'x = tags["Exif.Image.Make"], tags["Model"]'])
+        tb.HandleArgs(options, pos_args)
+        revmap = dict()
+        tb._MakeKeyMap(['Exif.Image.Make', 'Exif.Image.Model', 'Xmp.dc.Make',
+                        'Exif.Image.Orientation', 'Xmp.tiff.Model'], revmap)
+        self.assertEqual(revmap, {
+                'Exif.Image.Make': 'Exif.Image.Make',
+                'Make': 'Exif.Image.Make',
+                'Exif.Image.Model': 'Exif.Image.Model',
+                'Xmp.tiff.Model': 'Xmp.tiff.Model',
+                'Model': 'Xmp.tiff.Model'}) # same as with every tag
+
+    def testTagDemandDynamic(self):
+        """Test that --eval code with computed tag names gets every tag."""
+        for code in ('x = tags.get("Exif." + y)', 'x = tags.get("%s" % y)',
+                     'x = tags.pop("Exif.Image." + y, None)',
+                     'print objmap.keys()'):
+            tb = tagboy.TagBoy()
+            options, pos_args = tagboy.ArgParser().parse_args([
+                self.testdata, '--echo', '$Model', '--eval', code])
+            tb.HandleArgs(options, pos_args)
+            self.assert_(tb.demand is None,
+                         "Expected all tags for %r: %s" % (code, tb.demand))
+        tb = tagboy.TagBoy()
+        options, pos_args = tagboy.ArgParser().parse_args([
+            self.testdata, '--eval', 'x = tags.get("Make", "?") + y'])
+        tb.HandleArgs(options, pos_args)
+        self.assert_(tb.demand is not None and tb.demand.Wants('Exif.Image.Make'),
+                     "Expected just Make: %s" % tb.demand)
+        self.assert_(not tb.demand.Wants('Exif.Image.Model'))
+
+    def testEvalBatch(self):
+        """Test --evalbatch counts like --evalfile and can skip files."""
+        tdir = self.testdata
+        outputs = []
+        for args in (['--evalfile', os.path.join(tdir, 'tagcount-eval.py')],
+                     ['--evalbatch', os.path.join(tdir, 'tagcount-batch.py'),
+                      '--evalbatch-size', '2']):
+            sys.stdout = StringIO.StringIO() # redirect stdout
+            self.tb = tagboy.TagBoy()
+            options, pos_args = tagboy.ArgParser().parse_args([
+                tdir, '--iname', '*.jpg', '--long',
+                '--beginfile', os.path.join(tdir, 'tagcount-begin.py'),
+                '--endfile', os.path.join(tdir, 'tagcount-end.py')] + args)
+            args = self.tb.HandleArgs(options, pos_args)
+            self.tb.EachDir(tdir)
+            self.tb.DoEnd()
+            outputs.append(sys.stdout.getvalue())
+            sys.stdout.close()      # free memory
+            sys.stdout = self.old_stdout
+        self.assert_('Looked at' in outputs[0], "No counts: %s" % outputs[0])
+        self.assertEqual(outputs[1], outputs[0])
+
+        fd, batch_path = tempfile.mkstemp(suffix='.py')
+        os.write(fd, "def evalbatch(records):\n"
+                 "  return [not path.endswith('.JPG') for path, t, s in records]\n"
+                 "evalbatch_tags = []\n")
+        os.close(fd)
+        sys.stdout = StringIO.StringIO() # redirect stdout
+        self.tb = tagboy.TagBoy()
+        options, pos_args = tagboy.ArgParser().parse_args([
+            tdir, '--iname', '*.jpg', '--print', '--evalbatch', batch_path])
+        args = self.tb.HandleArgs(options, pos_args)
+        self.tb.EachDir(tdir)
+        self.tb.DoEnd()
+        output = sys.stdout.getvalue()
+        sys.stdout.close()      # free memory
+        sys.stdout = self.old_stdout
+        os.remove(batch_path)
+        self.assertEqual(output.splitlines(),
+                         [os.path.join(tdir, 'DSCN0443.JPG')])
+        self.assertEqual(self.tb.match_count, 1)
+
+        fd, batch_path = tempfile.mkstemp(suffix='.py')
+        os.write(fd, "def evalbatch(records):\n  return None\n")
+        os.close(fd)
+        sys.stdout = StringIO.StringIO() # redirect stdout
+        self.tb = tagboy.TagBoy()
+        options, pos_args = tagboy.ArgParser().parse_args([
+            tdir, '--iname', '*.jpg', '--echo', '$_filecount $_matchcount',
+            '--evalbatch', batch_path, '--evalbatch-size', '3'])
+        args = self.tb.HandleArgs(options, pos_args)
+        self.tb.EachDir(tdir)
+        self.tb.DoEnd()
+        output = sys.stdout.getvalue()
+        sys.stdout.close()      # free memory
+        sys.stdout = self.old_stdout
+        os.remove(batch_path)
+        count = self.tb.file_count
+        self.assertEqual(output.splitlines(),
+                         ['%d %d' % (ii, ii) for ii in range(1, count + 1)])
+
     def testGrepFilename(self):
         """Simple test of grep -v -H."""
         sys.stdout = StringIO.StringIO() # redirect stdout
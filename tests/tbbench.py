@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+
+# ******************************************************************************
+#
+# Copyright (C) 2018 Dan Christian <DanChristian65@gmail.com>
+#
+# This file is part of tagboy distribution.
+#
+# tagboy is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# tagboy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tagboy; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, 5th Floor, Boston, MA 02110-1301 USA.
+#
+# Author: Dan Christian <DanChristian65@gmail.com>
+#
+# ******************************************************************************
+
+"""Benchmarks for tagboy.
+
+Builds a synthetic tree of images (copies of the testdata images) and
+times the standard workloads on it, plus some micro benchmarks.
+Results can be saved as a json baseline and later runs compared
+against it.
+
+Usage: PYTHONPATH=.. tbbench.py [--files N] [--depth D] [--save FILE]
+                                [--compare FILE [--threshold FRACTION]]
+"""
+
+import cPickle
+import fnmatch
+import gc
+import json
+import optparse
+import os
+import random
+import shutil
+import StringIO
+import sys
+import tempfile
+import time
+import types
+try:
+    import tagboy
+except ImportError:
+    print "Unable to load tagboy.  You may need: PYTHONPATH=.. tbbench.py"
+    raise
+
+# A typical driver script --iname list
+EXT_GLOBS = ['*.' + ee for ee in (
+    'jpg', 'jpeg', 'jpe', 'tif', 'tiff', 'png', 'gif', 'bmp', 'cr2', 'crw',
+    'nef', 'nrw', 'arw', 'srf', 'sr2', 'orf', 'rw2', 'raf', 'pef', 'dng',
+    'x3f', 'mrw', 'webp', 'heic')]
+EXTENSIONS = ['jpg', 'JPG', 'txt', 'html', 'py', 'c', 'h', 'o', 'so', 'png',
+              'json', 'xml', 'log', 'cr2', 'md', 'gz']
+
+NEAR = '(37.273852, -107.884577)'
+
+# Same code as tb-tagcount
+TAGCOUNT_BEGIN = """
+global hist
+hist={}
+"""
+TAGCOUNT_EACH = """
+global hist
+tkeys = selected.keys() if (selected is not None) else tags.keys()
+
+for kk in tkeys:
+  if not tags[kk] or kk.find(".") < 1:
+    continue
+  if hist.has_key(kk):
+    hist[kk] += 1
+  else:
+    hist[kk] = 1
+"""
+TAGCOUNT_END = """
+global hist
+for kk in sorted(hist.keys()):
+  print "%60s: %d" % (kk, hist[kk])
+print "Looked at %d files" % filecount
+"""
+
+# name -> tagboy arguments (after the corpus directory).
+# LINKDIR is replaced with a scratch directory.
+WORKLOADS = {
+    'ls':       ['--iname', '*.jpg', '--ls'],
+    'grep':     ['--iname', '*.jpg', '--grep', '.', '*GPS*', '--print'],
+    'near':     ['--iname', '*.jpg', '--near', NEAR, '--distance', '999',
+                 '--print'],
+    'echo':     ['--iname', '*.jpg', '--echo', '$_filename: $Model $Make'],
+    'tagcount': ['--iname', '*.jpg', '--begin', TAGCOUNT_BEGIN,
+                 '--eval', TAGCOUNT_EACH, '--end', TAGCOUNT_END],
+    'symlink':  ['--iname', '*.jpg', '--grep', '.', 'Model',
+                 '--symlink', 'LINKDIR', '--symclear'],
+    }
+
+
+def FindSeeds(seed_dir):
+    """Return ([images with GPS], [images without]) in seed_dir."""
+    gps = []
+    no_gps = []
+    tb = tagboy.TagBoy()
+    options, pos_args = tagboy.ArgParser().parse_args([seed_dir])
+    tb.HandleArgs(options, pos_args)
+    for fn in sorted(os.listdir(seed_dir)):
+        if not fn.lower().endswith('.jpg'):
+            continue
+        path = os.path.join(seed_dir, fn)
+        meta = tb.ReadMetadata(path)
+        if not meta:
+            continue
+        if 'Exif.GPSInfo.GPSLatitude' in meta.exif_keys:
+            gps.append(path)
+        else:
+            no_gps.append(path)
+    return gps, no_gps
+
+
+def MakeCorpus(top, seed_dir, count, depth, gps_fraction=0.5, fanout=4,
+               seed=42):
+    """Fill top with count images in a tree depth directories deep.
+
+    Each file is a copy of a seed image (so key sets vary with the
+    seeds), gps_fraction of them with GPS tags.  Directories have up
+    to fanout sub-directories.
+    """
+    gps, no_gps = FindSeeds(seed_dir)
+    if not gps or not no_gps:
+        gps_fraction = 1.0 if gps else 0.0
+    rand = random.Random(seed)
+    dirs = ['']
+    level = ['']
+    for _ in range(depth):
+        level = [os.path.join(dd, 'd%d' % ii)
+                 for dd in level for ii in range(fanout)]
+        dirs.extend(level)
+    for dd in dirs[1:]:
+        os.mkdir(os.path.join(top, dd))
+    for ii in range(count):
+        src = rand.choice(gps if rand.random() < gps_fraction else no_gps)
+        dst = os.path.join(top, rand.choice(dirs), 'img%06d.jpg' % ii)
+        shutil.copyfile(src, dst)
+    return {'files': count, 'depth': depth, 'dirs': len(dirs),
+            'gps_fraction': gps_fraction, 'seeds': len(gps) + len(no_gps)}
+
+
+def RunTagboy(args):
+    """Run tagboy in this process.  Returns (seconds, file_count)."""
+    old_stdout = sys.stdout
+    sys.stdout = StringIO.StringIO() # output isn't part of the test
+    try:
+        start = time.time()
+        tb = tagboy.TagBoy()
+        options, pos_args = tagboy.ArgParser().parse_args(args)
+        for parg in tb.HandleArgs(options, pos_args):
+            tb.EachDir(parg)
+        tb.DoEnd()
+        return time.time() - start, tb.file_count
+    finally:
+        sys.stdout.close()
+        sys.stdout = old_stdout
+
+
+def BenchWorkloads(corpus, names, repeat=3, extra=[]):
+    """Time each named workload (best of repeat)."""
+    results = {}
+    for name in names:
+        link_dir = tempfile.mkdtemp()
+        args = [corpus] + [link_dir if aa == 'LINKDIR' else aa
+                           for aa in WORKLOADS[name]] + extra
+        best = None
+        for _ in range(repeat):
+            secs, files = RunTagboy(args)
+            if best is None or secs < best:
+                best = secs
+        shutil.rmtree(link_dir)
+        results[name] = {'seconds': best, 'files': files,
+                         'files_per_sec': files / best if best else 0.0}
+        print "  %-10s %8.3f sec %10.1f files/sec" % (
+            name, best, results[name]['files_per_sec'])
+    return results
+
+
+def Timed(func, names, repeat=3):
+    """Return (best seconds, match count) for func over names."""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        count = 0
+        for nn in names:
+            if func(nn):
+                count += 1
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, count
+
+
+def BenchNameMatch(count=200000):
+    """Compare the old per-glob fnmatch loop with NameMatcher."""
+    rand = random.Random(42)
+    names = ['file%06d.%s' % (ii, rand.choice(EXTENSIONS))
+             for ii in range(count)]
+    iglobs = [gg.lower() for gg in EXT_GLOBS]
+
+    def FnmatchLoop(fname):   # CheckMatch before NameMatcher
+        for chk in iglobs:
+            if fnmatch.fnmatchcase(fname.lower(), chk):
+                return True
+        return False
+
+    old_secs, old_count = Timed(FnmatchLoop, names)
+    new_secs, new_count = Timed(tagboy.NameMatcher([], iglobs), names)
+    mixed = tagboy.NameMatcher(['IMG_*', 'DSC?????.*'], iglobs)
+    mixed_secs, _ = Timed(mixed, names)
+    assert old_count == new_count, "Match counts differ %d != %d" % (
+        old_count, new_count)
+    print "Name match: %d names, %d globs, %d matched" % (
+        count, len(iglobs), new_count)
+    print "  fnmatch loop  %8.0f names/sec" % (count / old_secs)
+    print "  NameMatcher   %8.0f names/sec (%.1fx)" % (
+        count / new_secs, old_secs / new_secs)
+    print "  with regex    %8.0f names/sec" % (count / mixed_secs)
+    return {'name_match': {'seconds': new_secs,
+                           'files_per_sec': count / new_secs}}
+
+
+class _LegacySnapshot(object):
+    """MetadataSnapshot as it was before TagSchema (for BenchRecordMemory)."""
+
+    def __init__(self, exif_keys, iptc_keys, xmp_keys, tags):
+        self.exif_keys = exif_keys
+        self.iptc_keys = iptc_keys
+        self.xmp_keys = xmp_keys
+        self.tags = tags
+
+
+def DeepSize(root):
+    """Return the bytes used by root and everything it refers to.
+
+    Shared objects are counted once.  Code (and the TagBoy instance
+    behind a tag conversion function) isn't counted.
+    """
+    skip = (type, types.ModuleType, types.FunctionType, types.MethodType,
+            types.BuiltinFunctionType, tagboy.TagBoy)
+    seen = set()
+    stack = [root]
+    total = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, skip):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return total
+
+
+def BenchRecordMemory(count=20000, layouts=3, keys=160, used=8):
+    """Compare the memory held per file record, old layout and new.
+
+    Records are made the way --jobs (or --evalbatch) holds them: built
+    in a worker, pickled to the parent, and kept with their tags.
+    """
+    schemas = []
+    for ll in range(layouts):
+        exif = ['Exif.Photo.Tag%03d' % ii for ii in range(keys * 3 // 4)]
+        exif[:2] = ['Exif.Image.Make', 'Exif.Image.Model']
+        exif.append('Exif.Image.Layout%d' % ll)
+        iptc = ['Iptc.Application2.Tag%02d' % ii for ii in range(keys // 16)]
+        xmp = ['Xmp.dc.Tag%02d' % ii for ii in range(keys - len(exif) - len(iptc))]
+        schemas.append((exif, iptc, xmp))
+    tb = tagboy.TagBoy()
+    options, pos_args = tagboy.ArgParser().parse_args(['.', '--ls'])
+    tb.HandleArgs(options, pos_args) # every tag is mapped
+
+    start = time.time()
+    compact = []
+    legacy = []
+    for ii in range(count):
+        exif, iptc, xmp = schemas[ii % layouts]
+        tags = dict((kk, ('v%d' % ii, 'v%d' % ii, None, False, kk[-5:]))
+                    for kk in exif[:used])
+        meta = tagboy.MetadataSnapshot(exif, iptc, xmp, tags)
+        rec = tb.ScanMetadata('img%06d.jpg' % ii, meta)
+        for kk in exif[:used]:
+            rec.tags[kk]
+        rec.tags = rec.tags.Converted()
+        revmap = rec.revmap
+        rec.revmap = None       # as ScanFile() sends it
+        rec = cPickle.loads(cPickle.dumps(rec, cPickle.HIGHEST_PROTOCOL))
+        rec.revmap = tb.KeyMap(rec.meta)
+        rec.tags = tb._MakeTagDict(rec.meta, rec.revmap, rec.tags)
+        compact.append(rec)
+
+        old = cPickle.loads(cPickle.dumps(
+            (rec.path, meta.GetState(), dict(revmap), rec.tags.Converted()),
+            cPickle.HIGHEST_PROTOCOL))
+        path, state, revmap, converted = old
+        legacy.append({'path': path, 'meta': _LegacySnapshot(*state),
+                       'revmap': revmap, 'selected': None,
+                       'tags': (converted, dict(revmap))}) # LazyTagDict copy
+    secs = time.time() - start
+    per_file = {'legacy': DeepSize(legacy) / float(count),
+                'compact': DeepSize(compact) / float(count)}
+    print "Record memory: %d files, %d keys each, %d layouts" % (
+        count, keys, layouts)
+    for name in ('legacy', 'compact'):
+        print "  %-8s %8.1f MB per 100k files" % (
+            name, per_file[name] * 100000 / 1e6)
+    print "  %.1fx smaller" % (per_file['legacy'] / per_file['compact'])
+    return {'record_memory': {'seconds': secs,
+                              'bytes_per_100k': per_file['compact'] * 100000,
+                              'legacy_bytes_per_100k':
+                                  per_file['legacy'] * 100000}}
+
+
+def Compare(results, baseline, threshold):
+    """Print each result against baseline.  Returns the regressed names."""
+    regressed = []
+    print "Compared to baseline (threshold %.0f%%):" % (100 * threshold)
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name]['seconds']
+        new = results[name]['seconds']
+        change = (new - old) / old if old else 0.0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressed.append(name)
+        print "  %-10s %8.3f -> %8.3f sec %+7.1f%%%s" % (
+            name, old, new, 100 * change, flag)
+    return regressed
+
+
+def BenchParser():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option("--files", type="int", default=500,
+                      help="Number of images in the corpus (default 500)")
+    parser.add_option("--depth", type="int", default=2,
+                      help="Directory depth of the corpus (default 2)")
+    parser.add_option("--gps-fraction", type="float", default=0.5,
+                      dest="gps_fraction",
+                      help="Fraction of images with GPS tags (default 0.5)")
+    parser.add_option("--seeds", default=None,
+                      help="Directory of seed images (default testdata)")
+    parser.add_option("--corpus", default=None,
+                      help="Build (or reuse) the corpus here")
+    parser.add_option("--repeat", type="int", default=3,
+                      help="Runs per workload, best is kept (default 3)")
+    parser.add_option("--workload", action="append", dest="workloads",
+                      default=[], help="Only run WORKLOAD (repeatable): "
+                      + ', '.join(sorted(WORKLOADS)))
+    parser.add_option("--tagboy-arg", action="append", dest="extra",
+                      default=[], help="Extra tagboy argument (repeatable)"
+                      " e.g. --tagboy-arg=--jobs=4")
+    parser.add_option("--records", type="int", default=20000,
+                      help="Records for the memory benchmark (default 20000)")
+    parser.add_option("--save", default=None,
+                      help="Save the results as a json baseline")
+    parser.add_option("--compare", default=None,
+                      help="Compare the results with a json baseline")
+    parser.add_option("--threshold", type="float", default=0.10,
+                      help="Slow down that is a regression (default 0.10)")
+    return parser
+
+
+def main():
+    options, args = BenchParser().parse_args()
+    seeds = options.seeds
+    if not seeds:
+        here = os.path.dirname(os.path.abspath(__file__))
+        seeds = os.path.join(here, 'testdata')
+    for name in options.workloads:
+        if name not in WORKLOADS:
+            print "Unknown workload: %s" % name
+            sys.exit(2)
+
+    corpus = options.corpus
+    scratch = None
+    if not corpus:
+        corpus = scratch = tempfile.mkdtemp(prefix='tbbench')
+    try:
+        if not os.path.isdir(corpus) or not os.listdir(corpus):
+            if not os.path.isdir(corpus):
+                os.makedirs(corpus)
+            start = time.time()
+            info = MakeCorpus(corpus, seeds, options.files, options.depth,
+                              options.gps_fraction)
+            print "Corpus: %d files in %d directories (%.1f sec)" % (
+                info['files'], info['dirs'], time.time() - start)
+        else:
+            info = {'reused': corpus}
+            print "Corpus: reusing %s" % corpus
+        print "Workloads (best of %d):" % options.repeat
+        results = BenchWorkloads(corpus,
+                                 options.workloads or sorted(WORKLOADS),
+                                 options.repeat, options.extra)
+    finally:
+        if scratch:
+            shutil.rmtree(scratch)
+    results.update(BenchNameMatch())
+    results.update(BenchRecordMemory(options.records))
+
+    if options.save:
+        with open(options.save, 'w') as fd:
+            json.dump({'corpus': info, 'args': options.extra,
+                       'python': sys.version.split()[0],
+                       'results': results}, fd, indent=2, sort_keys=True)
+            fd.write('\n')
+        print "Saved baseline: %s" % options.save
+    if options.compare:
+        with open(options.compare) as fd:
+            baseline = json.load(fd)
+        if Compare(results, baseline['results'], options.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
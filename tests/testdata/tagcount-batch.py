@@ -0,0 +1,10 @@
+# Count tags like tagcount-eval.py, but a batch of files at a time.
+# Use with: --beginfile tagcount-begin.py --evalbatch tagcount-batch.py
+#           --endfile tagcount-end.py
+def evalbatch(records):
+  global hist
+  for path, tags, selected in records:
+    for kk, vv in tags.iteritems():
+      if vv and kk.find(".") >= 1:
+        hist[kk] = hist.get(kk, 0) + 1
+  return None                   # don't skip any